@@ -0,0 +1,182 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Inference backends that run a model on a flat uint8 input tensor.
+
+A backend offers:
+
+  inputShape()  The model's input shape, [1, height, width, 3].
+  outputSize()  The length of the (single) output vector.
+  run(tensor)   The output vector as np.float32 for a flat input tensor.
+
+EdgeTpuBackend runs on an Edge TPU with the edgetpu library, TFLiteBackend
+on the CPU with the TF Lite interpreter, and ReferenceBackend is a
+deterministic NumPy model for benchmarking everything around inference on
+machines with neither. Each backend imports its library only when created.
+"""
+
+import os
+
+import numpy as np
+
+BACKENDS = ('edgetpu', 'cpu', 'reference')
+
+
+def edgeTpuPaths():
+  """Returns the paths of the Edge TPUs not yet used by an engine."""
+  from edgetpu.basic import edgetpu_utils
+  return list(edgetpu_utils.ListEdgeTpuPaths(
+      edgetpu_utils.EDGE_TPU_STATE_UNASSIGNED))
+
+
+class EdgeTpuBackend(object):
+  """Runs an Edge TPU compiled model with edgetpu's BasicEngine."""
+
+  def __init__(self, model_path, device_path=None):
+    """Args:
+      model_path: String, path to TF-Lite Flatbuffer file.
+      device_path: String, Edge TPU to run on (see edgeTpuPaths), or None
+        for any.
+
+    Raises:
+      ValueError: The model has more than one output tensor.
+    """
+    from edgetpu.basic.basic_engine import BasicEngine
+    if device_path: self._engine = BasicEngine(model_path, device_path)
+    else: self._engine = BasicEngine(model_path)
+    output_tensors_sizes = self._engine.get_all_output_tensors_sizes()
+    if output_tensors_sizes.size != 1:
+      raise ValueError(
+          ('Dectection model should have only 1 output tensor!'
+           'This model has {}.'.format(output_tensors_sizes.size)))
+    self._output_size = int(output_tensors_sizes[0])
+
+  def inputShape(self):
+    return tuple(self._engine.get_input_tensor_shape())
+
+  def outputSize(self):
+    return self._output_size
+
+  def run(self, tensor):
+    return self._engine.RunInference(tensor)[1]
+
+
+def _cpuModelPath(model_path):
+  """Returns the CPU version of an Edge TPU compiled model, or model_path
+  if it is not compiled.
+
+  Compiled models hold the network in a custom op only the Edge TPU runs;
+  by convention the uncompiled model sits next to them without _edgetpu.
+
+  Raises:
+    ValueError: The model is compiled and there is no uncompiled one.
+  """
+  if not model_path.endswith('_edgetpu.tflite'): return model_path
+  cpu_path = model_path[:-len('_edgetpu.tflite')] + '.tflite'
+  if not os.path.isfile(cpu_path):
+    raise ValueError(
+        '%s is compiled for the Edge TPU; the CPU backend needs the '
+        'uncompiled model at %s.' % (model_path, cpu_path))
+  return cpu_path
+
+
+class TFLiteBackend(object):
+  """Runs a model on the CPU with the TF Lite interpreter.
+
+     Uses tflite_runtime if installed, else tensorflow.lite. Given an Edge
+     TPU compiled model, runs the uncompiled one next to it instead, which
+     must exist.
+  """
+
+  def __init__(self, model_path, threads=None):
+    """Args:
+      model_path: String, path to TF-Lite Flatbuffer file.
+      threads: Int, number of CPU threads the interpreter may use.
+
+    Raises:
+      ImportError: Neither tflite_runtime nor tensorflow is installed.
+      ValueError: The model has more than one output tensor, or is compiled
+        for the Edge TPU without an uncompiled one next to it.
+    """
+    model_path = _cpuModelPath(model_path)
+    try:
+      from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+      from tensorflow.lite import Interpreter
+    kwargs = {'num_threads': threads} if threads else {}
+    self._interpreter = Interpreter(model_path=model_path, **kwargs)
+    self._interpreter.allocate_tensors()
+    self._input = self._interpreter.get_input_details()[0]
+    outputs = self._interpreter.get_output_details()
+    if len(outputs) != 1:
+      raise ValueError(
+          'Embedding models have 1 output tensor, this one has %d.'
+          % len(outputs))
+    self._output = outputs[0]
+    self._scale, self._zero_point = self._output['quantization']
+
+  def inputShape(self):
+    return tuple(int(d) for d in self._input['shape'])
+
+  def outputSize(self):
+    return int(np.prod(self._output['shape']))
+
+  def run(self, tensor):
+    self._interpreter.set_tensor(self._input['index'],
+                                 tensor.reshape(self._input['shape']))
+    self._interpreter.invoke()
+    output = self._interpreter.get_tensor(self._output['index']).ravel()
+    # Dequantize like the Edge TPU library does.
+    if self._scale: return (output.astype(np.float32) -
+                            self._zero_point)*self._scale
+    return output.astype(np.float32)
+
+
+class ReferenceBackend(object):
+  """Deterministic NumPy stand-in for the headless MobileNet.
+
+     Pools the image to a coarse grid and projects that with a fixed random
+     matrix, so that similar images get similar embeddings. Costs a few
+     milliseconds per frame on a desktop CPU, much less than a model would,
+     which leaves mostly the rest of the pipeline to be measured.
+  """
+
+  def __init__(self, input_shape=(1, 224, 224, 3), output_size=1024, grid=14,
+               seed=0):
+    self._input_shape = tuple(input_shape)
+    self._grid = grid
+    rng = np.random.RandomState(seed)
+    self._projection = rng.randn(grid*grid*3, output_size).astype(np.float32)
+
+  def inputShape(self):
+    return self._input_shape
+
+  def outputSize(self):
+    return self._projection.shape[1]
+
+  def run(self, tensor):
+    _, height, width, _ = self._input_shape
+    pixels = tensor.reshape(height, width, 3).astype(np.float32)
+    cell_h, cell_w = height//self._grid, width//self._grid
+    pooled = pixels[:cell_h*self._grid, :cell_w*self._grid].reshape(
+        self._grid, cell_h, self._grid, cell_w, 3).mean(axis=(1, 3))
+    return np.maximum(np.dot(pooled.ravel()/255.0, self._projection), 0)
+
+
+def makeBackend(name, model_path, device_path=None):
+  """Returns the backend called name (one of BACKENDS) for a model."""
+  if name == 'edgetpu': return EdgeTpuBackend(model_path, device_path)
+  if name == 'cpu': return TFLiteBackend(model_path)
+  if name == 'reference': return ReferenceBackend()
+  raise ValueError('Unknown backend %s' % name)
@@ -0,0 +1,650 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for the embedding store, runnable without an Edge TPU.
+
+Usage:
+  python3 benchmark.py store --sizes 10,100,1000,10000,100000
+  python3 benchmark.py ann --size 100000 --probes 1,2,4,8,16
+  python3 benchmark.py compress [--replay embeddings.npz]
+  python3 benchmark.py bounded --stream 20000 --capacity 256
+  python3 benchmark.py labels --classes 1000,2000,5000
+  python3 benchmark.py suite --output results.json [--baseline base.json]
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from collections import Counter
+from collections import defaultdict
+
+import numpy as np
+
+from PIL import Image
+
+import compress
+import bounded
+from embedding import ImprintingEmbeddingEngine, KNNEmbeddingEngine
+from frames import inputTensor
+from ivf import IVFIndex
+from labels import LabelRegistry
+from store import EmbeddingStore
+
+
+def synthetic_embeddings(count, dim=1024, classes=4, noise=0.5, seed=0):
+  """Returns clustered, non-negative embeddings and their labels.
+
+  Each class is a random center plus gaussian noise, clipped at zero like the
+  ReLU output of a headless MobileNet. Labels start at 1, like the buttons.
+  The centers only depend on dim and classes, so calls with different seeds
+  draw from the same classes.
+  """
+  centers = np.abs(np.random.RandomState(dim*classes).randn(classes, dim))
+  centers = centers.astype(np.float32)
+  rng = np.random.RandomState(seed)
+  labels = rng.randint(0, classes, size=count)
+  embs = centers[labels] + noise*rng.randn(count, dim).astype(np.float32)
+  return np.maximum(embs, 0, out=embs), labels + 1
+
+
+class LegacyStore(object):
+  """The list-of-lists store KNNEmbeddingEngine used before EmbeddingStore.
+
+     Kept only as a baseline: every add re-stacks, re-pads and re-concatenates
+     the whole store.
+  """
+
+  def __init__(self, kNN=3):
+    self._kNN = kNN
+    self._embedding_map = defaultdict(list)
+    self._embeddings = None
+    self._labels = []
+
+  def add(self, emb, label):
+    normal = emb/np.sqrt((emb**2).sum())
+    self._embedding_map[label].append(normal)
+    emb_blocks = []
+    self._labels = []
+    for label, embeds in self._embedding_map.items():
+      emb_block = np.stack(embeds)
+      if emb_block.shape[0] < self._kNN:
+        emb_block = np.pad(emb_block,
+                           [(0, self._kNN - emb_block.shape[0]), (0, 0)],
+                           mode="reflect")
+      emb_blocks.append(emb_block)
+      self._labels.extend([label]*emb_block.shape[0])
+    self._embeddings = np.concatenate(emb_blocks, axis=0)
+
+  def query(self, query_emb):
+    if self._embeddings is None: return None
+    query_emb = query_emb/np.sqrt((query_emb**2).sum())
+    dists = np.matmul(self._embeddings, query_emb)
+    kNN = min(len(dists), self._kNN)
+    n_argmax = np.argpartition(dists, -kNN)[-kNN:]
+    labels = [self._labels[i] for i in n_argmax]
+    return Counter(labels).most_common(1)[0][0]
+
+
+def time_store(store, embs, labels, queries):
+  """Fills a store and returns (mean add, last add, mean query) in ms."""
+  add_times = np.empty(len(embs))
+  for i in range(len(embs)):
+    start = time.perf_counter()
+    store.add(embs[i], labels[i])
+    add_times[i] = time.perf_counter() - start
+  start = time.perf_counter()
+  for query in queries:
+    store.query(query)
+  query_time = (time.perf_counter() - start)/len(queries)
+  return 1e3*add_times.mean(), 1e3*add_times[-1], 1e3*query_time
+
+
+def run_store(args):
+  sizes = [int(s) for s in args.sizes.split(',')]
+  queries, _ = synthetic_embeddings(args.queries, args.dim, args.classes,
+                                    seed=1)
+  print('%8s %-8s %12s %12s %12s' % (
+      'examples', 'store', 'add mean ms', 'add last ms', 'query ms'))
+  for size in sizes:
+    embs, labels = synthetic_embeddings(size, args.dim, args.classes)
+    stores = [('array', EmbeddingStore(args.k))]
+    if size <= args.legacy_max:
+      stores.append(('legacy', LegacyStore(args.k)))
+    for name, store in stores:
+      add_mean, add_last, query = time_store(store, embs, labels, queries)
+      print('%8d %-8s %12.4f %12.4f %12.4f' % (
+          size, name, add_mean, add_last, query))
+    sys.stdout.flush()
+
+
+def run_ann(args):
+  embs, labels = synthetic_embeddings(args.size, args.dim, args.classes,
+                                      args.noise)
+  queries, _ = synthetic_embeddings(args.queries, args.dim, args.classes,
+                                    args.noise, seed=1)
+  exact = EmbeddingStore(args.k)
+  for emb, label in zip(embs, labels): exact.add(emb, label)
+
+  def measure(store):
+    """Returns (mean query ms, neighbors per query, labels per query)."""
+    neighbors, votes = [], []
+    start = time.perf_counter()
+    for query in queries:
+      neighbors.append(store.neighbors(query, args.k))
+      votes.append(store.query(query))
+    elapsed = (time.perf_counter() - start)/(2*len(queries))
+    return 1e3*elapsed, neighbors, votes
+
+  exact_ms, exact_neighbors, exact_votes = measure(exact)
+  print('%d examples, %d classes, dim %d, k=%d' % (
+      args.size, args.classes, args.dim, args.k))
+  print('%-8s %6s %10s %10s %12s' % (
+      'mode', 'nprobe', 'query ms', 'recall@k', 'same label'))
+  print('%-8s %6s %10.4f %10.4f %12.4f' % ('exact', '-', exact_ms, 1.0, 1.0))
+  for nprobe in [int(p) for p in args.probes.split(',')]:
+    index = IVFIndex(nprobe, args.list_size)
+    ann = EmbeddingStore(args.k, index=index)
+    start = time.perf_counter()
+    for emb, label in zip(embs, labels): ann.add(emb, label)
+    build_s = time.perf_counter() - start
+    ann_ms, ann_neighbors, ann_votes = measure(ann)
+    recall = np.mean([len(np.intersect1d(a, e))/float(len(e))
+                      for a, e in zip(ann_neighbors, exact_neighbors)])
+    agreement = np.mean([a == e for a, e in zip(ann_votes, exact_votes)])
+    print('%-8s %6d %10.4f %10.4f %12.4f  (%d lists, %.1f MB, built in '
+          '%.1fs)' % ('ivf', nprobe, ann_ms, recall, agreement,
+                      index.listCount(), ann.nbytes()/1e6, build_s))
+    sys.stdout.flush()
+
+
+def load_replay(path):
+  """Loads recorded embeddings from an .npz with 'embeddings' and 'labels'."""
+  with np.load(path) as data:
+    return data['embeddings'].astype(np.float32), data['labels']
+
+
+def run_compress(args):
+  datasets = []
+  embs, labels = synthetic_embeddings(args.size + args.queries, args.dim,
+                                      args.classes, args.noise)
+  datasets.append(('synthetic', embs, labels))
+  if args.replay:
+    embs, labels = load_replay(args.replay)
+    order = np.random.RandomState(0).permutation(len(embs))
+    datasets.append(('replay', embs[order], labels[order]))
+
+  configs = [(dtype, projection)
+             for projection in ('none',) + compress.PROJECTIONS
+             for dtype in compress.DTYPES]
+  print('%-10s %-8s %-10s %10s %10s %10s %10s' % (
+      'dataset', 'dtype', 'projection', 'bytes/ex', 'query ms', 'accuracy',
+      'delta'))
+  for name, embs, labels in datasets:
+    # Hold out the last examples as queries with known labels.
+    split = len(embs) - min(args.queries, len(embs)//5)
+    baseline = None
+    for dtype, projection in configs:
+      store = EmbeddingStore(
+          args.k, dtype=dtype,
+          projection=compress.makeProjection(projection, args.projection_dim))
+      for emb, label in zip(embs[:split], labels[:split]): store.add(emb, label)
+      start = time.perf_counter()
+      predicted = [store.query(query) for query in embs[split:]]
+      query_ms = 1e3*(time.perf_counter() - start)/(len(embs) - split)
+      accuracy = np.mean(np.array(predicted) == labels[split:])
+      if baseline is None: baseline = accuracy
+      print('%-10s %-8s %-10s %10.0f %10.4f %10.4f %+10.4f' % (
+          name, dtype, projection, store.nbytes()/float(split), query_ms,
+          accuracy, accuracy - baseline))
+      sys.stdout.flush()
+
+
+def taught_stream(count, dim=1024, classes=4, views=8, burst=30, noise=0.3,
+                  seed=0):
+  """Returns embeddings taught like a long unattended run, and labels.
+
+  Each class is seen in several views (random offsets from its center).
+  Examples come in bursts of near duplicates of one view, like frames added
+  while a button is held on an unchanging scene.
+  """
+  rng = np.random.RandomState(seed)
+  centers = np.abs(np.random.RandomState(dim*classes).randn(classes, dim))
+  offsets = np.random.RandomState(dim*classes + 1).randn(classes, views, dim)
+  embs = np.empty((count, dim), dtype=np.float32)
+  labels = np.empty(count, dtype=np.int64)
+  for start in range(0, count, burst):
+    end = min(start + burst, count)
+    label, view = rng.randint(classes), rng.randint(views)
+    frame = centers[label] + offsets[label, view] + noise*rng.randn(dim)
+    embs[start:end] = frame + 0.1*noise*rng.randn(end - start, dim)
+    labels[start:end] = label + 1
+  return np.maximum(embs, 0, out=embs), labels
+
+
+def run_bounded(args):
+  embs, labels = taught_stream(args.stream, args.dim, args.classes,
+                               args.views, args.burst, args.noise)
+  queries, query_labels = taught_stream(args.queries, args.dim, args.classes,
+                                        args.views, 1, args.noise, seed=1)
+  print('%d examples taught in bursts of %d, %d classes x %d views, '
+        'capacity %s, per class %s' % (
+            args.stream, args.burst, args.classes, args.views, args.capacity,
+            args.class_capacity))
+  print('%-10s %8s %8s %10s %12s %12s %10s' % (
+      'policy', 'examples', 'MB', 'add ms', 'query ms 10%', 'query ms end',
+      'accuracy'))
+  checkpoint = args.stream//10
+  for policy in ('unbounded',) + bounded.POLICIES:
+    store = EmbeddingStore(args.k)
+    if policy != 'unbounded':
+      store = bounded.BoundedStore(store, policy, args.class_capacity,
+                                   args.capacity, args.redundancy)
+    add_time = 0.0
+    query_ms = []
+    for i, (emb, label) in enumerate(zip(embs, labels)):
+      start = time.perf_counter()
+      store.add(emb, label)
+      add_time += time.perf_counter() - start
+      if i + 1 in (checkpoint, len(embs)):
+        start = time.perf_counter()
+        predicted = [store.query(query) for query in queries]
+        query_ms.append(1e3*(time.perf_counter() - start)/len(queries))
+    accuracy = np.mean(np.array(predicted) == query_labels)
+    print('%-10s %8d %8.2f %10.4f %12.4f %12.4f %10.4f' % (
+        policy, len(store), store.nbytes()/1e6, 1e3*add_time/len(embs),
+        query_ms[0], query_ms[-1], accuracy))
+    sys.stdout.flush()
+  return check_few_rows(embs, labels, args)
+
+
+def check_few_rows(embs, labels, args):
+  """Checks that no policy loses a class with fewer rows than classes."""
+  capacity = max(1, args.classes//2)
+  print('capacity %d for %d classes:' % (capacity, args.classes))
+  failed = False
+  for policy in bounded.POLICIES:
+    store = bounded.BoundedStore(EmbeddingStore(args.k), policy,
+                                 args.class_capacity, capacity,
+                                 args.redundancy)
+    kept = set()
+    lost = 0
+    for emb, label in zip(embs, labels):
+      store.add(emb, label)
+      now = set(np.unique(store.labels()).tolist())
+      lost += len(kept - now)
+      kept = now
+    failed = failed or lost > 0 or len(store) > capacity
+    print('%-10s %8d examples %4d classes kept %4d lost' % (
+        policy, len(store), len(kept), lost))
+  return 1 if failed else 0
+
+
+def run_labels(args):
+  print('about %d examples per class, %d-NN, queries batched by %d' % (
+      args.per_class, args.k, args.batch))
+  print('%8s %8s %12s %8s %10s %10s %12s %10s' % (
+      'classes', 'rows', 'padded rows', 'MB', 'padded MB', 'query ms',
+      'batch ms/q', 'accuracy'))
+  row_mb = args.dim*4/1e6
+  for classes in [int(c) for c in args.classes.split(',')]:
+    # Named classes get the ids after the buttons.
+    registry = LabelRegistry()
+    ids = np.array([registry.id('class%d' % c) for c in range(classes)])
+    embs, labels = synthetic_embeddings(classes*args.per_class, args.dim,
+                                        classes, args.noise)
+    queries, query_labels = synthetic_embeddings(args.queries, args.dim,
+                                                 classes, args.noise, seed=1)
+    labels, query_labels = ids[labels - 1], ids[query_labels - 1]
+    store = EmbeddingStore(args.k)
+    for emb, label in zip(embs, labels): store.add(emb, label)
+    # The rows the legacy store materialized, padding classes to k rows.
+    sizes = np.bincount(labels)
+    padded = int(np.maximum(sizes[sizes > 0], args.k).sum())
+
+    start = time.perf_counter()
+    for query in queries: store.query(query)
+    query_ms = 1e3*(time.perf_counter() - start)/len(queries)
+    start = time.perf_counter()
+    predicted = []
+    for i in range(0, len(queries), args.batch):
+      predicted.extend(store.queryBatch(queries[i:i + args.batch]))
+    batch_ms = 1e3*(time.perf_counter() - start)/len(queries)
+    accuracy = np.mean(np.array(predicted) == query_labels)
+    print('%8d %8d %12d %8.2f %10.2f %10.4f %12.4f %10.4f' % (
+        classes, len(store), padded, len(store)*row_mb, padded*row_mb,
+        query_ms, batch_ms, accuracy))
+    sys.stdout.flush()
+
+
+class StubBackend(object):
+  """Backend that stands in for the Edge TPU's BasicEngine without running
+  any model: it hands out precomputed synthetic embeddings in turn, so the
+  suite measures only the code around inference."""
+
+  def __init__(self, dim, classes=4, input_shape=(1, 224, 224, 3)):
+    self._input_shape = tuple(input_shape)
+    self._embs, _ = synthetic_embeddings(64, dim, classes, seed=2)
+    self._next = 0
+
+  def inputShape(self):
+    return self._input_shape
+
+  def outputSize(self):
+    return self._embs.shape[1]
+
+  def run(self, tensor):
+    self._next = (self._next + 1) % len(self._embs)
+    return self._embs[self._next]
+
+
+def normalized_rows(count, dim, classes, chunk=65536):
+  """Returns synthetic_embeddings() normalized like stored rows, generated
+  in chunks to keep the float64 temporaries of a million rows small."""
+  rows = np.empty((count, dim), dtype=np.float32)
+  labels = np.empty(count, dtype=np.int64)
+  for start in range(0, count, chunk):
+    end = min(start + chunk, count)
+    rows[start:end], labels[start:end] = synthetic_embeddings(
+        end - start, dim, classes, seed=start//chunk)
+  rows /= np.sqrt((rows**2).sum(axis=1, keepdims=True))
+  return rows, labels
+
+
+def ops_per_sec(function, items, min_time):
+  """Calls function on each item, round after round for at least min_time
+  seconds, and returns the calls per second.
+
+  A first call, on the first item, is not timed: it pays for one-off work
+  such as computing cached class means.
+  """
+  function(items[0])
+  calls = 0
+  start = time.perf_counter()
+  while True:
+    for item in items: function(item)
+    calls += len(items)
+    elapsed = time.perf_counter() - start
+    if elapsed >= min_time: return calls/elapsed
+
+
+def suite_config(size, dim, k, classes, args):
+  """Returns the ops/sec and memory of the kNN engine for one
+  configuration."""
+  engine = KNNEmbeddingEngine('stub', k, backend=StubBackend(dim, classes))
+  rows, labels = normalized_rows(size, dim, classes)
+  # Filled in bulk, as enroll.py's stores are loaded; adding a million rows
+  # one at a time would take most of the run.
+  engine.loadEmbeddings(rows, labels)
+  del rows, labels
+  # What the store holds, whatever ran before this configuration.
+  memory = engine.nbytes()
+
+  queries, query_labels = synthetic_embeddings(args.queries, dim, classes,
+                                               seed=1)
+  frames = [np.random.RandomState(i).randint(0, 256, (224, 224, 3), np.uint8)
+            for i in range(4)]
+  ops = {}
+  ops['query'] = ops_per_sec(engine.kNNEmbedding, queries, args.min_time)
+  ops['centroid'] = ops_per_sec(engine.centroidEmbedding, queries,
+                                args.min_time)
+  ops['classify'] = ops_per_sec(engine.classifyImage, frames, args.min_time)
+  ops['count'] = ops_per_sec(lambda _: engine.exampleCount(), [None]*1000,
+                             args.min_time)
+  # Last, as it grows the store.
+  ops['add'] = ops_per_sec(lambda i: engine.addEmbedding(queries[i],
+                                                         query_labels[i]),
+                           range(len(queries)), args.min_time)
+  return {'size': size, 'dim': dim, 'k': k, 'classes': classes, 'ops': ops,
+          'memory_mb': memory/1e6}
+
+
+def suite_fixed(args):
+  """Returns the ops/sec of the imprinting paths, which do not depend on a
+  store."""
+  size = (224, 224)
+  frame = np.random.RandomState(0).randint(0, 256, (224, 224, 3), np.uint8)
+  camera = Image.fromarray(np.random.RandomState(1).randint(
+      0, 256, (480, 640, 3), np.uint8))
+  # DemoImprintingEngine.addImage keeps a copy of the flat input tensor.
+  ops = {
+      'imprinting_tensor_array': ops_per_sec(
+          lambda img: np.array(inputTensor(img, size)), [frame]*100,
+          args.min_time),
+      'imprinting_tensor_pil': ops_per_sec(
+          lambda img: np.array(inputTensor(img, size)), [camera]*10,
+          args.min_time),
+  }
+  engine = ImprintingEmbeddingEngine('stub', backend=StubBackend(1024))
+  ops['imprinting_numpy_add'] = ops_per_sec(
+      lambda i: engine.addImage(frame, 1 + i % 4), range(100), args.min_time)
+  ops['imprinting_numpy_classify'] = ops_per_sec(
+      engine.classify, [frame]*100, args.min_time)
+  return ops
+
+
+def config_key(config):
+  return 'size=%(size)d dim=%(dim)d k=%(k)d classes=%(classes)d' % config
+
+
+def compare(results, baseline, tolerance):
+  """Prints how results compare to a baseline and returns the number of
+  regressions: ops/sec lower, or memory higher, by more than tolerance."""
+  base_configs = dict((config_key(c), c) for c in baseline['configs'])
+  rows = [(config_key(c), c['ops'], c['memory_mb'],
+           base_configs.get(config_key(c))) for c in results['configs']]
+  rows.append(('fixed', results['fixed'], None,
+               {'ops': baseline.get('fixed', {}), 'memory_mb': None}))
+  regressions = 0
+  print('%-40s %-26s %12s %12s %8s' % ('config', 'measure', 'baseline',
+                                       'now', 'ratio'))
+  for key, ops, memory, base in rows:
+    if base is None: continue
+    measures = [(op, base['ops'].get(op), value, False)
+                for op, value in sorted(ops.items())]
+    if memory is not None:
+      measures.append(('memory_mb', base['memory_mb'], memory, True))
+    for name, old, new, lower_is_better in measures:
+      if not old: continue
+      ratio = new/old
+      worse = (ratio > 1 + tolerance if lower_is_better
+               else ratio < 1 - tolerance)
+      regressions += worse
+      print('%-40s %-26s %12.1f %12.1f %8.2f%s' % (
+          key, name, old, new, ratio, '  REGRESSION' if worse else ''))
+  return regressions
+
+
+def run_suite(args):
+  sizes = [int(s) for s in args.sizes.split(',')]
+  grid = [(size, dim, k, classes) for size in sizes
+          for dim in [int(d) for d in args.dims.split(',')]
+          for k in [int(k) for k in args.ks.split(',')]
+          for classes in [int(c) for c in args.classes.split(',')]]
+  results = {'host': {'machine': platform.machine(),
+                      'python': platform.python_version(),
+                      'numpy': np.__version__},
+             'min_time': args.min_time, 'configs': [], 'skipped': []}
+  print('%8s %5s %3s %7s %10s %10s %10s %10s %10s %10s' % (
+      'examples', 'dim', 'k', 'classes', 'query/s', 'centroid/s',
+      'classify/s', 'count/s', 'add/s', 'MB'))
+  for size, dim, k, classes in grid:
+    if size*dim*4/1e6 > args.max_mb:
+      results['skipped'].append({'size': size, 'dim': dim, 'k': k,
+                                 'classes': classes})
+      continue
+    config = suite_config(size, dim, k, classes, args)
+    results['configs'].append(config)
+    print('%8d %5d %3d %7d %10.0f %10.0f %10.0f %10.0f %10.0f %10.1f' % (
+        size, dim, k, classes, config['ops']['query'],
+        config['ops']['centroid'], config['ops']['classify'],
+        config['ops']['count'], config['ops']['add'], config['memory_mb']))
+    sys.stdout.flush()
+  if results['skipped']:
+    print('skipped %d configurations over --max-mb' % len(results['skipped']))
+  results['fixed'] = suite_fixed(args)
+  for op, value in sorted(results['fixed'].items()):
+    print('%-26s %10.0f/s' % (op, value))
+  if args.output:
+    with open(args.output, 'w') as f: json.dump(results, f, indent=1)
+  if args.baseline:
+    with open(args.baseline) as f: baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    print('%d regressions beyond %.0f%%' % (regressions, 100*args.tolerance))
+    return 1 if regressions else 0
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  subparsers = parser.add_subparsers(dest='benchmark')
+  subparsers.required = True
+
+  store = subparsers.add_parser(
+      'store', help='Add and query cost of the kNN store by size.')
+  store.add_argument('--sizes', default='10,100,1000,10000,100000',
+                     help='Comma separated store sizes.')
+  store.add_argument('--dim', type=int, default=1024,
+                     help='Embedding dimension.')
+  store.add_argument('--classes', type=int, default=4,
+                     help='Number of classes.')
+  store.add_argument('--k', type=int, default=3, help='kNN.')
+  store.add_argument('--queries', type=int, default=100,
+                     help='Number of queries timed per size.')
+  store.add_argument('--legacy-max', type=int, default=10000,
+                     help='Largest size to also run the legacy store on.')
+  store.set_defaults(func=run_store)
+
+  ann = subparsers.add_parser(
+      'ann', help='Recall versus latency of the IVF index against exact kNN.')
+  ann.add_argument('--size', type=int, default=100000,
+                   help='Number of stored examples.')
+  ann.add_argument('--probes', default='1,2,4,8,16,32',
+                   help='Comma separated nprobe values.')
+  ann.add_argument('--list-size', type=int, default=256,
+                   help='Typical number of rows per IVF list.')
+  ann.add_argument('--dim', type=int, default=1024,
+                   help='Embedding dimension.')
+  ann.add_argument('--classes', type=int, default=100,
+                   help='Number of classes.')
+  ann.add_argument('--noise', type=float, default=2.0,
+                   help='Spread of each synthetic class around its center.')
+  ann.add_argument('--k', type=int, default=3, help='kNN.')
+  ann.add_argument('--queries', type=int, default=200,
+                   help='Number of queries timed.')
+  ann.set_defaults(func=run_ann)
+
+  comp = subparsers.add_parser(
+      'compress', help='Memory, latency and accuracy of compressed stores.')
+  comp.add_argument('--size', type=int, default=20000,
+                    help='Number of stored synthetic examples.')
+  comp.add_argument('--replay', default=None,
+                    help='.npz file of recorded embeddings and labels to '
+                    'evaluate besides the synthetic data.')
+  comp.add_argument('--projection-dim', type=int,
+                    default=compress.PROJECTION_DIM,
+                    help='Output dimension of the projections.')
+  comp.add_argument('--dim', type=int, default=1024,
+                    help='Embedding dimension.')
+  comp.add_argument('--classes', type=int, default=100,
+                    help='Number of classes.')
+  comp.add_argument('--noise', type=float, default=2.0,
+                    help='Spread of each synthetic class around its center.')
+  comp.add_argument('--k', type=int, default=3, help='kNN.')
+  comp.add_argument('--queries', type=int, default=500,
+                    help='Number of held out queries.')
+  comp.set_defaults(func=run_compress)
+
+  bound = subparsers.add_parser(
+      'bounded', help='Size, latency and accuracy of the bounded store '
+      'policies over a long stream of taught examples.')
+  bound.add_argument('--stream', type=int, default=20000,
+                     help='Number of examples taught.')
+  bound.add_argument('--capacity', type=int, default=256,
+                     help='Most examples kept in total.')
+  bound.add_argument('--class-capacity', type=int, default=None,
+                     help='Most examples kept per class.')
+  bound.add_argument('--redundancy', type=float, default=0.95,
+                     help='Similarity above which the prune policy drops '
+                     'an example.')
+  bound.add_argument('--burst', type=int, default=30,
+                     help='Examples taught per button hold.')
+  bound.add_argument('--views', type=int, default=8,
+                     help='Distinct views of each class.')
+  bound.add_argument('--dim', type=int, default=1024,
+                     help='Embedding dimension.')
+  bound.add_argument('--classes', type=int, default=16,
+                     help='Number of classes.')
+  bound.add_argument('--noise', type=float, default=2.0,
+                     help='Spread of the frames of one view.')
+  bound.add_argument('--k', type=int, default=3, help='kNN.')
+  bound.add_argument('--queries', type=int, default=500,
+                     help='Number of held out queries.')
+  bound.set_defaults(func=run_bounded)
+
+  labels = subparsers.add_parser(
+      'labels', help='Memory, latency and accuracy with thousands of named '
+      'classes.')
+  labels.add_argument('--classes', default='1000,2000,5000',
+                      help='Comma separated numbers of classes.')
+  labels.add_argument('--per-class', type=int, default=2,
+                      help='Mean number of examples per class; many classes '
+                      'get fewer than k.')
+  labels.add_argument('--dim', type=int, default=1024,
+                      help='Embedding dimension.')
+  labels.add_argument('--noise', type=float, default=1.0,
+                      help='Spread of each synthetic class around its center.')
+  labels.add_argument('--k', type=int, default=3, help='kNN.')
+  labels.add_argument('--queries', type=int, default=512,
+                      help='Number of held out queries.')
+  labels.add_argument('--batch', type=int, default=32,
+                      help='Queries searched together by queryBatch.')
+  labels.set_defaults(func=run_labels)
+
+  suite = subparsers.add_parser(
+      'suite', help='Ops/sec and memory of the engine operations over a grid '
+      'of configurations, with a stubbed model, compared to a baseline.')
+  suite.add_argument('--sizes', default='10,100,1000,10000,100000,1000000',
+                     help='Comma separated store sizes.')
+  suite.add_argument('--dims', default='1024,128',
+                     help='Comma separated embedding dimensions.')
+  suite.add_argument('--ks', default='1,3,10',
+                     help='Comma separated kNN values.')
+  suite.add_argument('--classes', default='4,100',
+                     help='Comma separated numbers of classes.')
+  suite.add_argument('--queries', type=int, default=20,
+                     help='Distinct queries (and added examples) per round.')
+  suite.add_argument('--min-time', type=float, default=0.2,
+                     help='Seconds each operation is timed for at least.')
+  suite.add_argument('--max-mb', type=float, default=1024,
+                     help='Skip configurations whose rows take more memory.')
+  suite.add_argument('--output', default=None,
+                     help='Write the results to this JSON file.')
+  suite.add_argument('--baseline', default=None,
+                     help='JSON results of an earlier run to compare with; '
+                     'exits with status 1 on regressions.')
+  suite.add_argument('--tolerance', type=float, default=0.2,
+                     help='Fraction by which ops/sec may drop, or memory '
+                     'grow, before it counts as a regression.')
+  suite.set_defaults(func=run_suite)
+
+  args = parser.parse_args(argv[1:])
+  return args.func(args)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,170 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keeps the kNN store within a fixed number of examples.
+
+Holding a button adds an example per frame, nearly all of them duplicates,
+and an unattended machine keeps adding for days. A BoundedStore caps the
+examples per class and in total, so memory and the per-frame search stay
+flat, and a policy decides what stays:
+
+  reservoir  A uniform random sample of everything taught to a class
+             (reservoir sampling), so old and new examples are equally
+             likely to stay.
+  prune      Examples more similar than a threshold to one already stored
+             are dropped; when full, the most redundant example goes.
+  kmeans     Examples are condensed into prototypes: when full, the two
+             closest prototypes of the class are merged into their mean,
+             weighted by how many examples each stands for (online k-means).
+
+Over the total capacity, the class with the most examples gives one up. No
+class gives up its last example: with as many classes as the capacity, a new
+class is dropped instead.
+"""
+
+import numpy as np
+
+POLICIES = ('reservoir', 'prune', 'kmeans')
+
+
+class BoundedStore(object):
+  """Wraps an EmbeddingStore to cap its number of examples.
+
+     Offers the add/query/queryBatch/neighbors/clear interface of
+     EmbeddingStore. The store must not have an index, whose rows cannot be
+     replaced or removed.
+  """
+
+  def __init__(self, store, policy='reservoir', class_capacity=None,
+               capacity=None, redundancy=0.95, seed=0):
+    """Args:
+      store: An empty EmbeddingStore to wrap.
+      policy: String, one of POLICIES.
+      class_capacity: Int, most examples kept per class, or None.
+      capacity: Int, most examples kept in total, or None.
+      redundancy: Float, cosine similarity above which the prune policy
+        drops a new example.
+      seed: Int, seed of the reservoir sampling.
+    """
+    if policy not in POLICIES:
+      raise ValueError('Unknown store policy %s' % policy)
+    self._store = store
+    self._policy = policy
+    self._class_capacity = class_capacity
+    self._capacity = capacity
+    self._redundancy = redundancy
+    self._rng = np.random.RandomState(seed)
+    self.clear()
+
+  def clear(self):
+    """Forgets all stored embeddings."""
+    self._store.clear()
+    # Examples taught per label, for the reservoir sampling.
+    self._seen = {}
+    # Number of examples each row stands for, for the k-means merges.
+    self._mass = []
+    self._counts = {'added': 0, 'replaced': 0, 'dropped': 0, 'evicted': 0,
+                    'merged': 0}
+
+  def add(self, emb, label):
+    """Adds an example, or not, as the policy decides."""
+    self._seen[label] = self._seen.get(label, 0) + 1
+    rows = self._store.rows(label)
+    full = (self._class_capacity is not None and
+            len(rows) >= self._class_capacity)
+    if not len(rows) and (full or self._noSpare()):
+      # Making room would take the only example of a class, this one's or
+      # another's, so the new class is not taught.
+      self._counts['dropped'] += 1
+      return
+    if self._policy == 'prune' and len(rows):
+      sims = np.dot(self._store.vectors(rows), self._store.prepare(emb))
+      if sims.max() > self._redundancy:
+        self._counts['dropped'] += 1
+        return
+    if self._policy == 'reservoir' and full:
+      # Keep each of the examples seen so far with equal probability.
+      slot = self._rng.randint(self._seen[label])
+      if slot < len(rows):
+        self._store.replace(rows[slot], self._store.prepare(emb))
+        self._counts['replaced'] += 1
+      else:
+        self._counts['dropped'] += 1
+      return
+
+    self._store.add(emb, label)
+    self._mass.append(1)
+    self._counts['added'] += 1
+    if full: self._shrink(label)
+    if self._capacity is not None and len(self._store) > self._capacity:
+      self._shrink(int(np.argmax(np.bincount(self._store.labels()))))
+
+  def _noSpare(self):
+    """Whether the store is at capacity with one example per class."""
+    return (self._capacity is not None and
+            len(self._store) >= self._capacity and
+            not (np.bincount(self._store.labels()) > 1).any())
+
+  def _shrink(self, label):
+    """Takes one example of a class out of the store."""
+    rows = self._store.rows(label)
+    if self._policy == 'reservoir':
+      self._remove(rows[self._rng.randint(len(rows))])
+      self._counts['evicted'] += 1
+      return
+    vectors = self._store.vectors(rows)
+    sims = np.dot(vectors, vectors.T)
+    np.fill_diagonal(sims, -np.inf)
+    if self._policy == 'prune':
+      # The example closest to another one.
+      self._remove(rows[int(np.argmax(sims.max(axis=1)))])
+      self._counts['evicted'] += 1
+      return
+    i, j = np.unravel_index(np.argmax(sims), sims.shape)
+    mass_i, mass_j = self._mass[rows[i]], self._mass[rows[j]]
+    merged = mass_i*vectors[i] + mass_j*vectors[j]
+    self._store.replace(rows[i], merged/np.sqrt((merged**2).sum()))
+    self._mass[rows[i]] = mass_i + mass_j
+    self._remove(rows[j])
+    self._counts['merged'] += 1
+
+  def _remove(self, row):
+    moved = self._store.remove(row)
+    if moved is not None: self._mass[row] = self._mass[moved]
+    self._mass.pop()
+
+  def stats(self):
+    """Returns the counters of what the policy did with the examples."""
+    return dict(self._counts)
+
+  def query(self, query_emb):
+    return self._store.query(query_emb)
+
+  def queryBatch(self, query_embs):
+    return self._store.queryBatch(query_embs)
+
+  def neighbors(self, query_emb, count):
+    return self._store.neighbors(query_emb, count)
+
+  def embeddings(self):
+    return self._store.embeddings()
+
+  def labels(self):
+    return self._store.labels()
+
+  def nbytes(self):
+    return self._store.nbytes()
+
+  def __len__(self):
+    return len(self._store)
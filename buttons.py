@@ -0,0 +1,225 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Event driven button input.
+
+Buttons used to be read once per video frame, so how quickly a press was
+seen, and how well it was debounced, depended on the inference speed. Here
+the buttons are watched off the frame path instead, by one of:
+
+  RpiGpioInput     RPi.GPIO edge detection callbacks.
+  PeripheryInput   A thread waiting for periphery GPIO edge events.
+  PollingInput     A thread reading the buttons every few milliseconds,
+                   for pins without edge detection.
+  KeyboardInput    A thread reading keyinput's characters.
+  SimulatedGpio    Edges fed in by hand with explicit timestamps.
+
+Each reports edges to a ButtonEvents, which debounces them by their
+timestamps and queues the presses. The frame thread calls drain() once per
+frame, which costs a single check of an empty queue when nothing happened.
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+
+
+class ButtonEvents(object):
+  """Debounces button edges and queues the presses.
+
+     A rising edge is a press unless the button changed less than
+     debounce_interval before, which drops contact bounce and key repeat.
+     Edges of a button must come from one thread at a time; presses are
+     passed to the frame thread in a deque, whose append and popleft are
+     atomic, so neither side takes a lock.
+  """
+
+  def __init__(self, count, debounce_interval=0.1):
+    self._count = count
+    self._debounce_interval = debounce_interval
+    self._pressed = [False]*count
+    self._last_change = [float('-inf')]*count
+    self._queue = deque()
+
+  def edge(self, index, pressed, timestamp=None):
+    """Reports a button edge.
+
+    Args:
+      index: Int, the button.
+      pressed: Bool, the new state of the button.
+      timestamp: Float, seconds (any clock, consistently per button) of the
+        edge; by default now.
+    """
+    t = time.monotonic() if timestamp is None else timestamp
+    if (pressed and not self._pressed[index] and
+        t - self._last_change[index] > self._debounce_interval):
+      self._queue.append(index)
+    self._pressed[index] = pressed
+    self._last_change[index] = t
+
+  def press(self, index, timestamp=None):
+    """Reports a press and release at once, for inputs without releases."""
+    self.edge(index, True, timestamp)
+    self.edge(index, False, timestamp)
+
+  def drain(self):
+    """Returns which buttons were pressed since the last drain, as a list."""
+    state = [False]*self._count
+    queue = self._queue
+    while queue: state[queue.popleft()] = True
+    return state
+
+
+class RpiGpioInput(object):
+  """Feeds RPi.GPIO edge detection callbacks to a ButtonEvents."""
+
+  def __init__(self, events, pins):
+    import RPi.GPIO as rpigpio
+    self._rpigpio = rpigpio
+    self._events = events
+    self._index = dict((pin, index) for index, pin in enumerate(pins))
+    for pin in pins:
+      rpigpio.add_event_detect(pin, rpigpio.BOTH, callback=self._edge)
+
+  def _edge(self, pin):
+    # Called on RPi.GPIO's thread; the level tells which edge it was.
+    self._events.edge(self._index[pin], bool(self._rpigpio.input(pin)))
+
+  def close(self):
+    for pin in self._index: self._rpigpio.remove_event_detect(pin)
+
+
+class _InputThread(object):
+  """Base for inputs watched by a thread of their own."""
+
+  def __init__(self, events):
+    self._events = events
+    self._running = True
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    raise NotImplementedError()
+
+  def close(self):
+    self._running = False
+    self._thread.join(1.0)
+
+
+class PollingInput(_InputThread):
+  """Reads the buttons every interval seconds and reports their changes.
+
+     read() returns the state of all buttons as a list of bools.
+  """
+
+  def __init__(self, events, read, interval=0.005):
+    self._read = read
+    self._interval = interval
+    _InputThread.__init__(self, events)
+
+  def _run(self):
+    # Buttons held at startup are not presses.
+    state = [bool(b) for b in self._read()]
+    while self._running:
+      time.sleep(self._interval)
+      new = [bool(b) for b in self._read()]
+      t = time.monotonic()
+      for i, pressed in enumerate(new):
+        if pressed != state[i]: self._events.edge(i, pressed, t)
+      state = new
+
+
+class PeripheryInput(_InputThread):
+  """Waits for edge events of periphery GPIOs on a thread.
+
+     Needs periphery 2.1 or later and pins with edge support; raises
+     GPIOError otherwise, see PollingInput for those.
+  """
+
+  def __init__(self, events, gpios, timeout=0.5):
+    from periphery import GPIO
+    self._poll_multiple = GPIO.poll_multiple
+    self._gpios = list(gpios)
+    self._index = dict((id(gpio), i) for i, gpio in enumerate(self._gpios))
+    self._timeout = timeout
+    for gpio in self._gpios: gpio.edge = 'both'
+    _InputThread.__init__(self, events)
+
+  def _run(self):
+    while self._running:
+      for gpio in self._poll_multiple(self._gpios, self._timeout):
+        event = gpio.read_event()
+        self._events.edge(self._index[id(gpio)], event.edge == 'rising',
+                          event.timestamp/1e9)
+
+
+class KeyboardInput(_InputThread):
+  """Turns characters read by keyinput into presses of the buttons bound
+     to them."""
+
+  def __init__(self, events, keys):
+    import keyinput
+    self._queue = keyinput.char_queue
+    self._index = dict((key, index) for index, key in enumerate(keys))
+    _InputThread.__init__(self, events)
+
+  def _run(self):
+    while self._running:
+      try:
+        char = self._queue.get(timeout=0.5)
+      except queue.Empty:
+        continue
+      if char in self._index: self._events.press(self._index[char])
+
+
+class SimulatedGpio(object):
+  """Buttons driven by hand, for tests and replays.
+
+     Behaves like an edge detecting GPIO backend: level changes become
+     edges of the ButtonEvents, at the given (simulated) timestamps.
+  """
+
+  def __init__(self, events, count):
+    self._events = events
+    self._levels = [False]*count
+
+  def set(self, index, level, timestamp=None):
+    """Sets a button's level; reports an edge if it changed."""
+    if level == self._levels[index]: return
+    self._levels[index] = level
+    self._events.edge(index, level, timestamp)
+
+  def press(self, index, timestamp, hold=0.05, bounces=0, bounce=0.002):
+    """Presses and releases a button, with contact bounce on both edges.
+
+    Args:
+      index: Int, the button.
+      timestamp: Float, seconds, when the button goes down.
+      hold: Float, seconds it stays down.
+      bounces: Int, extra open/close pairs after each edge.
+      bounce: Float, seconds between bounce edges.
+    """
+    for level, t in ((True, timestamp), (False, timestamp + hold)):
+      self.set(index, level, t)
+      for i in range(bounces):
+        self.set(index, not level, t + (2*i + 1)*bounce)
+        self.set(index, level, t + (2*i + 2)*bounce)
+
+  def getButtonState(self):
+    return list(self._levels)
+
+  def close(self):
+    pass
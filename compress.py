@@ -0,0 +1,106 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact encodings and projections for stored embeddings."""
+import numpy as np
+
+DTYPES = ('float32', 'float16', 'int8')
+PROJECTIONS = ('pca',)
+# Dimensions embeddings are projected to by default.
+PROJECTION_DIM = 128
+
+# Rows decoded to float32 at a time when scoring a compressed matrix. Keeps
+# the temporary small instead of upcasting the whole store per query.
+_CHUNK_ROWS = 4096
+
+
+def encode(vectors, dtype, out, scales=None):
+  """Encodes float32 rows into a storage matrix.
+
+  Args:
+    vectors: float32 array of shape [rows, dim].
+    dtype: One of DTYPES.
+    out: Storage array of shape [rows, dim] to write the codes into.
+    scales: For int8, float32 array of shape [rows] receiving the per-row
+      scale; ignored otherwise.
+  """
+  if dtype == 'int8':
+    scale = np.abs(vectors).max(axis=1)/127.0
+    scale[scale == 0] = 1.0
+    out[...] = np.rint(vectors/scale[:, np.newaxis])
+    scales[...] = scale
+  else:
+    out[...] = vectors
+
+
+def decode(codes, dtype, scales=None):
+  """Returns float32 rows from a storage matrix."""
+  vectors = codes.astype(np.float32)
+  if dtype == 'int8': vectors *= scales[:, np.newaxis]
+  return vectors
+
+
+def similarities(codes, dtype, query, scales=None):
+  """Returns the dot product of every stored row with a float32 query.
+
+  The query may also be a [dim, queries] matrix, giving [rows, queries].
+  """
+  if dtype == 'float32': return np.dot(codes, query)
+  sims = np.empty(codes.shape[:1] + query.shape[1:], dtype=np.float32)
+  # One buffer for all the chunks, rather than a new array per chunk.
+  scratch = np.empty((min(_CHUNK_ROWS, codes.shape[0]),) + codes.shape[1:],
+                     dtype=np.float32)
+  for start in range(0, codes.shape[0], _CHUNK_ROWS):
+    end = min(start + _CHUNK_ROWS, codes.shape[0])
+    block = scratch[:end - start]
+    np.copyto(block, codes[start:end], casting='unsafe')
+    np.dot(block, query, out=sims[start:end])
+  if dtype == 'int8':
+    sims *= scales.reshape(scales.shape + (1,)*(query.ndim - 1))
+  return sims
+
+
+class PCAProjection(object):
+  """Projection onto the top principal directions of the stored examples.
+
+     The store keeps full-size rows until fit_size examples were added, then
+     fits the projection on them and re-encodes the store. Vectors are
+     centered before projecting: the mean direction shared by all MobileNet
+     embeddings carries no class information and would otherwise dominate
+     both the principal directions and the cosine similarities.
+  """
+
+  def __init__(self, dim, fit_size=None):
+    self.dim = dim
+    self.fit_size = fit_size or 4*dim
+    self._mean = None
+    self._matrix = None
+
+  def fitted(self):
+    return self._matrix is not None
+
+  def fit(self, vectors):
+    self._mean = vectors.mean(axis=0)
+    _, _, vt = np.linalg.svd(vectors - self._mean, full_matrices=False)
+    self._matrix = np.ascontiguousarray(vt[:self.dim].T, dtype=np.float32)
+
+  def transform(self, vectors):
+    return np.dot(vectors - self._mean, self._matrix)
+
+
+def makeProjection(name, dim):
+  """Returns a projection by name ('pca' or 'none')."""
+  if name == 'pca': return PCAProjection(dim)
+  if name in (None, 'none'): return None
+  raise ValueError('Unknown projection %s' % name)
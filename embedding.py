@@ -13,53 +13,83 @@
 # limitations under the License.
 
 """Detection Engine used for detection tasks."""
-from collections import Counter
-from collections import defaultdict
-from edgetpu.basic.basic_engine import BasicEngine
+import os
+
+from backends import makeBackend
+from bounded import BoundedStore
+from compress import PROJECTION_DIM, makeProjection
+from frames import inputTensor
+from ivf import IVFIndex
+from labels import LabelRegistry
+import metrics
 import numpy as np
-from PIL import Image
+from persist import PersistentStore
+from shared import SharedStore
+from store import EmbeddingStore
 
 
-class EmbeddingEngine(BasicEngine):
+class EmbeddingEngine(object):
   """Engine used to obtain embeddings from headless mobilenets."""
 
-  def __init__(self, model_path):
+  def __init__(self, model_path, device_path=None, backend='edgetpu'):
     """Creates a EmbeddingEngine with given model and labels.
 
     Args:
       model_path: String, path to TF-Lite Flatbuffer file.
+      device_path: String, Edge TPU to run on (see backends.edgeTpuPaths),
+        or None for any.
+      backend: String, one of backends.BACKENDS, or a backend object.
 
     Raises:
       ValueError: An error occurred when model output is invalid.
+      RuntimeError: when model's input tensor format is invalid.
     """
-    BasicEngine.__init__(self, model_path)
-    output_tensors_sizes = self.get_all_output_tensors_sizes()
-    if output_tensors_sizes.size != 1:
-      raise ValueError(
-          ('Dectection model should have only 1 output tensor!'
-           'This model has {}.'.format(output_tensors_sizes.size)))
+    if isinstance(backend, str):
+      backend = makeBackend(backend, model_path, device_path)
+    self._backend = backend
+    input_tensor_shape = backend.inputShape()
+    if (len(input_tensor_shape) != 4 or input_tensor_shape[3] != 3 or
+        input_tensor_shape[0] != 1):
+      raise RuntimeError(
+          'Invalid input tensor shape! Expected: [1, height, width, 3]')
+    self._required_image_size = (input_tensor_shape[2], input_tensor_shape[1])
+
+  def requiredImageSize(self):
+    """Returns the (width, height) of images the model takes."""
+    return self._required_image_size
+
+  def embeddingSize(self):
+    """Returns the length of the embedding vectors."""
+    return self._backend.outputSize()
 
   def DetectWithImage(self, img):
     """Calculates embedding from an image.
 
     Args:
-      img: PIL image object.
+      img: PIL image object, or HxWx3 uint8 array. An array that already has
+        the model's input size is passed to the model without copies.
 
     Returns:
       Embedding vector as np.float32
+    """
+    start = metrics.start()
+    input_tensor = inputTensor(img, self._required_image_size)
+    metrics.record('resize', start)
+    start = metrics.start()
+    emb = self._backend.run(input_tensor)
+    metrics.record('inference', start)
+    return emb
 
-    Raises:
-      RuntimeError: when model's input tensor format is invalid.
+  def DetectWithImages(self, imgs):
+    """Calculates the embeddings of several images.
+
+    Backends run one input tensor at a time, so this only saves the
+    per-call overhead of the callers; see multistream.py.
+
+    Returns:
+      List of embedding vectors as np.float32
     """
-    input_tensor_shape = self.get_input_tensor_shape()
-    if (input_tensor_shape.size != 4 or input_tensor_shape[3] != 3 or
-        input_tensor_shape[0] != 1):
-      raise RuntimeError(
-          'Invalid input tensor shape! Expected: [1, height, width, 3]')
-    required_image_size = (input_tensor_shape[2], input_tensor_shape[1])
-    with img.resize(required_image_size, Image.NEAREST) as resized_img:
-      input_tensor = np.asarray(resized_img).flatten()
-      return self.RunInference(input_tensor)[1]
+    return [self.DetectWithImage(img) for img in imgs]
 
 
 class KNNEmbeddingEngine(EmbeddingEngine):
@@ -69,76 +99,343 @@ class KNNEmbeddingEngine(EmbeddingEngine):
      functions to find k nearest neighbors against a query emedding.
   """
 
-  def __init__(self, model_path, kNN=3):
+  def __init__(self, model_path, kNN=3, nprobe=None, dtype='float32',
+               projection=None, projection_dim=PROJECTION_DIM, store_path=None,
+               backend='edgetpu', device_path=None, capacity=None,
+               class_capacity=None, policy='reservoir', shared_path=None,
+               shared_reader=False):
     """Creates a EmbeddingEngine with given model and labels.
 
     Args:
       model_path: String, path to TF-Lite Flatbuffer file.
+      kNN: Int, number of neighbors that vote on a classification.
+      nprobe: Int, if set, search an approximate IVF index scanning this many
+        lists per query instead of the whole store.
+      dtype: String, storage type of the embeddings: float32, float16 or int8.
+      projection: String, 'pca' to reduce embeddings to
+        projection_dim dimensions before storing them, or None.
+      projection_dim: Int, output dimension of the projection.
+      store_path: String, if set, directory in which the store is kept
+        across restarts (see persist.py).
+      backend: String, inference backend, see EmbeddingEngine.
+      device_path: String, Edge TPU to run on, see EmbeddingEngine.
+      capacity: Int, if set, most examples kept in total (see bounded.py).
+      class_capacity: Int, if set, most examples kept per class.
+      policy: String, what a bounded store keeps, one of bounded.POLICIES.
+      shared_path: String, if set, file holding examples shared with other
+        processes of the host (see shared.py).
+      shared_reader: Bool, whether this process only reads the shared
+        examples, which another process teaches.
 
     Raises:
-      ValueError: An error occurred when model output is invalid.
+      ValueError: An error occurred when model output is invalid, or a
+        bounded store was asked to be indexed or persisted, or a shared
+        store to be any of these.
     """
-    EmbeddingEngine.__init__(self, model_path)
-    self.clear()
+    EmbeddingEngine.__init__(self, model_path, device_path, backend)
     self._kNN = kNN
+    # Names of the classes, kept with the examples they name.
+    if store_path: labels_path = os.path.join(store_path, 'labels.json')
+    elif shared_path: labels_path = shared_path + '.labels.json'
+    else: labels_path = None
+    self._labels = LabelRegistry(labels_path)
+    # Per class sums and normalized means of the examples, for
+    # centroidEmbedding(), and the _storeKey() they are up to date with.
+    self._class_rows = {}
+    self._class_labels = []
+    self._sums = self._means = None
+    self._means_key = None
+    if shared_path:
+      # The rows are written once into the file and never change, and each
+      # process would fit its own projection.
+      if nprobe or projection or store_path or capacity or class_capacity:
+        raise ValueError('Shared stores cannot be indexed, projected, '
+                         'persisted or bounded.')
+      self._store = SharedStore(shared_path, kNN, dtype,
+                                writer=not shared_reader)
+      return
+    index = IVFIndex(nprobe) if nprobe else None
+    self._store = EmbeddingStore(
+        kNN, index=index, dtype=dtype,
+        projection=makeProjection(projection, projection_dim))
+    if capacity or class_capacity:
+      # Evictions rewrite rows, which neither the index nor the journal of
+      # a persistent store can follow.
+      if nprobe or store_path:
+        raise ValueError('Bounded stores cannot be indexed or persisted.')
+      self._store = BoundedStore(self._store, policy, class_capacity,
+                                 capacity)
+    if store_path: self._store = PersistentStore(store_path, self._store)
 
   def clear(self):
-    """Clear the store: forgets all stored embeddings."""
-    self._labels = []
-    self._embedding_map = defaultdict(list)
-    self._embeddings = None
+    """Clear the store: forgets all stored embeddings (also on disk)."""
+    self._store.clear()
+    self._means_key = None
 
   def addEmbedding(self, emb, label):
-    """Add an embedding vector to the store."""
+    """Add an embedding vector to the store, under a class id or name."""
+    label = self._labels.id(label)
+    key = self._storeKey()
+    self._store.add(emb, label)
+    if key == self._means_key and len(self._store) == key[0] + 1:
+      # Nothing was evicted, the class means take the example as it is.
+      self._addToMeans(np.asarray(emb, dtype=np.float32).ravel(), label)
+      self._means_key = self._storeKey()
+    else:
+      self._means_key = None
+
+  def _storeKey(self):
+    """Returns what tells whether the store changed since the class means
+    were computed, besides addEmbedding() and clear()."""
+    generation = (self._store.generation()
+                  if hasattr(self._store, 'generation') else None)
+    return len(self._store), generation
+
+  def _addToMeans(self, emb, label):
+    if self._sums is None or self._sums.shape[1] != emb.size: return
+    row = self._class_rows.get(label)
+    if row is None:
+      row = self._class_rows[label] = len(self._class_labels)
+      self._class_labels.append(label)
+      self._sums = np.vstack([self._sums, np.zeros_like(emb)])
+      self._means = np.vstack([self._means, np.zeros_like(emb)])
+    total = self._sums[row]
+    total += emb/np.sqrt((emb**2).sum())
+    self._means[row] = total/np.sqrt((total**2).sum())
+
+  def _computeMeans(self):
+    labels = np.asarray(self._store.labels())
+    embeddings = self._store.embeddings()
+    classes, index = np.unique(labels, return_inverse=True)
+    order = np.argsort(index, kind='stable')
+    bounds = np.searchsorted(index[order], np.arange(len(classes) + 1))
+    dim = embeddings.shape[1] if len(embeddings) else self.embeddingSize()
+    self._sums = np.zeros((len(classes), dim), dtype=np.float32)
+    # Summed one class at a time, over rows made contiguous.
+    for row, (begin, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+      self._sums[row] = embeddings[order[begin:end]].sum(axis=0)
+    self._means = self._sums/np.sqrt(
+        (self._sums**2).sum(axis=1, keepdims=True))
+    self._class_labels = [int(label) for label in classes]
+    self._class_rows = dict((label, row)
+                            for row, label in enumerate(self._class_labels))
 
-    normal = emb/np.sqrt((emb**2).sum()) # Normalize the vector
+  def kNNEmbedding(self, query_emb):
+    """Returns the most common label among the self._kNN nearest neighbors."""
+    start = metrics.start()
+    label = self._store.query(query_emb)
+    metrics.record('knn', start)
+    return label
+
+  def centroidEmbedding(self, query_emb):
+    """Returns the label whose examples' mean is closest to an embedding.
+
+    A cheaper approximation of kNNEmbedding() on large stores, comparing
+    against one mean per class rather than every example, i.e. imprinting
+    on the stored examples. Examples taught here update the means in
+    O(dim); they are recomputed from the store when it changed otherwise.
+    Projected stores, whose rows do not compare to query_emb, are searched
+    with kNNEmbedding().
+    """
+    start = metrics.start()
+    key = self._storeKey()
+    if key != self._means_key:
+      self._computeMeans()
+      self._means_key = key
+    if not self._class_labels: return None
+    if self._means.shape[1] != np.size(query_emb):
+      return self.kNNEmbedding(query_emb)
+    label = self._class_labels[
+        int(np.argmax(np.dot(self._means, np.ravel(query_emb))))]
+    metrics.record('centroid', start)
+    return label
+
+  def classifyImage(self, img):
+    """Returns the embedding of an image and its kNNEmbedding() label."""
+    emb = self.DetectWithImage(img)
+    return emb, self.kNNEmbedding(emb)
+
+  def kNNEmbeddings(self, query_embs):
+    """Returns kNNEmbedding() of several embeddings, searching them together."""
+    start = metrics.start()
+    labels = self._store.queryBatch(query_embs)
+    metrics.record('knn_batch', start)
+    return labels
 
-    self._embedding_map[label].append(normal) # Add to store, under "label"
+  def exampleCount(self):
+    """Just returns the size of the embedding store."""
+    return len(self._store)
 
-    # Expand labelled blocks of embeddings for when we have less than kNN
-    # examples. Otherwise blocks that have more examples unfairly win.
-    emb_blocks = []
-    self._labels = [] # We'll be reconstructing the list of labels
-    for label, embeds in self._embedding_map.items():
-      emb_block = np.stack(embeds)
-      if emb_block.shape[0] < self._kNN:
-          emb_block = np.pad(emb_block,
-                             [(0,self._kNN - emb_block.shape[0]), (0,0)],
-                             mode="reflect")
-      emb_blocks.append(emb_block)
-      self._labels.extend([label]*emb_block.shape[0])
+  def loadEmbeddings(self, embeddings, labels):
+    """Replaces the examples with rows embedded ahead of time, at once.
 
-    self._embeddings = np.concatenate(emb_blocks, axis=0)
+    Args:
+      embeddings: Array of normalized rows, shape [rows, dim], used in place
+        (see EmbeddingStore.load).
+      labels: Integer class ids of the rows.
 
-  def kNNEmbedding(self, query_emb):
-    """Returns the self._kNN nearest neighbors to a query embedding."""
+    Raises:
+      ValueError: The store is persisted, bounded or shared, which keep
+        their rows their own way.
+    """
+    if not isinstance(self._store, EmbeddingStore):
+      raise ValueError('Only in-memory stores can be loaded in bulk.')
+    self._store.load(embeddings, labels)
+    self._means_key = None
 
-    # If we have nothing stored, the answer is None
-    if self._embeddings is None: return None
+  def nbytes(self):
+    """Returns the bytes the stored examples take in memory."""
+    return self._store.nbytes()
 
-    # Normalize query embedding
-    query_emb = query_emb/np.sqrt((query_emb**2).sum())
+  def labelRegistry(self):
+    """Returns the labels.LabelRegistry naming the classes."""
+    return self._labels
 
-    # We want a cosine distance ifrom query to each stored embedding. A matrix
-    # multiplication can do this in one step, resulting in a vector of
-    # distances.
-    dists = np.matmul(self._embeddings, query_emb)
 
-    # If we have less than self._kNN distances we can only return that many.
-    kNN = min(len(dists), self._kNN)
+# Edge TPU model whose last layer the imprinting API retrains, see
+# run_imprinting.sh.
+IMPRINTING_MODEL = 'models/mobilenet_v1_1.0_224_l2norm_quant_edgetpu.tflite'
 
-    # Get the N largest cosine similarities (larger means closer).
-    n_argmax = np.argpartition(dists, -kNN)[-kNN:]
 
-    # Get the corresponding labels associated with each distance.
-    labels = [self._labels[i] for i in n_argmax]
+class ImprintingEmbeddingEngine(EmbeddingEngine):
+  """Imprinting computed in NumPy on the embeddings of a headless model.
+
+     Imprinting gives each class the normalized mean of the normalized
+     embeddings of its examples as weights, and classifies by the largest
+     dot product with them. DemoImprintingEngine has the Edge TPU API
+     retrain a model for that, from every image kept so far; here the
+     weights are a [classes, dim] matrix updated in place, one O(dim) row
+     update per example, and a frame is embedded once and classified with
+     one small matrix-vector product.
+
+     A .tflite model is only written by export(), through the same
+     ImprintingEngine.SaveModel path, which trains from images: they are
+     only kept if export_path is given.
+  """
 
-    # Return the most common label over all self._kNN nearest neighbors.
-    most_common_label = Counter(labels).most_common(1)[0][0]
-    return most_common_label
+  def __init__(self, model_path, device_path=None, backend='edgetpu',
+               export_path=None, export_model=IMPRINTING_MODEL,
+               keep_classes=False):
+    """Creates an ImprintingEmbeddingEngine.
+
+    Args:
+      model_path: String, path to a headless TF-Lite model.
+      device_path: String, Edge TPU to run on, see EmbeddingEngine.
+      backend: String, inference backend, see EmbeddingEngine.
+      export_path: String, if set, .tflite file close() exports to; the
+        taught images are kept for that.
+      export_model: String, the imprinting model export() retrains.
+      keep_classes: Bool, whether the exported model keeps the classes of
+        export_model.
+    """
+    EmbeddingEngine.__init__(self, model_path, device_path, backend)
+    self._export_path = export_path
+    self._export_model = export_model
+    self._keep_classes = keep_classes
+    self.clear()
+
+  def clear(self):
+    """Forgets all classes."""
+    dim = self.embeddingSize()
+    # Row i holds the class self._classes[i]: the sum of its normalized
+    # examples and, normalized, its weights.
+    self._sums = np.zeros((0, dim), dtype=np.float32)
+    self._weights = np.zeros((0, dim), dtype=np.float32)
+    self._classes = []
+    self._rows = {}
+    self._images = {}
+    self._example_count = 0
+
+  def addEmbedding(self, emb, label, img=None):
+    """Trains a class with the embedding of an example.
+
+    Args:
+      emb: Embedding vector of the example.
+      label: Int, the class.
+      img: The example's image, kept for export() if there is an
+        export_path.
+    """
+    emb = np.asarray(emb, dtype=np.float32).ravel()
+    row = self._rows.get(label)
+    if row is None:
+      row = self._rows[label] = len(self._classes)
+      self._classes.append(label)
+      self._sums = np.vstack([self._sums, np.zeros_like(emb)])
+      self._weights = np.vstack([self._weights, np.zeros_like(emb)])
+    total = self._sums[row]
+    total += emb/np.sqrt((emb**2).sum())
+    self._weights[row] = total/np.sqrt((total**2).sum())
+    self._example_count += 1
+    if self._export_path and img is not None:
+      # Copy: img may be a view of a pipeline buffer about to be reused.
+      self._images.setdefault(label, []).append(np.array(
+          inputTensor(img, self._required_image_size)))
+
+  def addImage(self, img, label):
+    """Trains a class with an image."""
+    self.addEmbedding(self.DetectWithImage(img), label, img)
+
+  def classifyEmbedding(self, emb):
+    """Returns the class of an embedding, None before any is taught."""
+    if not self._classes: return None
+    start = metrics.start()
+    # The query's norm does not change which weights it is closest to.
+    label = self._classes[int(np.argmax(np.dot(self._weights, emb)))]
+    metrics.record('imprinting_matmul', start)
+    return label
+
+  def classifyImage(self, img):
+    """Returns the embedding of an image and its class."""
+    emb = self.DetectWithImage(img)
+    return emb, self.classifyEmbedding(emb)
+
+  def classify(self, img):
+    """Returns the class of an image, like DemoImprintingEngine.classify."""
+    return self.classifyImage(img)[1]
 
   def exampleCount(self):
-    """Just returns the size of the embedding store."""
-    return sum(len(v) for v in self._embedding_map.values())
+    return self._example_count
 
+  def weights(self):
+    """Returns the class labels and their [classes, dim] weights."""
+    return list(self._classes), self._weights.copy()
 
+  def export(self, output_path=None):
+    """Writes the classes as a .tflite model with the Edge TPU imprinting
+    API, retraining export_model from the kept images.
+
+    Returns:
+      Dict mapping the outputs of the written model to class labels. Classes
+      with kept images get consecutive outputs, after the classes of
+      export_model if keep_classes is set, since ImprintingEngine only trains
+      an existing output or the next one.
+
+    Raises:
+      ValueError: The engine keeps no images (no export_path).
+    """
+    output_path = output_path or self._export_path
+    if not self._export_path:
+      raise ValueError('Exporting needs the images kept with export_path.')
+    from edgetpu.learn.imprinting.engine import ImprintingEngine
+    import modelinfo
+    engine = ImprintingEngine(self._export_model,
+                              keep_classes=self._keep_classes)
+    size = modelinfo.imageSize(self._export_model)
+    width, height = self._required_image_size
+    base = modelinfo.classCount(self._export_model) if self._keep_classes else 0
+    outputs = {}
+    for label in self._classes:
+      tensors = [inputTensor(img.reshape(height, width, 3), size)
+                 for img in self._images.get(label, [])]
+      if not tensors: continue
+      output = base + len(outputs)
+      engine.Train(np.array(tensors), output)
+      outputs[output] = label
+    tmp = output_path + '.tmp'
+    engine.SaveModel(tmp)
+    os.rename(tmp, output_path)
+    return outputs
+
+  def close(self):
+    """Exports the model if there is an export_path."""
+    if self._export_path and self._classes: self.export()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Enrolls folders of labeled images into a kNN store.
+
+Every image below DATASET/<label>/ becomes an example of that label.
+Folders 1 to 4 teach the buttons' classes; other names get the next free
+class ids (see labels.py), recorded in labels.json in the store. Images
+are decoded and resized in worker processes, embedded in batches, and
+written to a store directory (see persist.py) that teachable.py loads with
+--store:
+
+  python3 enroll.py DATASET ~/teachable-store
+  python3 teachable.py --keyboard --store ~/teachable-store
+
+An interrupted run picks up where it stopped when run again: enrolled.txt
+in the store lists each image done, written just before its example, and
+on resume the entries whose examples did not reach the store are redone.
+"""
+
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+from embedding import EmbeddingEngine
+from frames import centerCrop
+from labels import LabelRegistry
+from persist import PersistentStore
+from store import EmbeddingStore
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.ppm')
+MANIFEST = 'enrolled.txt'
+LABELS = 'labels.json'
+
+
+def listImages(dataset):
+  """Returns the sorted (label name, path relative to dataset) of all
+  images."""
+  images = []
+  for name in sorted(os.listdir(dataset)):
+    folder = os.path.join(dataset, name)
+    if not os.path.isdir(folder): continue
+    for root, dirs, files in os.walk(folder):
+      dirs.sort()
+      for f in sorted(files):
+        if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS:
+          images.append((name, os.path.relpath(os.path.join(root, f),
+                                               dataset)))
+  return images
+
+
+def loadImages(paths, size, crop=False):
+  """Decodes images to HxWx3 uint8 arrays of a (width, height), or None for
+  the ones that cannot be read. Runs in the worker processes."""
+  frames = []
+  for path in paths:
+    try:
+      with Image.open(path) as img:
+        # JPEGs decode straight to a fraction of their size.
+        img.draft('RGB', size)
+        img = img.convert('RGB')
+        if crop:
+          scaled, (left, _, top, _) = centerCrop(img.size, size)
+          img = img.resize(scaled, Image.BILINEAR).crop(
+              (left, top, left + size[0], top + size[1]))
+        else:
+          img = img.resize(size, Image.BILINEAR)
+        frames.append(np.asarray(img))
+    except (IOError, OSError, ValueError):
+      frames.append(None)
+  return frames
+
+
+def readManifest(path, enrolled):
+  """Returns the images already done, given the number of examples they
+  added to the store.
+
+  The manifest is written ahead of the store, so its last entries may
+  claim examples that never got there; those are dropped, from the file
+  too, to be redone.
+  """
+  if not os.path.exists(path): return set()
+  done = []
+  added = 0
+  with open(path) as f:
+    for line in f:
+      if not line.endswith('\n'): break
+      flag, _, image = line[:-1].partition('\t')
+      if flag == '1':
+        if added == enrolled: break
+        added += 1
+      done.append(line)
+  if added < enrolled:
+    raise ValueError('%s does not account for all examples of the store'
+                     % path)
+  with open(path + '.tmp', 'w') as f: f.writelines(done)
+  os.rename(path + '.tmp', path)
+  return set(line[:-1].partition('\t')[2] for line in done)
+
+
+def batches(items, size):
+  for start in range(0, len(items), size):
+    yield items[start:start + size]
+
+
+def decoded(pool, load, chunks, window):
+  """Yields load(chunk) for each chunk in order, from the pool, with at
+  most window chunks decoded ahead."""
+  pending = deque()
+  for chunk in chunks:
+    pending.append(pool.apply_async(load, (chunk,)))
+    if len(pending) >= window: yield pending.popleft().get()
+  while pending: yield pending.popleft().get()
+
+
+class Progress(object):
+  """Prints the images done and images/sec at most every interval
+  seconds."""
+
+  def __init__(self, total, interval=0.5):
+    self._total = total
+    self._interval = interval
+    self._start = self._last = time.perf_counter()
+    self.done = 0
+
+  def update(self, count, final=False):
+    self.done += count
+    now = time.perf_counter()
+    if not final and now - self._last < self._interval: return
+    self._last = now
+    rate = self.done/max(now - self._start, 1e-9)
+    eta = (self._total - self.done)/rate if rate else 0
+    sys.stderr.write('\r%d/%d images  %.1f images/s  eta %ds   ' % (
+        self.done, self._total, rate, eta))
+    if final: sys.stderr.write('\n')
+    sys.stderr.flush()
+
+
+def enroll(dataset, store_path, model_path, backend='edgetpu', dtype='float32',
+           workers=None, batch_size=16, crop=False, limit=None):
+  """Adds the images of a dataset to a store; returns the counts of images
+  enrolled, skipped as unreadable and already done."""
+  if not os.path.isdir(store_path): os.makedirs(store_path)
+  registry = LabelRegistry(os.path.join(store_path, LABELS))
+  images = listImages(dataset)
+  ids = dict((name, registry.id(name))
+             for name in sorted(set(name for name, _ in images)))
+
+  store = PersistentStore(store_path, EmbeddingStore(dtype=dtype))
+  manifest_path = os.path.join(store_path, MANIFEST)
+  if not os.path.exists(manifest_path) and len(store):
+    raise ValueError('%s already holds examples not enrolled from a dataset'
+                     % store_path)
+  done = readManifest(manifest_path, len(store))
+  todo = [(name, image) for name, image in images if image not in done]
+  if limit is not None: todo = todo[:limit]
+
+  engine = EmbeddingEngine(model_path, backend=backend)
+  load = partial(loadImages, size=engine.requiredImageSize(), crop=crop)
+  workers = workers or os.cpu_count()
+  pool = Pool(workers)
+  progress = Progress(len(todo))
+  counts = {'enrolled': 0, 'unreadable': 0, 'done before': len(done)}
+  chunks = list(batches(todo, batch_size))
+  try:
+    with open(manifest_path, 'a') as manifest:
+      for chunk, frames in zip(chunks, decoded(
+          pool, load, [[os.path.join(dataset, image) for _, image in chunk]
+                       for chunk in chunks], 2*workers)):
+        readable = [i for i, frame in enumerate(frames) if frame is not None]
+        embs = engine.DetectWithImages([frames[i] for i in readable])
+        manifest.writelines('%d\t%s\n' % (frame is not None, image)
+                            for (_, image), frame in zip(chunk, frames))
+        manifest.flush()
+        for i, emb in zip(readable, embs): store.add(emb, ids[chunk[i][0]])
+        counts['enrolled'] += len(readable)
+        counts['unreadable'] += len(chunk) - len(readable)
+        progress.update(len(chunk))
+  finally:
+    pool.terminate()
+    progress.update(0, final=True)
+    # Fold the journal into a snapshot, the compact form loaded by mmap.
+    store.compact()
+    store.close()
+  return counts
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('dataset', help='Directory with a folder of images '
+                      'per label.')
+  parser.add_argument('store', help='Store directory to write (or resume).')
+  parser.add_argument('--model', help='File path of Tflite model.',
+                      default='models/mobilenet_quant_v1_224_headless_edgetpu.tflite')
+  parser.add_argument('--backend', default='edgetpu',
+                      choices=['edgetpu', 'cpu', 'reference'],
+                      help='What runs the model, see teachable.py.')
+  parser.add_argument('--dtype', default='float32',
+                      choices=['float32', 'float16', 'int8'],
+                      help='Storage type of the embeddings on disk.')
+  parser.add_argument('--workers', type=int, default=None,
+                      help='Processes decoding images, by default one per CPU.')
+  parser.add_argument('--batch', type=int, default=16,
+                      help='Images decoded and embedded together.')
+  parser.add_argument('--crop', action='store_true',
+                      help='Crop images to the model\'s aspect ratio instead '
+                      'of stretching them, like teachable.py --crop.')
+  parser.add_argument('--limit', type=int, default=None,
+                      help='Stop after this many images; run again to go on.')
+  args = parser.parse_args(argv[1:])
+  try:
+    counts = enroll(args.dataset, args.store, args.model, args.backend,
+                    args.dtype, args.workers, args.batch, args.crop,
+                    args.limit)
+  except KeyboardInterrupt:
+    print('Interrupted, run again to resume.')
+    return 1
+  print(', '.join('%d %s' % (counts[name], name)
+                  for name in ('enrolled', 'unreadable', 'done before')))
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,60 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers to move frames from the pipeline to model input tensors.
+
+Frames are either PIL images or HxWx3 uint8 NumPy arrays. Arrays usually
+are views of a mapped GStreamer buffer, negotiated at the model's input
+size, and are only valid while that buffer is mapped.
+"""
+import numpy as np
+from PIL import Image
+
+
+def bufferToArray(data, width, height):
+  """Returns an HxWx3 uint8 view of a mapped RGB video buffer.
+
+  GStreamer pads each row of RGB video to a multiple of 4 bytes; the view
+  skips the padding instead of copying it away.
+  """
+  stride = (width*3 + 3) & ~3
+  array = np.frombuffer(data, dtype=np.uint8, count=stride*height)
+  array = array.reshape(height, stride)
+  if stride != width*3: array = array[:, :width*3]
+  return array.reshape(height, width, 3)
+
+
+def inputTensor(img, size):
+  """Returns img as a flat uint8 input tensor of the given (width, height).
+
+  An array frame that already has the right size is flattened without a
+  copy (a padded view is copied once). Anything else is resized like the
+  engines always did.
+  """
+  if isinstance(img, np.ndarray):
+    if img.shape[:2] == (size[1], size[0]): return img.reshape(-1)
+    img = Image.fromarray(img)
+  with img.resize(size, Image.NEAREST) as resized_img:
+    return np.asarray(resized_img).flatten()
+
+
+def centerCrop(src_size, dst_size):
+  """Returns the size to scale src_size to and the (left, right, top,
+  bottom) margins to crop from it to get dst_size without stretching.
+  """
+  scale = max(float(dst_size[0])/src_size[0], float(dst_size[1])/src_size[1])
+  scaled = (max(dst_size[0], int(round(src_size[0]*scale))),
+            max(dst_size[1], int(round(src_size[1]*scale))))
+  dx, dy = scaled[0] - dst_size[0], scaled[1] - dst_size[1]
+  return scaled, (dx//2, dx - dx//2, dy//2, dy - dy//2)
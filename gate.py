@@ -0,0 +1,89 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Skips inference on frames that look like the last inferred one."""
+import numpy as np
+from PIL import Image
+
+
+class FrameGate(object):
+  """Decides per frame whether the scene changed enough to run inference.
+
+     Each frame is reduced to a small grid of block means (a signature).
+     If the mean absolute difference to the signature of the last inferred
+     frame stays below threshold (in 0-255 intensity levels), the caller
+     reuses its previous result. Comparing against the last inferred frame
+     rather than the previous one keeps a slow drift from going unnoticed.
+  """
+
+  def __init__(self, threshold=4.0, refresh_every=30, grid=16):
+    """Args:
+      threshold: Float, mean absolute difference that counts as a change.
+      refresh_every: Int, frames after which inference runs regardless.
+      grid: Int, the signature has grid x grid cells.
+    """
+    self._threshold = threshold
+    self._refresh_every = max(1, refresh_every)
+    self._grid = grid
+    self._counts = {'frames': 0, 'inferred': 0, 'reused': 0, 'changed': 0,
+                    'refreshed': 0, 'forced': 0}
+    self.reset()
+
+  def reset(self):
+    """Makes the next frame run inference, e.g. after the examples changed."""
+    self._signature = None
+    self._age = 0
+
+  def signature(self, img):
+    """Returns the grid x grid block means of a frame, summed over channels."""
+    if not isinstance(img, np.ndarray):
+      with img.resize((self._grid, self._grid), Image.BOX) as small:
+        return np.asarray(small, dtype=np.float32).sum(axis=2)
+    cell_h, cell_w = img.shape[0]//self._grid, img.shape[1]//self._grid
+    blocks = img[:cell_h*self._grid, :cell_w*self._grid].reshape(
+        self._grid, cell_h, self._grid, cell_w, -1)
+    return blocks.sum(axis=(1, 3, 4), dtype=np.uint32).astype(
+        np.float32)/(cell_h*cell_w)
+
+  def check(self, img, force=False):
+    """Returns True if inference should run on img.
+
+    Args:
+      img: The frame, an HxWx3 array or a PIL image.
+      force: Bool, run inference anyway (e.g. a button is pressed).
+    """
+    self._counts['frames'] += 1
+    signature = self.signature(img)
+    self._age += 1
+    if force:
+      reason = 'forced'
+    elif self._signature is None or self._age >= self._refresh_every:
+      reason = 'refreshed'
+    elif (np.abs(signature - self._signature).mean()/3 >= self._threshold):
+      reason = 'changed'
+    else:
+      self._counts['reused'] += 1
+      return False
+    self._counts[reason] += 1
+    self._counts['inferred'] += 1
+    self._signature = signature
+    self._age = 0
+    return True
+
+  def stats(self):
+    """Returns the counters and the fraction of frames that were reused."""
+    stats = dict(self._counts)
+    stats['hit_rate'] = (float(stats['reused'])/stats['frames']
+                         if stats['frames'] else 0.0)
+    return stats
@@ -12,18 +12,36 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import sys
+import threading
+import time
+import traceback
+from collections import deque
 from functools import partial
-import svgwrite
 
-import gi
-gi.require_version('Gst', '1.0')
-gi.require_version('GstBase', '1.0')
-from gi.repository import GLib, GObject, Gst, GstBase
-from PIL import Image
+from frames import bufferToArray, centerCrop
+import metrics
+from overlay import Overlay
 
-GObject.threads_init()
-Gst.init(None)
+# GStreamer is imported and initialized by init(), not on import: it takes
+# a good part of a second, which teachable.py spends loading the model.
+GLib = GObject = Gst = None
+_init_lock = threading.Lock()
+
+def init():
+    """Imports and initializes GStreamer; safe to call from any thread."""
+    global GLib, GObject, Gst
+    with _init_lock:
+        if Gst is not None:
+            return
+        import gi
+        gi.require_version('Gst', '1.0')
+        gi.require_version('GstBase', '1.0')
+        from gi.repository import GLib as glib, GObject as gobject, Gst as gst
+        gobject.threads_init()
+        gst.init(None)
+        GLib, GObject, Gst = glib, gobject, gst
 
 def on_bus_message(bus, message, loop):
     t = message.type
@@ -38,18 +56,146 @@ def on_bus_message(bus, message, loop):
         loop.quit()
     return True
 
-def on_new_sample(sink, overlay, screen_size, appsink_size, user_function):
+def on_new_sample(sink, overlay, svg_overlay, appsink_size, user_function,
+                  counts=None, loop=None):
     sample = sink.emit('pull-sample')
+    start = metrics.start()
     buf = sample.get_buffer()
     result, mapinfo = buf.map(Gst.MapFlags.READ)
+    metrics.record('map', start)
     if result:
-      img = Image.frombytes('RGB', (appsink_size[0], appsink_size[1]), mapinfo.data, 'raw')
-      svg_canvas = svgwrite.Drawing('', size=(screen_size[0], screen_size[1]))
-      user_function(img, svg_canvas)
-      overlay.set_property('data', svg_canvas.tostring())
+      # A view of the mapped buffer, only valid until it is unmapped below.
+      start = metrics.start()
+      img = bufferToArray(mapinfo.data, appsink_size[0], appsink_size[1])
+      metrics.record('frame', start)
+      start = metrics.start()
+      stop = user_function(img, svg_overlay)
+      metrics.record('classify', start)
+      if counts is not None: counts['frames'] += 1
+      if stop and loop is not None: loop.quit()
+      start = metrics.start()
+      svg = svg_overlay.render()
+      if svg is not None:
+        overlay.set_property('data', svg)
+      metrics.record('render', start)
     buf.unmap(mapinfo)
     return Gst.FlowReturn.OK
 
+class FrameWorker(object):
+    """Runs user_function on a worker thread instead of the appsink callback.
+
+    The streaming thread only queues the sample (a reference, not a copy) in
+    a ring of `depth` entries, dropping the oldest when it is full. The
+    worker always takes the newest sample and discards the rest as stale. A
+    third thread renders the status overlay when it changed and hands it to
+    rsvgoverlay, so capture, inference and rendering overlap.
+    """
+
+    def __init__(self, user_function, overlay, svg_overlay, appsink_size,
+                 depth=2, loop=None):
+        self._user_function = user_function
+        # Quit when user_function returns True.
+        self._loop = loop
+        self._overlay = overlay
+        self._svg_overlay = svg_overlay
+        self._appsink_size = appsink_size
+        self._samples = deque()
+        self._depth = max(1, depth)
+        self._cond = threading.Condition()
+        self._dirty = False
+        self._render_cond = threading.Condition()
+        self._running = True
+        self._counts = {'received': 0, 'processed': 0, 'dropped_full': 0,
+                        'dropped_stale': 0, 'rendered': 0}
+        self._threads = [threading.Thread(target=self._work),
+                         threading.Thread(target=self._render)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def push(self, sample):
+        with self._cond:
+            self._counts['received'] += 1
+            if len(self._samples) >= self._depth:
+                self._samples.popleft()
+                self._counts['dropped_full'] += 1
+            self._samples.append(sample)
+            self._cond.notify()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while self._running and not self._samples:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                sample = self._samples.pop()
+                self._counts['dropped_stale'] += len(self._samples)
+                self._samples.clear()
+            start = metrics.start()
+            buf = sample.get_buffer()
+            result, mapinfo = buf.map(Gst.MapFlags.READ)
+            metrics.record('map', start)
+            if not result:
+                continue
+            try:
+                start = metrics.start()
+                img = bufferToArray(mapinfo.data, self._appsink_size[0],
+                                    self._appsink_size[1])
+                metrics.record('frame', start)
+                start = metrics.start()
+                stop = self._user_function(img, self._svg_overlay)
+                metrics.record('classify', start)
+                if stop and self._loop is not None:
+                    self._loop.quit()
+            except Exception:
+                # One bad frame must not stop the video: log it and go on
+                # with the next one.
+                sys.stderr.write('Processing a frame failed:\n')
+                traceback.print_exc(file=sys.stderr)
+                continue
+            finally:
+                buf.unmap(mapinfo)
+            with self._cond:
+                self._counts['processed'] += 1
+            if self._svg_overlay.changed():
+                with self._render_cond:
+                    self._dirty = True
+                    self._render_cond.notify()
+
+    def _render(self):
+        while True:
+            with self._render_cond:
+                while self._running and not self._dirty:
+                    self._render_cond.wait()
+                if not self._running:
+                    return
+                self._dirty = False
+            start = metrics.start()
+            svg = self._svg_overlay.render()
+            if svg is not None:
+                self._overlay.set_property('data', svg)
+                with self._cond:
+                    self._counts['rendered'] += 1
+            metrics.record('render', start)
+
+    def stats(self):
+        """Returns a copy of the frame counters."""
+        with self._cond:
+            return dict(self._counts)
+
+    def stop(self):
+        self._running = False
+        for cond in (self._cond, self._render_cond):
+            with cond:
+                cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+def on_new_sample_pipelined(sink, worker):
+    worker.push(sink.emit('pull-sample'))
+    return Gst.FlowReturn.OK
+
 def detectCoralDevBoard():
   try:
     if 'MX8MQ' in open('/sys/firmware/devicetree/base/model').read():
@@ -58,47 +204,212 @@ def detectCoralDevBoard():
   except: pass
   return False
 
-def run_pipeline(user_function,
-                 src_size=(640,480),
-                 appsink_size=(320, 180)):
-    PIPELINE = 'v4l2src device=/dev/video0 ! {src_caps} ! {leaky_q} '
-    if detectCoralDevBoard():
-        SRC_CAPS = 'video/x-raw,format=YUY2,width={width},height={height},framerate=30/1'
-        PIPELINE += """ ! glupload ! tee name=t
-            t. ! {leaky_q} ! glfilterbin filter=glcolorscale
-               ! {dl_caps} ! videoconvert ! {sink_caps} ! {sink_element}
-            t. ! {leaky_q} ! glfilterbin filter=glcolorscale
-               ! rsvgoverlay name=overlay ! waylandsink
+LEAKINESS = ('no', 'upstream', 'downstream')
+
+class PipelineBuilder(object):
+    """Builds the camera pipeline from a few options.
+
+    Each source gets a branch that scales its frames to appsink_size for
+    user functions, and a display branch showing them with the overlay. For
+    benchmarks the display branch can end in a fakesink (headless), and the
+    pipeline can run unthrottled: test patterns are generated and files
+    decoded as fast as the pipeline takes them, and no sink waits for the
+    clock.
+    """
+
+    def __init__(self, sources=('/dev/video0',), src_size=(640, 480),
+                 framerate=30, appsink_size=(224, 224), crop=False,
+                 display=True, leaky='downstream', queue_size=1,
+                 throttle=True, num_buffers=None):
+        """Args:
+          sources: Sources, see sourceElement().
+          src_size: (width, height) the sources are captured at.
+          framerate: Int, frames per second the sources are captured at.
+          appsink_size: (width, height) of the frames for user functions.
+          crop: Bool, scale preserving the aspect ratio and center crop to
+            appsink_size instead of stretching.
+          display: Bool, show the video; otherwise end in a fakesink.
+          leaky: String, what full queues drop, one of LEAKINESS. With 'no'
+            nothing is dropped and slow consumers hold the sources back.
+          queue_size: Int, buffers each queue (and appsink) holds.
+          throttle: Bool, keep to framerate and the clock; otherwise run as
+            fast as possible.
+          num_buffers: Int, frames after which camera and test pattern
+            sources end the stream, or None.
+        """
+        if leaky not in LEAKINESS:
+            raise ValueError('Unknown queue leakiness %s' % leaky)
+        self.sources = list(sources)
+        self.src_size = tuple(src_size)
+        self.framerate = framerate
+        self.appsink_size = tuple(appsink_size)
+        self.crop = crop
+        self.display = display
+        self.leaky = leaky
+        self.queue_size = queue_size
+        self.throttle = throttle
+        self.num_buffers = num_buffers
+
+    def sourceElement(self, source):
+        """Returns the GStreamer source elements for a source argument.
+
+        A /dev/video* device is captured with v4l2src, 'videotestsrc' (or
+        'videotestsrc:PATTERN') generates a test pattern and a file is
+        decoded; anything else is used as a launch description as is.
+        Sources other than cameras are converted and scaled to the capture
+        caps.
         """
-    else:
-        SRC_CAPS = 'video/x-raw,width={width},height={height},framerate=30/1'
-        PIPELINE += """ ! tee name=t
-            t. ! {leaky_q} ! videoconvert ! videoscale ! {sink_caps} ! {sink_element}
-            t. ! {leaky_q} ! videoconvert
-               ! rsvgoverlay name=overlay ! videoconvert ! autovideosink
+        limit = (' num-buffers=%d' % self.num_buffers
+                 if self.num_buffers else '')
+        if source.startswith('/dev/video'):
+            return 'v4l2src device=%s%s' % (source, limit)
+        if source.split(':')[0] == 'videotestsrc':
+            pattern = source.partition(':')[2] or 'ball'
+            element = 'videotestsrc is-live=%s pattern=%s%s' % (
+                'true' if self.throttle else 'false', pattern, limit)
+        elif os.path.isfile(source):
+            element = 'filesrc location="%s" ! decodebin' % source
+        else:
+            element = source
+        rate = ' ! videorate' if self.throttle else ''
+        return element + rate + ' ! videoconvert ! videoscale'
+
+    def description(self):
+        """Returns the gst-launch description of the pipeline."""
+        PIPELINE = '{source} ! {src_caps} ! {queue} '
+        if detectCoralDevBoard():
+            SRC_CAPS = 'video/x-raw,format=YUY2,width={width},height={height}{rate}'
+            PIPELINE += """ ! glupload ! tee name=t{index}
+                t{index}. ! {queue} ! glfilterbin filter=glcolorscale
+                   ! {dl_caps} ! videoconvert ! {crop}{sink_caps} ! {sink_element}
+                t{index}. ! {queue} ! glfilterbin filter=glcolorscale
+                   ! rsvgoverlay name=overlay{index} ! {display_sink}
             """
+            DISPLAY_SINK = 'waylandsink'
+        else:
+            SRC_CAPS = 'video/x-raw,width={width},height={height}{rate}'
+            PIPELINE += """ ! tee name=t{index}
+                t{index}. ! {queue} ! videoconvert ! videoscale ! {scaled_caps}
+                   ! {crop}{sink_caps} ! {sink_element}
+                t{index}. ! {queue} ! videoconvert
+                   ! rsvgoverlay name=overlay{index} ! videoconvert ! {display_sink}
+                """
+            DISPLAY_SINK = 'autovideosink'
+
+        SINK_ELEMENT = 'appsink name=appsink{index} sync={sync} emit-signals=true max-buffers={size} drop={drop}'
+        DL_CAPS = 'video/x-raw,format=RGBA,width={width},height={height}'
+        SINK_CAPS = 'video/x-raw,format=RGB,width={width},height={height}'
+        SCALED_CAPS = 'video/x-raw,width={width},height={height}'
+        CROP = 'videocrop left={} right={} top={} bottom={} ! '
+        QUEUE = 'queue max-size-buffers={size} max-size-bytes=0 max-size-time=0 leaky={leaky}'
+
+        appsink_size = self.appsink_size
+        if self.crop:
+            scaled_size, margins = centerCrop(self.src_size, appsink_size)
+            crop = CROP.format(*margins)
+        else:
+            scaled_size, crop = appsink_size, ''
+        rate = (',framerate=%d/1' % self.framerate) if self.throttle else ''
+        if not self.display:
+            DISPLAY_SINK = 'fakesink sync=%s' % (
+                'true' if self.throttle else 'false')
+        src_caps = SRC_CAPS.format(width=self.src_size[0],
+                                   height=self.src_size[1], rate=rate)
+        dl_caps = DL_CAPS.format(width=scaled_size[0], height=scaled_size[1])
+        scaled_caps = SCALED_CAPS.format(width=scaled_size[0], height=scaled_size[1])
+        sink_caps = SINK_CAPS.format(width=appsink_size[0], height=appsink_size[1])
+        queue = QUEUE.format(size=self.queue_size, leaky=self.leaky)
+        return ''.join(PIPELINE.format(index=index, queue=queue,
+            source=self.sourceElement(source),
+            src_caps=src_caps, dl_caps=dl_caps, scaled_caps=scaled_caps,
+            crop=crop, sink_caps=sink_caps, display_sink=DISPLAY_SINK,
+            sink_element=SINK_ELEMENT.format(index=index,
+                size=self.queue_size, drop=str(self.leaky != 'no').lower(),
+                sync='false'))
+            for index, source in enumerate(self.sources))
+
+    def build(self):
+        """Creates the pipeline and brings it to the READY state.
+
+        Parsing the pipeline loads its plugins and READY opens the devices,
+        so this can run while the model loads; run_pipeline() then only
+        connects the user functions and starts playing.
+        """
+        init()
+        description = self.description()
+        print('Gstreamer pipeline: ', description)
+        pipeline = Gst.parse_launch(description)
+        pipeline.set_state(Gst.State.READY)
+        return pipeline
+
+def sourceElement(source):
+    """Returns the GStreamer source elements for a source argument, see
+    PipelineBuilder.sourceElement()."""
+    return PipelineBuilder().sourceElement(source)
+
+def build_pipeline(**options):
+    """Returns PipelineBuilder(**options).build()."""
+    return PipelineBuilder(**options).build()
+
+def run_pipeline(user_function,
+                 src_size=(640,480),
+                 appsink_size=(224, 224),
+                 crop=False,
+                 pipelined=False,
+                 queue_depth=2,
+                 sources=('/dev/video0',),
+                 pipeline=None):
+    """Runs the camera pipeline, calling user_function(frame, overlay) per frame.
+
+    The frame is an HxWx3 uint8 array of appsink_size, viewing the mapped
+    buffer; it must be copied to outlive the call. Negotiate appsink_size to
+    the model's input size so frames go to inference without resizing. With
+    crop the source is scaled preserving its aspect ratio and center cropped
+    instead of stretched. The overlay is an overlay.Overlay whose text is
+    drawn over the video.
+
+    With several sources (see sourceElement), each gets its own branch,
+    display and overlay, and user_function is a list holding the function
+    of each source. They are called from the sources' streaming threads.
+    A user function returning True stops the pipeline, e.g. for the
+    teachable machine's 4 button shutdown.
+
+    pipeline may be one made ahead by PipelineBuilder.build(), e.g. to run
+    headless or unthrottled; it must have the same sizes and sources.
+
+    Returns:
+      Dict with the number of frames classified, the seconds the pipeline
+      played and their ratio.
+    """
+    user_functions = (list(user_function)
+                      if isinstance(user_function, (list, tuple))
+                      else [user_function])
+    assert len(user_functions) == len(sources), \
+        'Need one user function per source'
+    if pipeline is None:
+        pipeline = PipelineBuilder(sources, src_size,
+                                   appsink_size=appsink_size,
+                                   crop=crop).build()
 
-    SINK_ELEMENT = 'appsink name=appsink sync=false emit-signals=true max-buffers=1 drop=true'
-    DL_CAPS = 'video/x-raw,format=RGBA,width={width},height={height}'
-    SINK_CAPS = 'video/x-raw,format=RGB,width={width},height={height}'
-    LEAKY_Q = 'queue max-size-buffers=1 leaky=downstream'
-
-    src_caps = SRC_CAPS.format(width=src_size[0], height=src_size[1])
-    dl_caps = DL_CAPS.format(width=appsink_size[0], height=appsink_size[1])
-    sink_caps = SINK_CAPS.format(width=appsink_size[0], height=appsink_size[1])
-    pipeline = PIPELINE.format(leaky_q=LEAKY_Q,
-        src_caps=src_caps, dl_caps=dl_caps, sink_caps=sink_caps,
-        sink_element=SINK_ELEMENT)
-
-    print('Gstreamer pipeline: ', pipeline)
-    pipeline = Gst.parse_launch(pipeline)
-
-    overlay = pipeline.get_by_name('overlay')
-    appsink = pipeline.get_by_name('appsink')
-    appsink.connect('new-sample', partial(on_new_sample,
-        overlay=overlay, screen_size = src_size,
-        appsink_size=appsink_size, user_function=user_function))
+    workers = []
+    # One counter per stream, as each is updated by its streaming thread.
+    counts = [{'frames': 0} for _ in user_functions]
     loop = GObject.MainLoop()
+    for index, function in enumerate(user_functions):
+        overlay = pipeline.get_by_name('overlay%d' % index)
+        appsink = pipeline.get_by_name('appsink%d' % index)
+        svg_overlay = Overlay(src_size)
+        if pipelined:
+            worker = FrameWorker(function, overlay, svg_overlay, appsink_size,
+                                 queue_depth, loop)
+            workers.append(worker)
+            appsink.connect('new-sample', partial(on_new_sample_pipelined,
+                worker=worker))
+        else:
+            appsink.connect('new-sample', partial(on_new_sample,
+                overlay=overlay, svg_overlay=svg_overlay,
+                appsink_size=appsink_size, user_function=function,
+                counts=counts[index], loop=loop))
 
     # Set up a pipeline bus watch to catch errors.
     bus = pipeline.get_bus()
@@ -107,12 +418,24 @@ def run_pipeline(user_function,
 
     # Run pipeline.
     pipeline.set_state(Gst.State.PLAYING)
+    start = time.perf_counter()
     try:
         loop.run()
     except:
         pass
+    elapsed = time.perf_counter() - start
 
     # Clean up.
     pipeline.set_state(Gst.State.NULL)
+    for worker in workers:
+        worker.stop()
+        print('Frame stats: ', worker.stats())
+        counts.append({'frames': worker.stats()['processed']})
     while GLib.MainContext.default().iteration(False):
         pass
+    frames = sum(count['frames'] for count in counts)
+    throughput = {'frames': frames, 'seconds': elapsed,
+                  'fps': frames/elapsed if elapsed > 0 else 0.0}
+    print('Pipeline throughput: %(frames)d frames in %(seconds).1f s, '
+          '%(fps).1f fps' % throughput)
+    return throughput
@@ -13,7 +13,13 @@
 # limitations under the License.
 
 from collections import defaultdict
-from edgetpu.basic.basic_engine import BasicEngine
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
 from edgetpu.classification.engine import ClassificationEngine
 
 from pkg_resources import parse_version
@@ -22,21 +28,35 @@ assert parse_version(edgetpu_version) >= parse_version('2.11.1'), \
     'Imprinting demo requires Edge TPU version >= 2.11.1'
 
 from edgetpu.learn.imprinting.engine import ImprintingEngine
+from frames import inputTensor
+import modelinfo
 import numpy as np
-from PIL import Image
 
 
 class DemoImprintingEngine(object):
-  """Engine wrapping from Imprinting Engine for demo usage."""
-
-  def __init__(self, model_path, output_path, keep_classes, batch_size):
+  """Engine wrapping from Imprinting Engine for demo usage.
+
+     Training runs on a background thread: addImage() only queues the
+     image, and the worker trains everything queued so far in one batch,
+     saves the model to a temporary file, loads it into a new
+     ClassificationEngine and swaps that in. Until then classify() keeps
+     using the previous classifier, so video never waits for training. The
+     saved model is renamed over output_path, so the file is always a
+     complete model.
+  """
+
+  def __init__(self, model_path, output_path, keep_classes, batch_size,
+               coalesce=0.25):
     """Creates a ImprintingEngine with given model and labels.
 
     Args:
       model_path: String, path to TF-Lite Flatbuffer file.
       output_path: String, path to output tflite file.
       keep_classes: Bool, whether to keep base model classes.
-      batch_size: Int, batch size for engine to train once.
+      batch_size: Int, number of queued images that starts training right
+        away.
+      coalesce: Float, seconds to wait for more images to train together
+        while fewer than batch_size are queued.
 
     Raises:
       ValueError: An error occurred when model output is invalid.
@@ -45,79 +65,150 @@ class DemoImprintingEngine(object):
     self._keep_classes = keep_classes
     self._output_path = output_path
     self._batch_size = batch_size
+    self._coalesce = coalesce
     self._required_image_size = self.getRequiredInputShape()
     self._example_count = 0
     self._imprinting_engine = ImprintingEngine(self._model_path, keep_classes=self._keep_classes)
+    # (ClassificationEngine, real to button label map), replaced as a whole.
+    self._classifier = None
+    self._cond = threading.Condition()
+    self._epoch = 0
+    self._running = True
+    self._training = False
     self.clear()
+    self._worker = threading.Thread(target=self._train)
+    self._worker.daemon = True
+    self._worker.start()
+
+  def requiredImageSize(self):
+    """Returns the (width, height) of images the model takes."""
+    return self._required_image_size
 
   def getRequiredInputShape(self):
     """
-    Get the required input shape for the model.
+    Get the required input shape for the model, read from the model file
+    rather than by loading the model a second time.
     """
-    basic_engine = BasicEngine(self._model_path)
-    input_tensor_shape = basic_engine.get_input_tensor_shape()
-    if (input_tensor_shape.size != 4 or input_tensor_shape[3] != 3 or
-        input_tensor_shape[0] != 1):
-      raise RuntimeError(
-          'Invalid input tensor shape! Expected: [1, height, width, 3]')
-    return (input_tensor_shape[2], input_tensor_shape[1])
+    return modelinfo.imageSize(self._model_path)
 
   def clear(self):
     """
-    Save the trained model.
     Clear the store: forgets all stored images.
+    The trained model was already saved by the worker.
     """
-    # Save the trained model.
-    if self._example_count > 0:
-      self._imprinting_engine.SaveModel(self._output_path)
-    # The size of all the image store.
-    self._example_count = 0
-
-    # The ImprintingEngine does not allow training images with too large labels.
-    # For example, with an existing model with 3 output classes, there are two
-    # options: training existing classes [0, 1, 2] or training exactly the next
-    # class [3].
-
-    # We have two maps to store the mappings from button_label to real_label,
-    # and vice versa.
-    self._label_map_button2real = {}
-    self._label_map_real2button = {}
-    self._max_real_label = 0
-    # A map with real label as key, and training images as value.
-    self._image_map = defaultdict(list)
-
-  def trainAndUpdateModel(self):
-    """Train a batch of images and update the engines."""
-    for label_real in range(0, self._max_real_label):
-      if label_real in self._image_map:
-        self._imprinting_engine.Train(np.array(self._image_map[label_real]), label_real)
-    self._image_map = defaultdict(list)  #reset
+    with self._cond:
+      # The size of all the image store.
+      self._example_count = 0
+
+      # The ImprintingEngine does not allow training images with too large labels.
+      # For example, with an existing model with 3 output classes, there are two
+      # options: training existing classes [0, 1, 2] or training exactly the next
+      # class [3].
+
+      # We have two maps to store the mappings from button_label to real_label,
+      # and vice versa.
+      self._label_map_button2real = {}
+      self._label_map_real2button = {}
+      self._max_real_label = 0
+      # A map with real label as key, and images waiting to be trained as value.
+      self._image_map = defaultdict(list)
+      # Work queued before the clear is dropped, and the worker starts over
+      # with a fresh ImprintingEngine.
+      self._epoch += 1
+      self._classifier = None
+      self._cond.notify_all()
+
+  def _train(self):
+    """Worker: trains queued images in batches and swaps in the result."""
+    epoch = self._epoch
+    while True:
+      with self._cond:
+        while self._running and not self._image_map:
+          self._cond.wait()
+        if not self._running: return
+        # Give more presses a moment to join the batch.
+        deadline = time.time() + self._coalesce
+        while (self._running and
+               sum(len(v) for v in self._image_map.values()) < self._batch_size):
+          remaining = deadline - time.time()
+          if remaining <= 0: break
+          self._cond.wait(remaining)
+        image_map, self._image_map = self._image_map, defaultdict(list)
+        real2button = dict(self._label_map_real2button)
+        if epoch != self._epoch:
+          epoch = self._epoch
+          self._imprinting_engine = ImprintingEngine(
+              self._model_path, keep_classes=self._keep_classes)
+        self._training = True
+
+      classifier = None
+      try:
+        for label_real in sorted(image_map):
+          self._imprinting_engine.Train(np.array(image_map[label_real]), label_real)
+        classifier = (self._save(), real2button)
+      except Exception:
+        # The batch is lost, but the worker goes on with the next one and
+        # the last trained model stays in use.
+        sys.stderr.write('Imprinting training failed:\n')
+        traceback.print_exc(file=sys.stderr)
+      finally:
+        with self._cond:
+          self._training = False
+          # Not if the examples were cleared meanwhile.
+          if classifier is not None and epoch == self._epoch:
+            self._classifier = classifier
+          self._cond.notify_all()
+
+  def _save(self):
+    """Saves the trained model and returns a ClassificationEngine on it."""
+    directory = os.path.dirname(os.path.abspath(self._output_path))
+    fd, tmp = tempfile.mkstemp(suffix='.tflite', dir=directory)
+    os.close(fd)
+    try:
+      self._imprinting_engine.SaveModel(tmp)
+      engine = ClassificationEngine(tmp)
+      os.rename(tmp, self._output_path)
+    except:
+      os.remove(tmp)
+      raise
+    return engine
 
   def addImage(self, img, label_button):
-    """Add an image to the store."""
-    # Update the label map.
-    if label_button not in self._label_map_button2real:
-      self._label_map_button2real[label_button] = self._max_real_label
-      self._label_map_real2button[self._max_real_label] = label_button
-      self._max_real_label += 1
-    label_real = self._label_map_button2real[label_button]
-    self._example_count += 1
-    resized_img = img.resize(self._required_image_size, Image.NEAREST)
-    self._image_map[label_real].append(np.asarray(resized_img).flatten())
-
-    # Train a batch of images.
-    if sum(len(v) for v in self._image_map.values()) == self._batch_size:
-      self.trainAndUpdateModel()
+    """Queues an image to be trained under a button label."""
+    # Copy: img may be a view of a pipeline buffer that is about to be reused.
+    tensor = np.array(inputTensor(img, self._required_image_size))
+    with self._cond:
+      # Update the label map.
+      if label_button not in self._label_map_button2real:
+        self._label_map_button2real[label_button] = self._max_real_label
+        self._label_map_real2button[self._max_real_label] = label_button
+        self._max_real_label += 1
+      label_real = self._label_map_button2real[label_button]
+      self._example_count += 1
+      self._image_map[label_real].append(tensor)
+      self._cond.notify_all()
 
   def classify(self, img):
     # If we have nothing trained, the answer is None
-    if self.exampleCount() == 0:
+    classifier = self._classifier
+    if self.exampleCount() == 0 or classifier is None:
         return None
-    resized_img = img.resize(self._required_image_size, Image.NEAREST)
-    scores = self._imprinting_engine.ClassifyWithResizedImage(resized_img, top_k=1)
-    return self._label_map_real2button[scores[0][0]]
+    engine, real2button = classifier
+    input_tensor = inputTensor(img, self._required_image_size)
+    scores = engine.ClassifyWithInputTensor(input_tensor, threshold=0.1, top_k=1)
+    if not scores: return None
+    return real2button.get(scores[0][0])
 
   def exampleCount(self):
     """Just returns the size of the image store."""
     return self._example_count
 
+  def close(self):
+    """Waits for queued training (and its save) and stops the worker."""
+    with self._cond:
+      while ((self._image_map or self._training) and
+             self._worker.is_alive()):
+        self._cond.wait(0.1)
+      self._running = False
+      self._cond.notify_all()
+    self._worker.join()
@@ -0,0 +1,159 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Inverted-file (IVF) index for approximate nearest neighbor search."""
+import numpy as np
+
+
+class _InvertedList(object):
+  """Capacity-doubling block of store rows and the sum of their vectors."""
+
+  def __init__(self, rows, vectors, capacity):
+    capacity = max(capacity, len(rows))
+    self.rows = np.empty(capacity, dtype=np.int64)
+    self.rows[:len(rows)] = rows
+    self.size = len(rows)
+    self.sum = vectors.sum(axis=0)
+
+  def append(self, row, vector):
+    if self.size == self.rows.shape[0]:
+      self.rows = np.concatenate([self.rows, np.empty_like(self.rows)])
+    self.rows[self.size] = row
+    self.size += 1
+    self.sum += vector
+
+
+class IVFIndex(object):
+  """Coarse-quantizer index over the rows of an EmbeddingStore.
+
+     Rows are partitioned into lists, each with a centroid (the normalized
+     mean of its rows). A query scores only the centroids, then the rows of
+     the nprobe closest lists, instead of the whole store. The lists hold
+     only row numbers: the rows are scored from the store's own encoded
+     rows (see attach()), so the index adds little to the store's memory
+     and keeps its compression.
+
+     The index is built incrementally: a new row joins the list with the
+     closest centroid and moves that centroid. A list that grows past
+     2*list_size is split in two with a few rounds of 2-means over its own
+     rows, so no add ever pays for a rebuild of the whole index.
+  """
+
+  def __init__(self, nprobe=8, list_size=256):
+    """Creates an empty index.
+
+    Args:
+      nprobe: Int, number of lists scanned per query.
+      list_size: Int, typical number of rows per list.
+    """
+    self._nprobe = nprobe
+    self._list_size = list_size
+    self._store = None
+    self.clear()
+
+  def attach(self, store):
+    """Sets the store whose rows are indexed; done by the store itself.
+
+    The store provides vectors(rows), the float32 rows, and
+    rowSimilarities(rows, query), their scores against a query.
+    """
+    self._store = store
+
+  def clear(self):
+    """Forgets all indexed rows."""
+    self._lists = []
+    self._centroids = None  # Normalized list sums, scored against queries.
+
+  def listCount(self):
+    """Returns the number of lists."""
+    return len(self._lists)
+
+  def nbytes(self):
+    """Returns the number of bytes allocated by the index."""
+    allocated = sum(l.rows.nbytes + l.sum.nbytes for l in self._lists)
+    if self._centroids is not None: allocated += self._centroids.nbytes
+    return allocated
+
+  def _newList(self, rows, vectors):
+    """Appends a list holding the given rows."""
+    if self._centroids is None:
+      self._centroids = np.zeros((16, vectors.shape[1]), dtype=np.float32)
+    elif len(self._lists) == self._centroids.shape[0]:
+      self._centroids = np.concatenate(
+          [self._centroids, np.zeros_like(self._centroids)])
+    self._lists.append(_InvertedList(rows, vectors, self._list_size))
+    self._updateCentroid(len(self._lists) - 1)
+
+  def _updateCentroid(self, index):
+    total = self._lists[index].sum
+    self._centroids[index] = total/max(np.sqrt((total**2).sum()), 1e-12)
+
+  def add(self, row, vector):
+    """Indexes a stored row.
+
+    Args:
+      row: Int, row of the store the vector was written to.
+      vector: Normalized embedding of that row.
+    """
+    if not self._lists:
+      self._newList([row], vector[np.newaxis])
+      return
+    nlist = len(self._lists)
+    index = int(np.argmax(np.dot(self._centroids[:nlist], vector)))
+    inverted = self._lists[index]
+    inverted.append(row, vector)
+    self._updateCentroid(index)
+    if inverted.size >= 2*self._list_size:
+      self._split(index)
+
+  def _split(self, index, iterations=4):
+    """Splits a list in two with 2-means over its rows."""
+    inverted = self._lists[index]
+    rows = inverted.rows[:inverted.size].copy()
+    vectors = self._store.vectors(rows)
+    # Seed with the row farthest from the centroid and the row farthest
+    # from that one.
+    a = vectors[np.argmin(np.dot(vectors, self._centroids[index]))]
+    b = vectors[np.argmin(np.dot(vectors, a))]
+    for _ in range(iterations):
+      side = np.dot(vectors, a) >= np.dot(vectors, b)
+      if side.all() or not side.any(): break
+      a = vectors[side].mean(axis=0)
+      b = vectors[~side].mean(axis=0)
+    if side.all() or not side.any():
+      # Degenerate (e.g. identical rows): any balanced split will do.
+      side = np.arange(len(rows)) < len(rows)//2
+
+    self._lists[index] = _InvertedList(rows[side], vectors[side],
+                                       self._list_size)
+    self._updateCentroid(index)
+    self._newList(rows[~side], vectors[~side])
+
+  def search(self, query):
+    """Scores a normalized query against the rows of the closest lists.
+
+    Returns:
+      Tuple (rows, similarities) of the scanned candidates.
+    """
+    nlist = len(self._lists)
+    if nlist == 0:
+      return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    if nlist <= self._nprobe:
+      probes = range(nlist)
+    else:
+      sims = np.dot(self._centroids[:nlist], query)
+      probes = np.argpartition(sims, -self._nprobe)[-self._nprobe:]
+    rows = np.concatenate([self._lists[i].rows[:self._lists[i].size]
+                           for i in probes])
+    return rows, self._store.rowSimilarities(rows, query)
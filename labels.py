@@ -0,0 +1,90 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Names of the classes and their dense integer ids.
+
+The stores keep a class as an integer label, and arrays per class (such
+as the example counts of bounded.py) are indexed by it, so ids are kept
+small and dense. Ids 1-4 are the buttons; named classes, e.g. from
+enroll.py or server.py, get the next ids in the order they are first seen.
+Id 0 (or None) is no class.
+"""
+
+import json
+import numbers
+import os
+
+NO_CLASS = '--'
+BUTTONS = ('One', 'Two', 'Three', 'Four')
+
+
+class LabelRegistry(object):
+  """Maps class names to dense ids and back.
+
+     With a path, the names are kept in a JSON file of {name: id} (the
+     labels.json of a store), written whenever a name is added and re-read
+     when an unknown id turns up, so that processes sharing the file learn
+     each other's names.
+  """
+
+  def __init__(self, path=None):
+    self._path = path
+    self._names = [NO_CLASS] + list(BUTTONS)
+    self._ids = dict((name, i) for i, name in enumerate(self._names))
+    if path and os.path.exists(path): self.load(path)
+
+  def load(self, path):
+    """Adds the names of a {name: id} JSON file; they win over the default
+    button names."""
+    with open(path) as f: ids = json.load(f)
+    for name, label in sorted(ids.items(), key=lambda item: item[1]):
+      while len(self._names) <= label: self._names.append(str(len(self._names)))
+      self._names[label] = name
+      self._ids[name] = label
+
+  def save(self, path):
+    """Writes the names as a {name: id} JSON file, atomically."""
+    with open(path + '.tmp', 'w') as f:
+      json.dump(dict((name, i) for i, name in enumerate(self._names) if i),
+                f, indent=1, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+  def id(self, name):
+    """Returns the id of a class name, adding the name if it is new.
+
+    Ints, and names that are the digits of a known id, are that id.
+    """
+    if isinstance(name, numbers.Integral): return int(name)
+    label = self._ids.get(name)
+    if label is not None: return label
+    if name.isdigit() and int(name) < len(self._names): return int(name)
+    label = len(self._names)
+    self._names.append(name)
+    self._ids[name] = label
+    if self._path: self.save(self._path)
+    return label
+
+  def name(self, label):
+    """Returns the name of an id, NO_CLASS for None or 0."""
+    if not label: return NO_CLASS
+    if label >= len(self._names) and self._path and os.path.exists(self._path):
+      self.load(self._path)
+    return self._names[label] if label < len(self._names) else str(label)
+
+  def names(self):
+    """Returns the names of all ids, index 0 being NO_CLASS."""
+    return list(self._names)
+
+  def __len__(self):
+    return len(self._names)
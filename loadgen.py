@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load generator for server.py.
+
+Opens --concurrency keep-alive connections, teaches the server --examples
+synthetic examples, then sends --requests classify requests as fast as the
+connections allow and reports the throughput, the tail latency, the
+accuracy on the synthetic classes and the server's batch sizes.
+
+Usage:
+  python3 loadgen.py --port 8765 --concurrency 32 --requests 10000
+  python3 loadgen.py --unix /tmp/teachable.sock --frames
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+import numpy as np
+
+from benchmark import synthetic_embeddings
+
+
+class Client(object):
+  """One keep-alive HTTP connection to server.py."""
+
+  def __init__(self, reader, writer):
+    self._reader = reader
+    self._writer = writer
+
+  @classmethod
+  async def connect(cls, port=8765, unix=None):
+    if unix: reader, writer = await asyncio.open_unix_connection(unix)
+    else: reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    return cls(reader, writer)
+
+  async def request(self, method, target, body=b'',
+                    content_type='application/json'):
+    """Returns the status and the decoded JSON answer of a request."""
+    self._writer.write(('%s %s HTTP/1.1\r\nHost: localhost\r\n'
+                        'Content-Type: %s\r\nContent-Length: %d\r\n\r\n' % (
+                            method, target, content_type, len(body))
+                       ).encode('latin-1') + body)
+    status = int((await self._reader.readline()).split()[1])
+    length = 0
+    while True:
+      header = await self._reader.readline()
+      if header in (b'\r\n', b'\n', b''): break
+      name, _, value = header.decode('latin-1').partition(':')
+      if name.strip().lower() == 'content-length': length = int(value)
+    return status, json.loads((await self._reader.readexactly(length))
+                              .decode('utf-8'))
+
+  def close(self):
+    self._writer.close()
+
+
+def _payload(emb, frame_size):
+  """Returns the (query string, body, content type) sending emb.
+
+  With a frame_size, emb is sent as an RGB frame instead: the server then
+  computes the embedding with its model, so the answers are not checked.
+  """
+  if frame_size is None:
+    return '', emb.astype('<f4').tobytes(), 'application/x-float32'
+  width, height = frame_size
+  frame = np.resize(np.minimum(emb*64, 255).astype(np.uint8),
+                    height*width*3)
+  return ('?width=%d&height=%d' % (width, height), frame.tobytes(),
+          'image/x-rgb')
+
+
+async def _worker(client, jobs, frame_size, latencies, answers):
+  while jobs:
+    index, emb = jobs.pop()
+    query, body, content_type = _payload(emb, frame_size)
+    start = time.perf_counter()
+    status, answer = await client.request('POST', '/classify' + query, body,
+                                          content_type)
+    latencies.append(time.perf_counter() - start)
+    if status != 200: raise RuntimeError(answer.get('error'))
+    answers[index] = answer['label']
+
+
+async def run(args):
+  clients = [await Client.connect(args.port, args.unix)
+             for _ in range(max(1, args.concurrency))]
+  status, stats = await clients[0].request('GET', '/stats')
+  dim = stats['embedding_size']
+  frame_size = tuple(stats['image_size']) if args.frames else None
+
+  if args.clear: await clients[0].request('POST', '/clear')
+  embs, labels = synthetic_embeddings(args.examples, dim, args.classes,
+                                      args.noise, seed=args.seed)
+  for emb, label in zip(embs, labels):
+    query, body, content_type = _payload(emb, frame_size)
+    sep = '&' if query else '?'
+    status, answer = await clients[0].request(
+        'POST', '/add_example%s%slabel=%d' % (query, sep, label), body,
+        content_type)
+    if status != 200: raise RuntimeError(answer.get('error'))
+
+  queries, expected = synthetic_embeddings(args.requests, dim, args.classes,
+                                           args.noise, seed=args.seed + 1)
+  jobs = list(enumerate(queries))[::-1]
+  answers = [None]*len(queries)
+  latencies = []
+  start = time.perf_counter()
+  await asyncio.gather(*[_worker(client, jobs, frame_size, latencies, answers)
+                         for client in clients])
+  seconds = time.perf_counter() - start
+  status, stats = await clients[0].request('GET', '/stats')
+  for client in clients: client.close()
+
+  latencies = 1e3*np.array(latencies)
+  print('requests: %d  concurrency: %d  %s' % (
+      len(latencies), len(clients), 'frames' if frame_size else 'embeddings'))
+  print('throughput: %.1f req/s' % (len(latencies)/seconds))
+  print('latency ms: mean %.3f  p50 %.3f  p95 %.3f  p99 %.3f  p99.9 %.3f  '
+        'max %.3f' % ((latencies.mean(),) + tuple(
+            np.percentile(latencies, [50, 95, 99, 99.9])) +
+                      (latencies.max(),)))
+  if not frame_size and args.examples:
+    print('accuracy: %.3f' % np.mean(np.array(answers) == expected))
+  batches = stats['batches']
+  print('server batches: %d  mean size %.2f  largest %d' % (
+      batches['batches'], batches['mean'], batches['largest']))
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--port', type=int, default=8765,
+                      help='Port of the server, on 127.0.0.1.')
+  parser.add_argument('--unix', default=None,
+                      help='Unix socket of the server instead of a port.')
+  parser.add_argument('--concurrency', type=int, default=16,
+                      help='Number of connections with a request in flight.')
+  parser.add_argument('--requests', type=int, default=5000,
+                      help='Number of classify requests.')
+  parser.add_argument('--examples', type=int, default=200,
+                      help='Number of examples taught first.')
+  parser.add_argument('--classes', type=int, default=4,
+                      help='Number of synthetic classes.')
+  parser.add_argument('--noise', type=float, default=0.5,
+                      help='Spread of each synthetic class around its center.')
+  parser.add_argument('--frames', action='store_true',
+                      help='Send RGB frames of the model\'s input size '
+                      'instead of embeddings.')
+  parser.add_argument('--clear', action='store_true',
+                      help='Clear the server\'s examples first.')
+  parser.add_argument('--seed', type=int, default=0,
+                      help='Seed of the synthetic examples and queries.')
+  args = parser.parse_args(argv[1:])
+  asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
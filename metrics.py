@@ -0,0 +1,273 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-stage latency histograms of the frame path.
+
+Stages are timed with
+
+  start = metrics.start()
+  ...
+  metrics.record('inference', start)
+
+While metrics are disabled (the default) start() returns None and record()
+returns immediately, so the hooks cost two function calls per stage. Once
+enable()d, every stage feeds a histogram with fixed buckets, which can be
+exported periodically as JSON or Prometheus text to a file, or served over
+HTTP on a local port.
+
+Startup is timed separately, from process start to the first
+classification: startupBegin() at the top of main, startupPhase() around
+each initialization step and firstResult() after every classification.
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds; a last bucket takes
+# everything slower.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0)
+
+_metrics = None
+_startup = None
+
+
+class Histogram(object):
+  """Counts observations into fixed buckets."""
+
+  def __init__(self, bounds=BUCKETS):
+    self._bounds = bounds
+    self.counts = [0]*(len(bounds) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self._bounds, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def copy(self):
+    other = Histogram(self._bounds)
+    other.counts = list(self.counts)
+    other.count = self.count
+    other.sum = self.sum
+    return other
+
+
+class Metrics(object):
+  """The histograms of all stages."""
+
+  def __init__(self, bounds=BUCKETS):
+    self._bounds = bounds
+    self._lock = threading.Lock()
+    self._histograms = {}
+
+  def observe(self, stage, seconds):
+    with self._lock:
+      histogram = self._histograms.get(stage)
+      if histogram is None:
+        histogram = self._histograms[stage] = Histogram(self._bounds)
+      histogram.observe(seconds)
+
+  def snapshot(self):
+    """Returns a copy of the histograms, by stage."""
+    with self._lock:
+      return dict((stage, histogram.copy())
+                  for stage, histogram in self._histograms.items())
+
+  def toJson(self):
+    """Returns the histograms as a JSON document."""
+    stages = {}
+    for stage, histogram in sorted(self.snapshot().items()):
+      stages[stage] = {
+          'count': histogram.count, 'sum': histogram.sum,
+          'mean': histogram.sum/histogram.count if histogram.count else 0.0,
+          'buckets': [[bound, count] for bound, count in
+                      zip(list(self._bounds) + ['+Inf'], histogram.counts)]}
+    return json.dumps({'time': time.time(), 'stages': stages}, indent=2)
+
+  def toPrometheus(self):
+    """Returns the histograms in the Prometheus text exposition format."""
+    lines = ['# TYPE teachable_stage_seconds histogram']
+    for stage, histogram in sorted(self.snapshot().items()):
+      cumulative = 0
+      for bound, count in zip(list(self._bounds) + ['+Inf'], histogram.counts):
+        cumulative += count
+        lines.append('teachable_stage_seconds_bucket{stage="%s",le="%s"} %d'
+                     % (stage, bound, cumulative))
+      lines.append('teachable_stage_seconds_sum{stage="%s"} %r'
+                   % (stage, histogram.sum))
+      lines.append('teachable_stage_seconds_count{stage="%s"} %d'
+                   % (stage, histogram.count))
+    return '\n'.join(lines) + '\n'
+
+
+def enable(bounds=BUCKETS):
+  """Starts collecting timings and returns the Metrics they go to."""
+  global _metrics
+  if _metrics is None: _metrics = Metrics(bounds)
+  return _metrics
+
+
+def enabled():
+  return _metrics is not None
+
+
+def start():
+  """Returns a start time for record(), or None if metrics are disabled."""
+  return time.perf_counter() if _metrics is not None else None
+
+
+def record(stage, start):
+  """Adds the time since start to the histogram of stage."""
+  if start is None: return
+  _metrics.observe(stage, time.perf_counter() - start)
+
+
+def write(path):
+  """Writes the histograms to path atomically, as Prometheus text if the
+  name ends in .prom and as JSON otherwise."""
+  if _metrics is None: return
+  if path.endswith('.prom'): text = _metrics.toPrometheus()
+  else: text = _metrics.toJson()
+  tmp = path + '.tmp'
+  with open(tmp, 'w') as f: f.write(text)
+  os.rename(tmp, path)
+
+
+class Exporter(object):
+  """Writes the histograms to a file every interval seconds."""
+
+  def __init__(self, path, interval=10.0):
+    self._path = path
+    self._interval = interval
+    self._stopped = threading.Event()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    while not self._stopped.wait(self._interval):
+      write(self._path)
+
+  def stop(self):
+    """Stops the thread and writes the final histograms."""
+    self._stopped.set()
+    self._thread.join()
+    write(self._path)
+
+
+def serve(port, host='127.0.0.1'):
+  """Serves the histograms over HTTP from a thread.
+
+  Answers with Prometheus text, or with JSON for paths ending in .json.
+  """
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  enable()
+
+  class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      json_format = self.path.endswith('.json')
+      body = (_metrics.toJson() if json_format
+              else _metrics.toPrometheus()).encode('utf-8')
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json' if json_format
+                       else 'text/plain; version=0.0.4')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, *args):
+      pass
+
+  server = HTTPServer((host, port), Handler)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+def _processAge():
+  """Returns the seconds since this process started, 0.0 if unknown."""
+  try:
+    with open('/proc/self/stat') as f:
+      # Fields after the command name, which may contain spaces.
+      fields = f.read().rpartition(')')[2].split()
+    with open('/proc/uptime') as f:
+      uptime = float(f.read().split()[0])
+    return max(0.0, uptime - int(fields[19])/float(os.sysconf('SC_CLK_TCK')))
+  except (IOError, OSError, ValueError, IndexError):
+    return 0.0
+
+
+class Startup(object):
+  """Times the phases of startup, up to the first classification.
+
+     Times are in seconds since the process started, so interpreter start
+     and module imports count too.
+  """
+
+  def __init__(self):
+    self._origin = time.perf_counter() - _processAge()
+    self._lock = threading.Lock()
+    self._phases = [('imports', 0.0, time.perf_counter() - self._origin)]
+    self.first = None
+
+  def phase(self, name, start):
+    """Records a phase that began at start (a time.perf_counter())."""
+    end = time.perf_counter()
+    with self._lock:
+      self._phases.append((name, start - self._origin, end - start))
+
+  def firstResult(self):
+    """Records the first classification; returns False if it already was."""
+    with self._lock:
+      if self.first is not None: return False
+      self.first = time.perf_counter() - self._origin
+    if _metrics is not None:
+      _metrics.observe('time_to_first_result', self.first)
+    return True
+
+  def report(self):
+    """Returns the phases as text, one per line."""
+    with self._lock:
+      phases = sorted(self._phases, key=lambda phase: phase[1])
+      first = self.first
+    lines = ['Startup (seconds since process start):']
+    for name, start, duration in phases:
+      lines.append('  %-20s at %6.3f took %6.3f' % (name, start, duration))
+    if first is not None:
+      lines.append('  %-20s at %6.3f' % ('first result', first))
+    return '\n'.join(lines)
+
+
+def startupBegin():
+  """Starts timing startup and returns the Startup."""
+  global _startup
+  _startup = Startup()
+  return _startup
+
+
+def startupPhase(name, start):
+  """Records a startup phase that began at start (a time.perf_counter())."""
+  if _startup is not None: _startup.phase(name, start)
+
+
+def firstResult():
+  """Marks the first classification and prints the startup report."""
+  if _startup is None or _startup.first is not None: return
+  if _startup.firstResult(): print(_startup.report())
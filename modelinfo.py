@@ -0,0 +1,133 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reads tensor shapes straight from a .tflite file.
+
+Loading a model into an interpreter or onto an Edge TPU only to ask for
+its input size costs as much as the load itself. The .tflite format is a
+FlatBuffer, so the few fields needed are read in place from a memory map:
+the model's first subgraph, its input and output tensor indices, and the
+shapes of those tensors.
+"""
+
+import mmap
+import struct
+
+_IDENTIFIER = b'TFL3'
+
+# Field numbers in the TF Lite schema.
+_MODEL_SUBGRAPHS = 2
+_SUBGRAPH_TENSORS = 0
+_SUBGRAPH_INPUTS = 1
+_SUBGRAPH_OUTPUTS = 2
+_TENSOR_SHAPE = 0
+
+
+class _Reader(object):
+  """Just enough of a FlatBuffer reader for tables, vectors and ints."""
+
+  def __init__(self, data):
+    self._data = data
+
+  def _uint32(self, pos):
+    return struct.unpack_from('<I', self._data, pos)[0]
+
+  def root(self):
+    return self._uint32(0)
+
+  def _field(self, table, field):
+    """Returns the position of a field of a table, or None if absent."""
+    vtable = table - struct.unpack_from('<i', self._data, table)[0]
+    vtable_size = struct.unpack_from('<H', self._data, vtable)[0]
+    entry = 4 + 2*field
+    if entry >= vtable_size: return None
+    offset = struct.unpack_from('<H', self._data, vtable + entry)[0]
+    return table + offset if offset else None
+
+  def _vector(self, table, field):
+    """Returns (position of the first element, length) of a vector field."""
+    pos = self._field(table, field)
+    if pos is None: return None, 0
+    vector = pos + self._uint32(pos)
+    return vector + 4, self._uint32(vector)
+
+  def tables(self, table, field):
+    """Returns the positions of the tables in a vector field."""
+    start, length = self._vector(table, field)
+    return [start + 4*i + self._uint32(start + 4*i) for i in range(length)]
+
+  def ints(self, table, field):
+    """Returns an int32 vector field as a tuple."""
+    start, length = self._vector(table, field)
+    if not length: return ()
+    return struct.unpack_from('<%di' % length, self._data, start)
+
+
+def tensorShapes(model_path):
+  """Returns the shapes of the input and the output tensors of a model.
+
+  Args:
+    model_path: String, path to TF-Lite Flatbuffer file (compiled for the
+      Edge TPU or not).
+
+  Returns:
+    (inputs, outputs), lists of shape tuples of the first subgraph.
+
+  Raises:
+    ValueError: The file is not a TF Lite model.
+  """
+  with open(model_path, 'rb') as f:
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    if data[4:8] != _IDENTIFIER:
+      raise ValueError('%s is not a TF Lite model' % model_path)
+    reader = _Reader(data)
+    subgraphs = reader.tables(reader.root(), _MODEL_SUBGRAPHS)
+    if not subgraphs:
+      raise ValueError('%s has no subgraph' % model_path)
+    subgraph = subgraphs[0]
+    tensors = reader.tables(subgraph, _SUBGRAPH_TENSORS)
+    def shapes(field):
+      return [reader.ints(tensors[i], _TENSOR_SHAPE)
+              for i in reader.ints(subgraph, field)]
+    return shapes(_SUBGRAPH_INPUTS), shapes(_SUBGRAPH_OUTPUTS)
+  finally:
+    data.close()
+
+
+def inputShape(model_path):
+  """Returns the shape of a model's (first) input tensor."""
+  return tensorShapes(model_path)[0][0]
+
+
+def classCount(model_path):
+  """Returns the number of classes a classification model scores, the size
+  of its (first) output tensor."""
+  count = 1
+  for size in tensorShapes(model_path)[1][0]: count *= size
+  return count
+
+
+def imageSize(model_path):
+  """Returns the (width, height) of the images a model takes.
+
+  Raises:
+    ValueError: The input is not a [1, height, width, 3] image.
+  """
+  shape = inputShape(model_path)
+  if len(shape) != 4 or shape[0] != 1 or shape[3] != 3:
+    raise ValueError(
+        'Invalid input tensor shape %s! Expected: [1, height, width, 3]'
+        % (shape,))
+  return (shape[2], shape[1])
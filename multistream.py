@@ -0,0 +1,159 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lets several camera streams share one kNN engine.
+
+Each stream runs its own TeachableMachineKNN (smoothing buffer, gate and
+overlay) on its own streaming thread. Their engine is a SharedKNNEngine
+that hands every frame to a Batcher: frames arriving within max_wait of
+each other are embedded and searched together in one call, so the model is
+loaded once and the store is streamed once per batch rather than per frame.
+"""
+
+import threading
+import time
+
+
+class _Request(object):
+  __slots__ = ('item', 'result', 'error', 'done')
+
+  def __init__(self, item):
+    self.item = item
+    self.result = None
+    self.error = None
+    self.done = threading.Event()
+
+
+class Batcher(object):
+  """Runs function on items submitted from several threads, in batches.
+
+     The worker takes the first waiting item, waits up to max_wait for more
+     (or until max_batch are waiting) and calls function(items), which must
+     return one result per item. submit() blocks until its result is ready.
+  """
+
+  def __init__(self, function, max_batch=8, max_wait=0.005):
+    self._function = function
+    self._max_batch = max(1, max_batch)
+    self._max_wait = max_wait
+    self._queue = []
+    self._cond = threading.Condition()
+    self._running = True
+    self._counts = {'items': 0, 'batches': 0, 'largest': 0}
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def submit(self, item):
+    """Queues item and returns function's result for it."""
+    request = _Request(item)
+    with self._cond:
+      if not self._running: raise RuntimeError('Batcher is stopped')
+      self._queue.append(request)
+      self._cond.notify()
+    request.done.wait()
+    if request.error is not None: raise request.error
+    return request.result
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while self._running and not self._queue:
+          self._cond.wait()
+        if not self._running: return
+        deadline = time.time() + self._max_wait
+        while len(self._queue) < self._max_batch:
+          remaining = deadline - time.time()
+          if remaining <= 0 or not self._running: break
+          self._cond.wait(remaining)
+        batch = self._queue[:self._max_batch]
+        del self._queue[:self._max_batch]
+        self._counts['items'] += len(batch)
+        self._counts['batches'] += 1
+        self._counts['largest'] = max(self._counts['largest'], len(batch))
+      try:
+        results = self._function([request.item for request in batch])
+        for request, result in zip(batch, results): request.result = result
+      except Exception as e:
+        for request in batch: request.error = e
+      for request in batch: request.done.set()
+
+  def stats(self):
+    """Returns the counters and the mean batch size."""
+    with self._cond:
+      stats = dict(self._counts)
+    stats['mean'] = (float(stats['items'])/stats['batches']
+                     if stats['batches'] else 0.0)
+    return stats
+
+  def stop(self):
+    """Stops the worker; waiting submitters are failed."""
+    with self._cond:
+      self._running = False
+      pending, self._queue = self._queue, []
+      self._cond.notify_all()
+    self._thread.join()
+    for request in pending:
+      request.error = RuntimeError('Batcher is stopped')
+      request.done.set()
+
+
+class SharedKNNEngine(object):
+  """Shares a KNNEmbeddingEngine between the machines of several streams.
+
+     Offers the engine interface TeachableMachineKNN uses. classifyImage()
+     goes through a Batcher, using the engine's DetectWithImages and
+     kNNEmbeddings; adding and clearing examples take the same lock as the
+     searches, so the store is never searched while it changes.
+
+     With an embedder (e.g. a pool.EnginePool) the frames of a batch are
+     embedded by it instead of by the engine.
+  """
+
+  def __init__(self, engine, max_batch=8, max_wait=0.005, embedder=None):
+    self._engine = engine
+    self._embedder = embedder or engine
+    self._lock = threading.Lock()
+    self._batcher = Batcher(self._classifyBatch, max_batch, max_wait)
+
+  def _classifyBatch(self, imgs):
+    embs = self._embedder.DetectWithImages(imgs)
+    with self._lock:
+      return list(zip(embs, self._engine.kNNEmbeddings(embs)))
+
+  def classifyImage(self, img):
+    """Returns the embedding of img and its kNN label."""
+    return self._batcher.submit(img)
+
+  def requiredImageSize(self):
+    return self._engine.requiredImageSize()
+
+  def addEmbedding(self, emb, label):
+    with self._lock: self._engine.addEmbedding(emb, label)
+
+  def clear(self):
+    with self._lock: self._engine.clear()
+
+  def exampleCount(self):
+    return self._engine.exampleCount()
+
+  def labelRegistry(self):
+    return self._engine.labelRegistry()
+
+  def stats(self):
+    """Returns the batching counters."""
+    return self._batcher.stats()
+
+  def stop(self):
+    self._batcher.stop()
@@ -0,0 +1,103 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Status overlay and console logging kept off the per-frame path."""
+import sys
+import threading
+import time
+from xml.sax.saxutils import escape
+
+_SVG = ('<svg baseProfile="full" height="{height}" version="1.1" '
+        'width="{width}" xmlns="http://www.w3.org/2000/svg">{body}</svg>')
+_TEXT = '<text fill="{fill}" font-size="{size}" x="{x}" y="{y}">{text}</text>'
+
+
+class Overlay(object):
+  """Status text drawn over the video, rendered to SVG only on change.
+
+     The frame callback sets the text every frame; render() returns a new
+     SVG document only when the text differs from what was last rendered,
+     and None otherwise, so rsvgoverlay is not made to re-parse an identical
+     document 30 times a second. Safe to update and render from different
+     threads.
+  """
+
+  def __init__(self, size, font_size=20):
+    self._size = size
+    self._font_size = font_size
+    self._lock = threading.Lock()
+    self._text = None
+    self._version = 0
+    self._rendered_version = 0
+
+  def setText(self, text):
+    """Sets the status line. Returns True if it changed."""
+    with self._lock:
+      if text == self._text: return False
+      self._text = text
+      self._version += 1
+      return True
+
+  def changed(self):
+    """Returns True if there is something new to render."""
+    with self._lock: return self._version != self._rendered_version
+
+  def render(self):
+    """Returns the SVG document if it changed since the last call, else None."""
+    with self._lock:
+      if self._version == self._rendered_version: return None
+      self._rendered_version = self._version
+      text = self._text
+    body = ''
+    if text:
+      text = escape(text)
+      # A black shadow under white text, readable on any background.
+      body = (_TEXT.format(fill='black', size=self._font_size, x=26, y=26,
+                           text=text) +
+              _TEXT.format(fill='white', size=self._font_size, x=25, y=25,
+                           text=text))
+    return _SVG.format(width=self._size[0], height=self._size[1], body=body)
+
+
+class BackgroundLogger(object):
+  """Buffers console lines and writes them from a thread every interval.
+
+     log() only appends to a list, so a slow terminal or serial console
+     never stalls the frame loop.
+  """
+
+  def __init__(self, interval=1.0, stream=None):
+    self._interval = interval
+    self._stream = stream
+    self._lines = []
+    self._lock = threading.Lock()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def log(self, line):
+    with self._lock: self._lines.append(line)
+
+  def flush(self):
+    with self._lock: lines, self._lines = self._lines, []
+    if lines:
+      # Resolve sys.stdout late so redirections (e.g. in replay.py) apply.
+      stream = self._stream or sys.stdout
+      stream.write('\n'.join(lines) + '\n')
+      stream.flush()
+
+  def _run(self):
+    while True:
+      time.sleep(self._interval)
+      self.flush()
@@ -0,0 +1,272 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keeps an EmbeddingStore on disk across restarts.
+
+A store directory holds:
+
+  CURRENT         Generation number g of the live snapshot.
+  snapshot.<g>/   embeddings.npy, labels.npy and scales.npy holding every
+                  example added before generation g started. The embeddings
+                  are memory-mapped on load rather than read.
+  journal.<g>     Append-only log of the examples added since, one fixed-size
+                  record (int32 label, float32 embedding) each.
+
+Compaction starts journal.<g+1>, writes snapshot.<g+1> from the in-memory
+store, and only then points CURRENT at it. Loading replays journal.<g> and
+journal.<g+1>, so a crash at any point loses no acknowledged example.
+"""
+
+import os
+import shutil
+import threading
+
+import numpy as np
+
+_JOURNAL_MAGIC = b'TMJ1'
+
+
+def _fsync(path):
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+class PersistentStore(object):
+  """Wraps an EmbeddingStore so that every example is also kept on disk.
+
+     Offers the same add/query/neighbors/clear interface as EmbeddingStore.
+     Compaction of the journal into a new snapshot runs on a background
+     thread every compact_every examples.
+  """
+
+  def __init__(self, path, store, compact_every=1024):
+    """Opens (or creates) a store directory and loads its contents.
+
+    Args:
+      path: String, directory holding the store.
+      store: An empty EmbeddingStore to load into and wrap.
+      compact_every: Int, journal length that triggers a compaction.
+
+    Raises:
+      ValueError: The store projects its embeddings; projections are fitted
+        per process and cannot be persisted.
+    """
+    if store.projected():
+      raise ValueError('Projected stores cannot be persisted.')
+    self._path = path
+    self._store = store
+    self._compact_every = compact_every
+    self._lock = threading.Lock()          # Guards the store and journal.
+    self._compact_lock = threading.Lock()  # Serializes compaction and clear.
+    self._compactor = None
+    self._journal = None
+    if not os.path.isdir(path): os.makedirs(path)
+    self._open()
+
+  def _file(self, name, generation):
+    return os.path.join(self._path, '%s.%d' % (name, generation))
+
+  def _open(self):
+    """Loads the snapshot, replays the journals and opens the journal."""
+    current = os.path.join(self._path, 'CURRENT')
+    self._generation = 0
+    if os.path.exists(current):
+      with open(current) as f: self._generation = int(f.read())
+    self._removeStale(self._generation)
+
+    snapshot = self._file('snapshot', self._generation)
+    if os.path.isdir(snapshot):
+      self._store.load(
+          np.load(os.path.join(snapshot, 'embeddings.npy'), mmap_mode='r'),
+          np.load(os.path.join(snapshot, 'labels.npy')),
+          np.load(os.path.join(snapshot, 'scales.npy')))
+
+    # A compaction interrupted before CURRENT moved leaves a newer journal.
+    self._journal_generation = self._generation
+    self._pending = 0
+    for generation in (self._generation, self._generation + 1):
+      if not os.path.exists(self._file('journal', generation)): continue
+      self._journal_generation = generation
+      for label, emb in self._readJournal(generation):
+        self._store.add(emb, label)
+        self._pending += 1
+    if self._pending >= self._compact_every: self._startCompaction()
+
+  def _readJournal(self, generation):
+    """Yields the (label, embedding) records of a journal.
+
+    A record cut short by a crash is dropped and truncated away, so that
+    appends stay aligned.
+    """
+    path = self._file('journal', generation)
+    with open(path, 'rb') as f: data = f.read()
+    if len(data) < 8: return
+    if data[:4] != _JOURNAL_MAGIC:
+      raise ValueError('%s is not a journal file' % path)
+    dim = int(np.frombuffer(data[4:8], dtype='<i4')[0])
+    record = np.dtype([('label', '<i4'), ('emb', '<f4', (dim,))])
+    count = (len(data) - 8) // record.itemsize
+    if 8 + count*record.itemsize != len(data):
+      with open(path, 'r+b') as f: f.truncate(8 + count*record.itemsize)
+    records = np.frombuffer(data, dtype=record, count=count, offset=8)
+    for r in records: yield int(r['label']), r['emb']
+
+  def _append(self, emb, label):
+    """Appends a record to the current journal."""
+    emb = np.asarray(emb, dtype='<f4').ravel()
+    if self._journal is None:
+      path = self._file('journal', self._journal_generation)
+      new = not os.path.exists(path) or os.path.getsize(path) == 0
+      self._journal = open(path, 'ab')
+      if new:
+        self._journal.write(_JOURNAL_MAGIC)
+        self._journal.write(np.array([emb.shape[0]], dtype='<i4').tobytes())
+    self._journal.write(np.array([label], dtype='<i4').tobytes())
+    self._journal.write(emb.tobytes())
+    # Hand the record to the OS now; compaction fsyncs.
+    self._journal.flush()
+
+  def _closeJournal(self):
+    if self._journal is not None:
+      self._journal.close()
+      self._journal = None
+
+  def _removeStale(self, generation):
+    """Deletes files no longer needed once `generation` is current."""
+    for name in os.listdir(self._path):
+      kind, _, suffix = name.partition('.')
+      path = os.path.join(self._path, name)
+      if suffix.endswith('tmp'):
+        stale = True
+      elif kind == 'snapshot' and suffix.isdigit():
+        stale = int(suffix) != generation
+      elif kind == 'journal' and suffix.isdigit():
+        stale = int(suffix) < generation
+      else:
+        stale = False
+      if not stale: continue
+      if os.path.isdir(path): shutil.rmtree(path)
+      else: os.remove(path)
+
+  def _setCurrent(self, generation):
+    """Atomically points CURRENT at a generation."""
+    tmp = os.path.join(self._path, 'CURRENT.tmp')
+    with open(tmp, 'w') as f:
+      f.write('%d' % generation)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp, os.path.join(self._path, 'CURRENT'))
+    _fsync(self._path)
+    self._generation = generation
+
+  def _startCompaction(self):
+    if self._compactor is not None and self._compactor.is_alive(): return
+    self._compactor = threading.Thread(target=self.compact)
+    self._compactor.daemon = True
+    self._compactor.start()
+
+  def compact(self):
+    """Folds the journal into a new snapshot."""
+    with self._compact_lock:
+      with self._lock:
+        if self._journal is not None: os.fsync(self._journal.fileno())
+        self._closeJournal()
+        generation = self._journal_generation + 1
+        self._journal_generation = generation
+        self._pending = 0
+        count = len(self._store)
+        blocks = self._store.segments()
+        labels = self._store.labels().copy()
+
+      snapshot = self._file('snapshot', generation)
+      if count:
+        tmp = snapshot + '.tmp'
+        if os.path.isdir(tmp): shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        dim = blocks[0][0].shape[1]
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(tmp, 'embeddings.npy'), mode='w+',
+            dtype=blocks[0][0].dtype, shape=(count, dim))
+        scales = np.empty(count, dtype=np.float32)
+        start = 0
+        for codes, block_scales in blocks:
+          end = min(start + len(codes), count)
+          embeddings[start:end] = codes[:end - start]
+          scales[start:end] = block_scales[:end - start]
+          start = end
+        embeddings.flush()
+        del embeddings
+        np.save(os.path.join(tmp, 'labels.npy'), labels)
+        np.save(os.path.join(tmp, 'scales.npy'), scales)
+        for name in os.listdir(tmp): _fsync(os.path.join(tmp, name))
+        os.rename(tmp, snapshot)
+      self._setCurrent(generation)
+      self._removeStale(generation)
+
+      if count:
+        mapped = np.load(os.path.join(snapshot, 'embeddings.npy'),
+                         mmap_mode='r')
+        with self._lock: self._store.rebase(mapped)
+
+  def add(self, emb, label):
+    """Adds an example to the store and its journal."""
+    with self._lock:
+      self._append(emb, label)
+      self._store.add(emb, label)
+      self._pending += 1
+      if self._pending >= self._compact_every: self._startCompaction()
+
+  def clear(self):
+    """Forgets all examples, in memory and on disk."""
+    with self._compact_lock:
+      with self._lock:
+        self._store.clear()
+        self._closeJournal()
+        # Skip past any journal a compaction may have started.
+        generation = self._journal_generation + 1
+        self._journal_generation = generation
+        self._pending = 0
+        self._setCurrent(generation)
+        self._removeStale(generation)
+
+  def close(self):
+    """Waits for a running compaction and closes the journal."""
+    if self._compactor is not None: self._compactor.join()
+    with self._lock:
+      if self._journal is not None: os.fsync(self._journal.fileno())
+      self._closeJournal()
+
+  def query(self, query_emb):
+    with self._lock: return self._store.query(query_emb)
+
+  def queryBatch(self, query_embs):
+    with self._lock: return self._store.queryBatch(query_embs)
+
+  def neighbors(self, query_emb, count):
+    with self._lock: return self._store.neighbors(query_emb, count)
+
+  def embeddings(self):
+    with self._lock: return self._store.embeddings()
+
+  def labels(self):
+    with self._lock: return self._store.labels()
+
+  def nbytes(self):
+    return self._store.nbytes()
+
+  def __len__(self):
+    return len(self._store)
@@ -0,0 +1,260 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Spreads embedding inference over several engines.
+
+An EnginePool owns backends that each embed one frame at a time: engines
+in this process (ThreadBackend, e.g. one EmbeddingEngine per Edge TPU) or
+engines in worker processes (ProcessBackend, for CPU inference). Frames go
+to the backend with the least outstanding work. Results of one stream are
+delivered in the order its frames were submitted, whichever backend
+finishes first.
+"""
+
+import multiprocessing
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+
+class ThreadBackend(object):
+  """Runs an engine's DetectWithImage in the calling thread."""
+
+  def __init__(self, engine, name=None):
+    self._engine = engine
+    self.name = name or type(engine).__name__
+
+  def requiredImageSize(self):
+    return self._engine.requiredImageSize()
+
+  def run(self, img):
+    return self._engine.DetectWithImage(img)
+
+  def close(self):
+    pass
+
+
+def _serve(factory, conn):
+  """Worker process loop of a ProcessBackend."""
+  engine = factory()
+  conn.send(tuple(engine.requiredImageSize()))
+  while True:
+    img = conn.recv()
+    if img is None: return
+    try:
+      conn.send((engine.DetectWithImage(img), None))
+    except Exception as e:
+      conn.send((None, e))
+
+
+class ProcessBackend(object):
+  """Runs an engine in a worker process.
+
+     factory must be picklable (e.g. a class or functools.partial of one) as
+     the process is spawned, not forked, to stay clear of the parent's
+     threads. Frames are copied to the process over a pipe.
+  """
+
+  def __init__(self, factory, name=None):
+    context = multiprocessing.get_context('spawn')
+    self._conn, child = context.Pipe()
+    self._process = context.Process(target=_serve, args=(factory, child))
+    self._process.daemon = True
+    self._process.start()
+    child.close()
+    self._size = self._conn.recv()
+    self.name = name or 'process%d' % self._process.pid
+
+  def requiredImageSize(self):
+    return self._size
+
+  def run(self, img):
+    self._conn.send(img)
+    emb, error = self._conn.recv()
+    if error is not None: raise error
+    return emb
+
+  def close(self):
+    try:
+      self._conn.send(None)
+    except (IOError, OSError):
+      pass
+    self._process.join(1.0)
+    if self._process.is_alive(): self._process.terminate()
+
+
+class _Job(object):
+  __slots__ = ('img', 'callback', 'stream', 'result', 'error', 'finished',
+               'done')
+
+  def __init__(self, img, callback, stream):
+    self.img = img
+    self.callback = callback
+    self.stream = stream
+    self.result = None
+    self.error = None
+    self.finished = img is None
+    self.done = threading.Event()
+
+  def wait(self):
+    """Returns the embedding, once the job (and its callback) is done."""
+    self.done.wait()
+    if self.error is not None: raise self.error
+    return self.result
+
+
+class _Stream(object):
+  __slots__ = ('jobs', 'delivering')
+
+  def __init__(self):
+    self.jobs = deque()
+    self.delivering = False
+
+
+class EnginePool(object):
+  """Schedules frames over backends, least-loaded first."""
+
+  def __init__(self, backends, max_pending=None):
+    """Args:
+      backends: List of ThreadBackend or ProcessBackend.
+      max_pending: Int, frames of one stream that may be in flight before
+        submit() blocks; by default the number of backends.
+    """
+    self._backends = list(backends)
+    self._max_pending = max_pending or len(self._backends)
+    self._cond = threading.Condition()
+    self._queues = [deque() for _ in self._backends]
+    self._load = [0]*len(self._backends)   # Queued plus running jobs.
+    self._jobs = [0]*len(self._backends)
+    self._busy = [0.0]*len(self._backends)
+    self._streams = {}
+    self._start = time.time()
+    self._running = True
+    self._threads = [threading.Thread(target=self._work, args=(i,))
+                     for i in range(len(self._backends))]
+    for thread in self._threads:
+      thread.daemon = True
+      thread.start()
+
+  def requiredImageSize(self):
+    return self._backends[0].requiredImageSize()
+
+  def submit(self, img, callback=None, stream=None):
+    """Queues a frame for embedding and returns a job to wait() on.
+
+    Args:
+      img: The frame; must stay valid until the job is done. None only
+        orders callback after the stream's earlier frames.
+      callback: Optional function called with the embedding (or None).
+        Callbacks of a stream run one at a time, in submission order.
+      stream: Hashable stream key; None for a frame with no ordering.
+    """
+    job = _Job(img, callback, stream)
+    with self._cond:
+      if stream is not None:
+        ordered = self._streams.setdefault(stream, _Stream())
+        while len(ordered.jobs) >= self._max_pending:
+          self._cond.wait()
+        ordered.jobs.append(job)
+      if img is not None:
+        index = min(range(len(self._backends)),
+                    key=lambda i: (self._load[i], self._busy[i]))
+        self._load[index] += 1
+        self._queues[index].append(job)
+        self._cond.notify_all()
+    if img is None: self._finish(job)
+    return job
+
+  def flush(self, stream):
+    """Waits until the frames submitted for stream have been delivered."""
+    self.submit(None, stream=stream).wait()
+
+  def DetectWithImage(self, img):
+    return self.submit(img).wait()
+
+  def DetectWithImages(self, imgs):
+    """Embeds several frames in parallel across the backends."""
+    jobs = [self.submit(img) for img in imgs]
+    return [job.wait() for job in jobs]
+
+  def _work(self, index):
+    backend = self._backends[index]
+    queue = self._queues[index]
+    while True:
+      with self._cond:
+        while self._running and not queue:
+          self._cond.wait()
+        if not self._running: return
+        job = queue.popleft()
+      start = time.perf_counter()
+      try:
+        job.result = backend.run(job.img)
+      except Exception as e:
+        job.error = e
+      elapsed = time.perf_counter() - start
+      job.img = None
+      with self._cond:
+        self._load[index] -= 1
+        self._jobs[index] += 1
+        self._busy[index] += elapsed
+      self._finish(job)
+
+  def _finish(self, job):
+    """Marks a job finished and delivers whatever is now in order."""
+    if job.stream is None:
+      self._deliver(job)
+      return
+    with self._cond:
+      job.finished = True
+      ordered = self._streams[job.stream]
+      # Another thread is delivering this stream and will get to the job.
+      if ordered.delivering: return
+      ordered.delivering = True
+    while True:
+      with self._cond:
+        if not ordered.jobs or not ordered.jobs[0].finished:
+          ordered.delivering = False
+          return
+        head = ordered.jobs.popleft()
+        self._cond.notify_all()
+      self._deliver(head)
+
+  def _deliver(self, job):
+    if job.callback is not None and job.error is not None:
+      sys.stderr.write('Inference failed: %s\n' % job.error)
+    elif job.callback is not None:
+      try:
+        job.callback(job.result)
+      except Exception:
+        traceback.print_exc(file=sys.stderr)
+    job.done.set()
+
+  def stats(self):
+    """Returns per backend the jobs run, busy seconds and utilization."""
+    elapsed = max(time.time() - self._start, 1e-9)
+    with self._cond:
+      return [{'name': backend.name, 'jobs': self._jobs[i],
+               'busy': self._busy[i], 'utilization': self._busy[i]/elapsed,
+               'queued': self._load[i]}
+              for i, backend in enumerate(self._backends)]
+
+  def close(self):
+    """Stops the workers and closes the backends."""
+    with self._cond:
+      self._running = False
+      self._cond.notify_all()
+    for thread in self._threads: thread.join()
+    for backend in self._backends: backend.close()
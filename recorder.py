@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Records what the demo sees, to look into misclassifications later.
+
+teachable.py --record DIR keeps, for every frame, a downsampled copy of it,
+its embedding (when one was computed), the class shown, the buttons and the
+time, in compressed segment files of DIR; the oldest segments are deleted
+to stay within --recordmb. Summarize a recording with:
+
+  python3 recorder.py DIR
+
+and read it back for analysis with readRecording(DIR), which yields one
+dict per frame.
+"""
+
+import argparse
+import glob
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+import numpy as np
+
+SEGMENT_PATTERN = 'segment-%08d.npz'
+NO_LABEL = -1
+
+
+def segmentPaths(path):
+  """Returns the segment files of a recording, oldest first."""
+  return sorted(glob.glob(os.path.join(path, 'segment-*.npz')))
+
+
+class Recorder(object):
+  """Keeps frames, embeddings, labels and buttons in a ring buffer that a
+  writer thread saves in segments.
+
+     record() only copies into preallocated arrays, so it takes
+     microseconds and never waits on the disk. The writer thread saves
+     segment_frames frames at a time (or what it has every flush_interval
+     seconds) as a compressed .npz, and deletes the oldest segments beyond
+     max_bytes. When the writer falls behind by a whole ring, new frames
+     are dropped (and counted) rather than slowing the caller.
+  """
+
+  def __init__(self, path, factor=4, capacity=1024, segment_frames=256,
+               max_bytes=256 << 20, flush_interval=5.0):
+    """Args:
+      path: String, directory of the segment files; a recording already
+        there is continued.
+      factor: Int, frames are kept at 1/factor of their width and height.
+      capacity: Int, frames the ring buffer holds.
+      segment_frames: Int, frames per segment file.
+      max_bytes: Int, most bytes the segment files take together.
+      flush_interval: Float, seconds after which frames are saved even if
+        they do not fill a segment.
+    """
+    if not os.path.isdir(path): os.makedirs(path)
+    self._path = path
+    self._factor = max(1, factor)
+    self._capacity = capacity
+    self._segment_frames = min(segment_frames, capacity)
+    self._max_bytes = max_bytes
+    self._flush_interval = flush_interval
+    # Allocated by the first record(), which tells the sizes.
+    self._ring = None
+    # Frames [_tail, _head) are waiting for the writer, frames before
+    # _saved are on disk, and flush() wants frames before _flush saved.
+    self._head = self._tail = self._saved = self._flush = 0
+    self._cond = threading.Condition()
+    self._closing = False
+    self._counts = {'recorded': 0, 'dropped': 0, 'written': 0,
+                    'segments': 0, 'deleted': 0}
+    self._segments = deque((p, os.path.getsize(p)) for p in segmentPaths(path))
+    self._bytes = sum(size for _, size in self._segments)
+    self._next = (int(os.path.basename(self._segments[-1][0])[8:-4]) + 1
+                  if self._segments else 0)
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def downsample(self, img):
+    """Returns img at 1/factor of its size, as a view when it is an array."""
+    return np.asarray(img)[::self._factor, ::self._factor]
+
+  def _allocate(self, frame):
+    n = self._capacity
+    # The embeddings are added by the first frame that has one.
+    self._ring = {
+        'time': np.zeros(n, dtype=np.float64),
+        'frame': np.zeros((n,) + frame.shape, dtype=np.uint8),
+        'inferred': np.zeros(n, dtype=bool),
+        'label': np.zeros(n, dtype=np.int32),
+        'buttons': np.zeros((n, 8), dtype=bool),
+    }
+
+  def record(self, img, emb, label, buttons, timestamp=None,
+             downsampled=False):
+    """Adds a frame to the ring buffer.
+
+    Args:
+      img: The frame, an HxWx3 array or PIL image.
+      emb: Its embedding, or None if it reused an earlier result.
+      label: Int, the class shown, or None.
+      buttons: The debounced button states (at most 8).
+      timestamp: Float, time.time() of the frame, by default now.
+      downsampled: Bool, whether img is already a downsample() of the frame.
+    """
+    frame = np.asarray(img) if downsampled else self.downsample(img)
+    with self._cond:
+      if self._ring is None: self._allocate(frame)
+      ring = self._ring
+      if emb is not None and 'embedding' not in ring:
+        ring['embedding'] = np.zeros((self._capacity, np.size(emb)),
+                                     dtype=np.float32)
+      if (self._head - self._tail >= self._capacity or
+          frame.shape != ring['frame'].shape[1:]):
+        self._counts['dropped'] += 1
+        return
+      slot = self._head % self._capacity
+      ring['time'][slot] = time.time() if timestamp is None else timestamp
+      ring['frame'][slot] = frame
+      inferred = (emb is not None and
+                  np.size(emb) == ring['embedding'].shape[1])
+      ring['inferred'][slot] = inferred
+      if inferred: ring['embedding'][slot] = np.ravel(emb)
+      ring['label'][slot] = NO_LABEL if label is None else label
+      ring['buttons'][slot] = False
+      ring['buttons'][slot, :len(buttons)] = buttons
+      self._head += 1
+      self._counts['recorded'] += 1
+      # Starts the writer's flush_interval, or has it write a segment.
+      if self._head - self._tail in (1, self._segment_frames):
+        self._cond.notify_all()
+
+  def _run(self):
+    while True:
+      with self._cond:
+        deadline = None
+        while (self._head - self._tail < self._segment_frames and
+               not self._closing and self._tail >= self._flush):
+          if self._head == self._tail:
+            deadline = None
+            self._cond.wait()
+          elif deadline is None:
+            deadline = time.time() + self._flush_interval
+          elif time.time() < deadline:
+            self._cond.wait(deadline - time.time())
+          else:
+            break
+        if self._head == self._tail:
+          if self._closing: return
+          continue
+        start = self._tail
+        end = min(self._head, start + self._segment_frames)
+        ring = dict(self._ring)
+      # The slots up to end are not written again until _tail moves past
+      # them, so they are copied out without the lock.
+      slots = np.arange(start, end) % self._capacity
+      arrays = dict((name, array[slots]) for name, array in ring.items())
+      with self._cond: self._tail = end
+      self._write(arrays)
+
+  def _write(self, arrays):
+    path = os.path.join(self._path, SEGMENT_PATTERN % self._next)
+    self._next += 1
+    with open(path + '.tmp', 'wb') as f: np.savez_compressed(f, **arrays)
+    os.rename(path + '.tmp', path)
+    size = os.path.getsize(path)
+    self._segments.append((path, size))
+    self._bytes += size
+    # The newest segment is kept even if it alone is over the budget.
+    while self._bytes > self._max_bytes and len(self._segments) > 1:
+      old, old_size = self._segments.popleft()
+      try:
+        os.remove(old)
+      except OSError:
+        pass
+      self._bytes -= old_size
+      self._counts['deleted'] += 1
+    with self._cond:
+      self._counts['written'] += len(arrays['time'])
+      self._counts['segments'] += 1
+      self._saved += len(arrays['time'])
+      self._cond.notify_all()
+
+  def flush(self):
+    """Waits until the frames recorded so far are saved."""
+    with self._cond:
+      self._flush = self._head
+      self._cond.notify_all()
+      while self._saved < self._flush and self._thread.is_alive():
+        self._cond.wait(0.1)
+
+  def close(self):
+    """Saves the frames still in the ring buffer and stops the writer."""
+    with self._cond:
+      self._closing = True
+      self._cond.notify()
+    self._thread.join()
+
+  def stats(self):
+    """Returns the frames recorded, dropped and written, segments written
+    and deleted, and the bytes on disk."""
+    with self._cond:
+      stats = dict(self._counts)
+      stats['bytes'] = self._bytes
+    return stats
+
+
+def readRecording(path, start=None, end=None):
+  """Yields the frames of a recording, oldest first, as dicts of time,
+  frame, embedding (None if the frame reused an earlier result), label
+  (None for no class) and buttons.
+
+  Segments are loaded one at a time, and ones deleted by a running
+  recorder meanwhile are skipped.
+
+  Args:
+    path: String, the recording directory.
+    start: Float, if set, skip frames before this time.time().
+    end: Float, if set, stop at frames from this time on.
+  """
+  for segment in segmentPaths(path):
+    try:
+      with np.load(segment) as data: arrays = dict(data.items())
+    except (IOError, OSError):
+      continue
+    times = arrays['time']
+    if end is not None and len(times) and times[0] >= end: return
+    for i in range(len(times)):
+      if start is not None and times[i] < start: continue
+      if end is not None and times[i] >= end: return
+      label = int(arrays['label'][i])
+      yield {'time': float(times[i]), 'frame': arrays['frame'][i],
+             'embedding': (arrays['embedding'][i]
+                           if arrays['inferred'][i] else None),
+             'label': None if label == NO_LABEL else label,
+             'buttons': arrays['buttons'][i]}
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('recording', help='Directory of a recording.')
+  args = parser.parse_args(argv[1:])
+  frames = inferred = presses = 0
+  first = last = None
+  labels = Counter()
+  pressed = None
+  for record in readRecording(args.recording):
+    frames += 1
+    inferred += record['embedding'] is not None
+    labels[record['label']] += 1
+    # Count presses, not the frames a button is held for.
+    if pressed is not None: presses += int((record['buttons'] & ~pressed).sum())
+    pressed = record['buttons']
+    if first is None: first = record['time']
+    last = record['time']
+  if not frames:
+    print('No frames recorded.')
+    return 1
+  print('%d frames (%d inferred) over %.1fs in %d segments, %d button presses'
+        % (frames, inferred, last - first, len(segmentPaths(args.recording)),
+           presses))
+  print('classes: ' + ', '.join('%s %d' % ('--' if label is None else label,
+                                           count)
+                                for label, count in labels.most_common()))
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Replays recorded frames through TeachableMachine.classify.
+
+Runs without a camera, a display or an Edge TPU: frames come from a
+directory of images, a raw RGB video file or a synthetic generator, buttons
+follow a script, and embeddings come from a deterministic stand-in for the
+model. Reports throughput and per-frame latency.
+
+Usage:
+  python3 replay.py --images frames/ --buttons 10:1,20:2,30:3
+  python3 replay.py --raw video.rgb --raw-size 640x480
+  python3 replay.py --synthetic 1000 --infer-ms 10
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from functools import partial
+
+import numpy as np
+from PIL import Image
+
+from backends import ReferenceBackend
+import buttons
+from embedding import (EmbeddingEngine, ImprintingEmbeddingEngine,
+                       KNNEmbeddingEngine)
+from gate import FrameGate
+import metrics
+from multistream import SharedKNNEngine
+from overlay import Overlay
+from pool import EnginePool, ProcessBackend
+from recorder import Recorder
+from schedule import DeadlineScheduler
+import teachable
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.ppm')
+
+
+class StandInBackend(ReferenceBackend):
+  """Deterministic replacement for the headless MobileNet.
+
+     Runs backends.ReferenceBackend; an optional sleep stands in for the
+     accelerator's inference time, which after throttle_after runs becomes
+     throttle_ms, like a device slowing down as it heats up.
+  """
+
+  def __init__(self, infer_ms=0.0, throttle_after=None, throttle_ms=0.0,
+               **kwargs):
+    ReferenceBackend.__init__(self, **kwargs)
+    self._infer_s = infer_ms/1000.0
+    self._throttle_after = throttle_after
+    self._throttle_s = throttle_ms/1000.0
+    self._runs = 0
+
+  def run(self, tensor):
+    emb = ReferenceBackend.run(self, tensor)
+    self._runs += 1
+    if self._throttle_after is not None and self._runs > self._throttle_after:
+      time.sleep(self._throttle_s)
+    elif self._infer_s:
+      time.sleep(self._infer_s)
+    return emb
+
+
+class StandInImprintingEngine(EmbeddingEngine):
+  """Stand-in for imprinting.DemoImprintingEngine.
+
+     Imprinting classifies by the closest normalized class mean, which is
+     what this computes on the stand-in embeddings.
+  """
+
+  def __init__(self, model_path, infer_ms=0.0):
+    EmbeddingEngine.__init__(self, model_path,
+                             backend=StandInBackend(infer_ms))
+    self.clear()
+
+  def clear(self):
+    self._sums = {}
+    self._example_count = 0
+
+  def addImage(self, img, label):
+    emb = self.DetectWithImage(img)
+    emb = emb/np.sqrt((emb**2).sum())
+    self._sums[label] = self._sums.get(label, 0) + emb
+    self._example_count += 1
+
+  def classify(self, img):
+    if self._example_count == 0: return None
+    emb = self.DetectWithImage(img)
+    labels = list(self._sums)
+    weights = np.stack([self._sums[l] for l in labels])
+    return labels[int(np.argmax(np.dot(weights, emb)))]
+
+  def exampleCount(self):
+    return self._example_count
+
+  def close(self):
+    pass
+
+
+class UI_Scripted(teachable.UI):
+  """UI whose buttons are pressed on given frame numbers.
+
+     The presses drive a buttons.SimulatedGpio, timed as if frames came at
+     FPS, so they are debounced like live presses but independently of the
+     replay speed.
+  """
+
+  FPS = 30.0
+
+  def __init__(self, script):
+    """Args:
+      script: Dict mapping frame number to the list of buttons pressed.
+    """
+    self._buttons = [None]*5
+    self._LEDs = [None]*5
+    self._script = script
+    super(UI_Scripted, self).__init__()
+    self._events = buttons.ButtonEvents(len(self._buttons),
+                                        self._debounce_interval)
+    self._gpio = buttons.SimulatedGpio(self._events, len(self._buttons))
+    self.frame = 0
+
+  @property
+  def frame(self):
+    return self._frame
+
+  @frame.setter
+  def frame(self, frame):
+    self._frame = frame
+    for button in self._script.get(frame, ()):
+      self._gpio.press(button, frame/self.FPS)
+
+  def setLED(self, index, state):
+    pass
+
+  def getButtonState(self):
+    pressed = self._script.get(self.frame, ())
+    return [i in pressed for i in range(len(self._buttons))]
+
+
+def parseButtons(text):
+  """Parses 'FRAME:BUTTON,...' into a dict of frame to pressed buttons."""
+  script = {}
+  for entry in filter(None, (text or '').split(',')):
+    frame, button = entry.split(':')
+    script.setdefault(int(frame), []).append(int(button))
+  return script
+
+
+def imageFrames(path, size):
+  """Yields the images of a directory, sorted by name, resized to size."""
+  for name in sorted(os.listdir(path)):
+    if not name.lower().endswith(IMAGE_EXTENSIONS): continue
+    with Image.open(os.path.join(path, name)) as img:
+      yield img.convert('RGB').resize(size, Image.NEAREST)
+
+
+def rawFrames(path, raw_size, size):
+  """Yields the frames of a raw rgb24 video file, resized to size."""
+  frame_bytes = raw_size[0]*raw_size[1]*3
+  with open(path, 'rb') as f:
+    while True:
+      data = f.read(frame_bytes)
+      if len(data) < frame_bytes: return
+      img = Image.frombytes('RGB', raw_size, data, 'raw')
+      yield img if raw_size == size else img.resize(size, Image.NEAREST)
+
+
+def syntheticFrames(count, size, scene_length=50, seed=0):
+  """Yields noisy frames of a few scenes that change every scene_length."""
+  rng = np.random.RandomState(seed)
+  scenes = rng.randint(0, 256, size=(8, 9, 16, 3)).astype(np.float32)
+  for i in range(count):
+    scene = scenes[(i//scene_length) % len(scenes)]
+    pixels = np.kron(scene, np.ones((size[1]//9 + 1, size[0]//16 + 1, 1)))
+    pixels = pixels[:size[1], :size[0]] + rng.randn(size[1], size[0], 3)*8
+    yield Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+
+
+def percentiles(latencies):
+  """Returns p50/p95/p99 of a list of seconds, in milliseconds."""
+  return dict(('p%d' % p, 1e3*float(np.percentile(latencies, p)))
+              for p in (50, 95, 99))
+
+
+def replay(machine, ui, frames, loops=1, fps=None):
+  """Feeds frames through machine.classify and returns per-frame latencies.
+
+  Frames are decoded before timing starts, so only classify and the overlay
+  rendering done by the pipeline are measured. With fps, frames come no
+  faster than a camera's would.
+  """
+  svg_overlay = Overlay((640, 480))
+  latencies = []
+  frame = 0
+  due = time.perf_counter()
+  for _ in range(loops):
+    for img in frames:
+      ui.frame = frame
+      if fps:
+        due += 1.0/fps
+        time.sleep(max(0.0, due - time.perf_counter()))
+      start = time.perf_counter()
+      done = machine.classify(img, svg_overlay)
+      render_start = metrics.start()
+      svg_overlay.render()
+      metrics.record('render', render_start)
+      latencies.append(time.perf_counter() - start)
+      frame += 1
+      if done: return latencies
+  return latencies
+
+
+def replayStreams(machines, uis, frames, loops=1):
+  """Replays frames through several machines at once, one thread each.
+
+  Like several cameras feeding machines that share a SharedKNNEngine.
+  Returns the latencies of all streams.
+  """
+  latencies = [[] for _ in machines]
+  def stream(index):
+    # Start the streams in different scenes.
+    offset = index*len(frames)//len(machines)
+    latencies[index] = replay(
+        machines[index], uis[index],
+        frames[offset:] + frames[:offset], loops)
+  threads = [threading.Thread(target=stream, args=(i,))
+             for i in range(len(machines))]
+  for thread in threads: thread.start()
+  for thread in threads: thread.join()
+  return sum(latencies, [])
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  source = parser.add_mutually_exclusive_group(required=True)
+  source.add_argument('--images', help='Directory of frames to replay.')
+  source.add_argument('--raw', help='Raw rgb24 video file to replay.')
+  source.add_argument('--synthetic', type=int,
+                      help='Number of synthetic frames to replay.')
+  parser.add_argument('--raw-size', default='640x480',
+                      help='WIDTHxHEIGHT of the frames of --raw.')
+  parser.add_argument('--appsink-size', default='224x224',
+                      help='WIDTHxHEIGHT frames are scaled to, like the '
+                      'pipeline\'s appsink.')
+  parser.add_argument('--pil', action='store_true',
+                      help='Pass frames as PIL images instead of arrays.')
+  parser.add_argument('--method', default='knn',
+                      choices=['knn', 'imprinting', 'imprinting-numpy'],
+                      help='Teachable machine to replay through.')
+  parser.add_argument('--buttons', default='',
+                      help='Button script, FRAME:BUTTON[,FRAME:BUTTON...].')
+  parser.add_argument('--infer-ms', type=float, default=0.0,
+                      help='Simulated inference time per embedding.')
+  parser.add_argument('--throttle-after', type=int, default=None,
+                      help='Embeddings after which inference slows down to '
+                      '--throttle-ms.')
+  parser.add_argument('--throttle-ms', type=float, default=0.0,
+                      help='Simulated inference time once throttled.')
+  parser.add_argument('--budget', type=float, default=None,
+                      help='Classification milliseconds per frame, see '
+                      'teachable.py --budget.')
+  parser.add_argument('--duty', type=float, default=None,
+                      help='Fraction of the frame time spent classifying, see '
+                      'teachable.py --duty.')
+  parser.add_argument('--max-stride', type=int, default=8,
+                      help='See teachable.py --maxstride.')
+  parser.add_argument('--fps', type=float, default=None,
+                      help='Feed frames at this rate instead of as fast as '
+                      'they are classified.')
+  parser.add_argument('--preload', type=int, default=0,
+                      help='Random examples to fill the kNN store with first, '
+                      'to make searching it cost something.')
+  parser.add_argument('--gate', type=float, default=None,
+                      help='FrameGate threshold, see teachable.py --gate.')
+  parser.add_argument('--refresh', type=int, default=30,
+                      help='FrameGate refresh interval in frames.')
+  parser.add_argument('--streams', type=int, default=1,
+                      help='Number of concurrent streams sharing one kNN '
+                      'engine, only for knn.')
+  parser.add_argument('--batch-wait', type=float, default=5.0,
+                      help='Milliseconds streams wait to batch, see '
+                      'teachable.py --batchwait.')
+  parser.add_argument('--pool', type=int, default=0,
+                      help='Embed frames in this many worker processes, '
+                      'only for knn.')
+  parser.add_argument('--record', default=None,
+                      help='Record the frames and results to this directory, '
+                      'see teachable.py --record.')
+  parser.add_argument('--loops', type=int, default=1,
+                      help='Number of times to replay the frames.')
+  parser.add_argument('--metrics', default=None,
+                      help='Write per-stage latency histograms to this file '
+                      '(Prometheus text if it ends in .prom, else JSON).')
+  parser.add_argument('--json', default=None,
+                      help='Also write the results to this file.')
+  parser.add_argument('--verbose', action='store_true',
+                      help='Keep the per-frame status output.')
+  args = parser.parse_args(argv[1:])
+
+  def size(text): return tuple(int(v) for v in text.split('x'))
+  appsink_size = size(args.appsink_size)
+  if args.images:
+    frames = list(imageFrames(args.images, appsink_size))
+  elif args.raw:
+    frames = list(rawFrames(args.raw, size(args.raw_size), appsink_size))
+  else:
+    frames = list(syntheticFrames(args.synthetic, appsink_size))
+  if not frames:
+    print('No frames to replay.')
+    return 1
+  if not args.pil:
+    # Like the pipeline, which hands over views of the appsink buffers.
+    frames = [np.asarray(img) for img in frames]
+
+  ui = UI_Scripted(parseButtons(args.buttons))
+  # Only checked for existence; the stand-in backend doesn't load it.
+  model = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models',
+                       'mobilenet_quant_v1_224_headless_edgetpu.tflite')
+  def makeGate():
+    return FrameGate(args.gate, args.refresh) if args.gate is not None else None
+  def makeScheduler(cheap):
+    if not (args.budget or args.duty): return None
+    return DeadlineScheduler(args.budget, args.duty, args.max_stride,
+                             cheap=cheap)
+  recorders = []
+  def makeRecorder(stream):
+    if not args.record: return None
+    recorders.append(Recorder(os.path.join(args.record, 'stream%d' % stream)
+                              if args.streams > 1 else args.record))
+    return recorders[-1]
+  def standIn():
+    return StandInBackend(args.infer_ms, args.throttle_after, args.throttle_ms)
+  if args.method != 'knn' and (args.streams > 1 or args.pool):
+    parser.error('--streams and --pool are only supported by the knn method.')
+  if (args.budget or args.duty) and (args.streams > 1 or args.pool):
+    parser.error('--budget and --duty cannot be combined with --streams or '
+                 '--pool.')
+  shared = pool = None
+  if args.pool:
+    pool = EnginePool([ProcessBackend(partial(
+        EmbeddingEngine, model, backend=standIn()))
+                       for _ in range(args.pool)])
+  if args.streams > 1:
+    engine = KNNEmbeddingEngine(model, backend=standIn())
+    shared = SharedKNNEngine(engine, args.streams, args.batch_wait/1000.0,
+                             embedder=pool)
+    # Only the first stream follows the button script.
+    uis = [ui] + [UI_Scripted({}) for _ in range(args.streams - 1)]
+    machines = [teachable.TeachableMachineKNN(
+        model, uis[i], engine=shared, gate=makeGate(), name='stream%d' % i,
+        recorder=makeRecorder(i))
+        for i in range(args.streams)]
+    machine = machines[0]
+  elif args.method == 'knn':
+    engine = KNNEmbeddingEngine(model, backend=standIn())
+    machine = teachable.TeachableMachineKNN(model, ui, engine=engine,
+                                            gate=makeGate(), pool=pool,
+                                            scheduler=makeScheduler(True),
+                                            recorder=makeRecorder(0))
+    rng = np.random.RandomState(0)
+    for i in range(args.preload):
+      engine.addEmbedding(rng.randn(engine.embeddingSize()), 1 + i % 4)
+  else:
+    if args.method == 'imprinting':
+      engine = StandInImprintingEngine(model, args.infer_ms)
+    else:
+      engine = ImprintingEmbeddingEngine(
+          model, backend=standIn())
+    machine = teachable.TeachableMachineImprinting(
+        model, ui, None, False, engine=engine, gate=makeGate(),
+        scheduler=makeScheduler(False), recorder=makeRecorder(0))
+
+  if args.metrics: metrics.enable()
+  stdout = sys.stdout
+  if not args.verbose: sys.stdout = open(os.devnull, 'w')
+  try:
+    start = time.perf_counter()
+    if shared is None:
+      latencies = replay(machine, ui, frames, args.loops, args.fps)
+      if pool is not None: pool.flush(machine)
+    else:
+      latencies = replayStreams(machines, uis, frames, args.loops)
+    elapsed = time.perf_counter() - start
+  finally:
+    for m in (machines if shared is not None else [machine]):
+      m.close()
+      m.flushLog()
+    for recorder in recorders: recorder.close()
+    if not args.verbose:
+      sys.stdout.close()
+      sys.stdout = stdout
+
+  results = {'method': args.method, 'frames': len(latencies),
+             'fps': len(latencies)/elapsed,
+             'examples': engine.exampleCount()}
+  results.update(percentiles(latencies))
+  print('%(method)s: %(frames)d frames, %(fps).1f fps, p50 %(p50).2f ms, '
+        'p95 %(p95).2f ms, p99 %(p99).2f ms, %(examples)d examples' % results)
+  if pool is not None:
+    pool.close()
+    results['backends'] = pool.stats()
+    for backend in results['backends']:
+      print('%(name)s: %(jobs)d frames, %(utilization).0f%% busy' %
+            dict(backend, utilization=100*backend['utilization']))
+  if shared is not None:
+    shared.stop()
+    results['batches'] = shared.stats()
+    print('batches: %(batches)d, mean size %(mean).2f, largest %(largest)d'
+          % results['batches'])
+  if args.gate is not None:
+    results['gate'] = machine.gateStats()
+    print('gate: %(inferred)d inferred, %(reused)d reused (hit rate '
+          '%(hit_rate).2f)' % results['gate'])
+  if recorders:
+    results['recorder'] = [recorder.stats() for recorder in recorders]
+    for stats in results['recorder']:
+      print('recorder: %(recorded)d frames, %(dropped)d dropped, %(segments)d '
+            'segments, %(bytes)d bytes' % stats)
+  if machine.schedulerStats() is not None:
+    results['scheduler'] = machine.schedulerStats()
+    print('scheduler: %(inferred)d inferred (%(exact)d exact, %(cheap)d '
+          'cheap, %(forced)d forced), %(skipped)d skipped, stride %(stride)d, '
+          '%(over_budget)d over budget' % results['scheduler'])
+  if args.metrics:
+    metrics.write(args.metrics)
+    print('stages (mean ms): ' + ', '.join(
+        '%s %.3f' % (stage, 1e3*histogram.sum/histogram.count)
+        for stage, histogram in sorted(metrics.enable().snapshot().items())))
+  if args.json:
+    with open(args.json, 'w') as f: json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
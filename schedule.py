@@ -0,0 +1,173 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Classifies only as many frames as a time budget allows."""
+import math
+import time
+
+PATHS = ('exact', 'cheap')
+
+
+class DeadlineScheduler(object):
+  """Decides per frame whether, and how, to classify it within a budget.
+
+     The time classifying a frame takes is measured on each of two paths,
+     the exact one and a cheaper approximation, as moving averages. The
+     budget is budget_ms per frame, or the duty fraction of the time
+     between frames (e.g. to bound the power drawn), or the smaller of
+     both. When a classification costs more than that, only every
+     stride-th frame is classified, stride being the cost over the budget
+     rounded up, and the frames in between reuse the last result. The
+     cheap path is taken when it allows a shorter stride; the path not in
+     use is measured again every probe_every classifications, since what
+     it costs changes, e.g. when the CPU throttles. A probe replaces the
+     estimate rather than averaging into it, and a path is measured twice
+     before it is judged, the first run often paying for a warm up.
+
+     Frames with a button pressed are classified right away on the exact
+     path, and so is the frame after them, since the examples changed.
+  """
+
+  def __init__(self, budget_ms=None, duty=None, max_stride=8, smoothing=4,
+               cheap=True, alpha=0.2, probe_every=50, clock=time.perf_counter):
+    """Args:
+      budget_ms: Float, milliseconds of classification per frame, or None.
+      duty: Float, fraction of the time between frames spent classifying,
+        or None.
+      max_stride: Int, most frames one classification stands for.
+      smoothing: Int, classifications the smoothing vote spans, see
+        window().
+      cheap: Bool, whether the caller has a cheap path.
+      alpha: Float, weight of a new measurement in the moving averages.
+      probe_every: Int, classifications after which the path not in use is
+        measured again.
+      clock: Function returning the time in seconds.
+
+    Raises:
+      ValueError: Neither budget_ms nor duty is given.
+    """
+    if budget_ms is None and duty is None:
+      raise ValueError('A budget_ms or a duty is needed.')
+    self._budget_s = budget_ms/1000.0 if budget_ms is not None else None
+    self._duty = duty
+    self._max_stride = max(1, max_stride)
+    self._smoothing = max(1, smoothing)
+    self._paths = PATHS if cheap else PATHS[:1]
+    self._alpha = alpha
+    self._probe_every = max(1, probe_every)
+    self._clock = clock
+    self._cost = dict((path, None) for path in self._paths)
+    self._samples = dict((path, 0) for path in self._paths)
+    self._interval = None
+    self._last = None
+    self._path = 'exact'
+    self._stride = 1
+    self._age = 0
+    self._due = False
+    self._since_probe = 0
+    self._counts = {'frames': 0, 'inferred': 0, 'skipped': 0, 'forced': 0,
+                    'exact': 0, 'cheap': 0, 'over_budget': 0}
+
+  def _average(self, old, new):
+    return new if old is None else old + self._alpha*(new - old)
+
+  def budget(self):
+    """Returns the seconds of classification allowed per frame, None while
+    a duty budget still waits for the time between frames."""
+    budgets = []
+    if self._budget_s is not None: budgets.append(self._budget_s)
+    if self._duty is not None and self._interval is not None:
+      budgets.append(self._duty*self._interval)
+    return min(budgets) if budgets else None
+
+  def check(self, buttons=()):
+    """Returns how to classify the current frame: 'exact', 'cheap', or None
+    to reuse the last result.
+
+    Args:
+      buttons: The debounced button states of the frame.
+    """
+    now = self._clock()
+    if self._last is not None:
+      self._interval = self._average(self._interval, now - self._last)
+    self._last = now
+    self._counts['frames'] += 1
+    self._age += 1
+    pressed = any(buttons)
+    if pressed or self._due:
+      self._due = pressed
+      self._counts['forced'] += 1
+      return self._infer('exact')
+    if self._age < self._stride:
+      self._counts['skipped'] += 1
+      return None
+    path = self._path
+    self._since_probe += 1
+    other = [p for p in self._paths if p != path]
+    if other and (self._since_probe >= self._probe_every or
+                  (self._samples[other[0]] < 2 and self._stride > 1)):
+      # Measure the other path, it may have become the better one.
+      self._since_probe = 0
+      path = other[0]
+    return self._infer(path)
+
+  def _infer(self, path):
+    self._age = 0
+    self._counts['inferred'] += 1
+    self._counts[path] += 1
+    return path
+
+  def record(self, path, seconds):
+    """Takes the time a classification on a path took and adapts the stride
+    and path to it."""
+    self._samples[path] += 1
+    if path == self._path:
+      self._cost[path] = self._average(self._cost[path], seconds)
+    else:
+      self._cost[path] = seconds
+    budget = self.budget()
+    if budget is not None and seconds > budget*self._stride:
+      self._counts['over_budget'] += 1
+    if budget is None: return
+    strides = dict((p, self._strideFor(cost, budget))
+                   for p, cost in self._cost.items() if cost is not None)
+    # Exact unless the cheap path gets to classify more frames.
+    self._path = min(strides, key=lambda p: (strides[p], PATHS.index(p)))
+    self._stride = strides[self._path]
+
+  def _strideFor(self, cost, budget):
+    if budget <= 0: return self._max_stride
+    return min(self._max_stride, max(1, int(math.ceil(cost/budget - 1e-9))))
+
+  def stride(self):
+    """Returns the number of frames a classification currently stands for."""
+    return self._stride
+
+  def window(self):
+    """Returns the frames a smoothing vote should span: smoothing
+    classifications at the current stride, so that it rejects as much
+    noise as unthrottled."""
+    return self._smoothing*self._stride
+
+  def stats(self):
+    """Returns the counters, the stride, the path and the mean cost in
+    milliseconds of each path measured."""
+    stats = dict(self._counts)
+    stats['stride'] = self._stride
+    stats['path'] = self._path
+    budget = self.budget()
+    stats['budget_ms'] = 1e3*budget if budget is not None else None
+    for path, cost in self._cost.items():
+      stats['%s_ms' % path] = 1e3*cost if cost is not None else None
+    return stats
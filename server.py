@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Serves the kNN engine to other processes on the host.
+
+Usage:
+  python3 server.py --port 8765                  # http://127.0.0.1:8765
+  python3 server.py --unix /tmp/teachable.sock   # HTTP over a Unix socket
+
+Endpoints (HTTP/1.1 with keep-alive):
+
+  POST /classify     A frame or an embedding; answers {"label": L,
+                     "name": NAME}.
+  POST /add_example  A frame or an embedding and a class id or name
+                     (?label=L, or "label" in JSON); answers
+                     {"examples": N}. New names get the next free class
+                     ids, see labels.py.
+  POST /clear        Forgets all examples.
+  GET  /stats        Request, batch and latency counters.
+
+A frame or embedding is sent as JSON, {"embedding": [...]} or {"frame":
+base64 RGB bytes, "width": W, "height": H}, or raw: Content-Type
+application/x-float32 for a little endian float32 embedding, image/x-rgb
+with ?width=W&height=H for RGB pixels.
+
+Requests arriving within --batchwait milliseconds of each other are handled
+as one batch on the engine thread: their frames are embedded together and
+runs of classifications are searched together, in arrival order with the
+examples added and cleared in between.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+import numpy as np
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+            405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class _Item(object):
+  __slots__ = ('kind', 'frame', 'emb', 'label', 'future')
+
+  def __init__(self, kind, frame=None, emb=None, label=None):
+    self.kind = kind
+    self.frame = frame
+    self.emb = emb
+    self.label = label
+    self.future = None
+
+
+class MicroBatcher(object):
+  """Collects items submitted by coroutines into batches.
+
+     The first waiting item opens a batch, which takes whatever else
+     arrives within max_wait (up to max_batch items) and is then handed to
+     function(items) on the executor. One batch runs at a time; items that
+     arrive meanwhile make up the next one.
+  """
+
+  def __init__(self, function, max_batch=32, max_wait=0.002, executor=None):
+    self._function = function
+    self._max_batch = max(1, max_batch)
+    self._max_wait = max_wait
+    self._executor = executor or ThreadPoolExecutor(1)
+    self._queue = asyncio.Queue()
+    self._counts = {'items': 0, 'batches': 0, 'largest': 0}
+    self._task = asyncio.ensure_future(self._run())
+
+  async def submit(self, item):
+    """Queues item and returns function's result for it."""
+    item.future = asyncio.get_event_loop().create_future()
+    await self._queue.put(item)
+    return await item.future
+
+  async def _run(self):
+    loop = asyncio.get_event_loop()
+    while True:
+      batch = [await self._queue.get()]
+      deadline = loop.time() + self._max_wait
+      while len(batch) < self._max_batch:
+        if not self._queue.empty():
+          batch.append(self._queue.get_nowait())
+          continue
+        remaining = deadline - loop.time()
+        if remaining <= 0: break
+        try:
+          batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+        except asyncio.TimeoutError:
+          break
+      self._counts['items'] += len(batch)
+      self._counts['batches'] += 1
+      self._counts['largest'] = max(self._counts['largest'], len(batch))
+      try:
+        results = await loop.run_in_executor(self._executor, self._function,
+                                             batch)
+        for item, result in zip(batch, results): item.future.set_result(result)
+      except Exception as e:
+        for item in batch:
+          if not item.future.done(): item.future.set_exception(e)
+
+  def stats(self):
+    """Returns the counters and the mean batch size."""
+    stats = dict(self._counts)
+    stats['mean'] = (float(stats['items'])/stats['batches']
+                     if stats['batches'] else 0.0)
+    return stats
+
+  async def stop(self):
+    """Stops batching; items still queued are not run."""
+    self._task.cancel()
+    try:
+      await self._task
+    except asyncio.CancelledError:
+      pass
+
+
+class Server(object):
+  """Answers HTTP requests with a KNNEmbeddingEngine."""
+
+  def __init__(self, engine, max_batch=32, max_wait=0.002):
+    self._engine = engine
+    self._batcher = MicroBatcher(self._process, max_batch, max_wait)
+    self._counts = dict((name, 0) for name in
+                        ('classify', 'add_example', 'clear', 'stats',
+                         'errors'))
+    self._latencies = deque(maxlen=10000)
+
+  def _process(self, items):
+    """Runs a batch on the engine thread; returns one result per item."""
+    frames = [item for item in items if item.frame is not None]
+    if frames:
+      embs = self._engine.DetectWithImages([item.frame for item in frames])
+      for item, emb in zip(frames, embs): item.emb = emb
+    results = [None]*len(items)
+    queries = []
+    registry = self._engine.labelRegistry()
+    def search():
+      labels = self._engine.kNNEmbeddings([items[i].emb for i in queries])
+      for i, label in zip(queries, labels):
+        results[i] = {'label': label, 'name': registry.name(label)}
+      del queries[:]
+    for i, item in enumerate(items):
+      if item.kind == 'classify':
+        queries.append(i)
+        continue
+      if queries: search()
+      if item.kind == 'add_example':
+        self._engine.addEmbedding(item.emb, item.label)
+      else:
+        self._engine.clear()
+      results[i] = {'examples': self._engine.exampleCount()}
+    if queries: search()
+    return results
+
+  def _parseItem(self, kind, headers, params, body):
+    """Returns the _Item of a classify or add_example request."""
+    content_type = headers.get('content-type', '').split(';')[0].strip()
+    label = params.get('label')
+    item = _Item(kind)
+    if content_type == 'application/x-float32':
+      item.emb = np.frombuffer(body, dtype='<f4')
+    elif content_type == 'image/x-rgb':
+      width, height = int(params['width']), int(params['height'])
+      item.frame = np.frombuffer(body, dtype=np.uint8).reshape(
+          height, width, 3)
+    else:
+      request = json.loads(body.decode('utf-8'))
+      label = request.get('label', label)
+      if 'embedding' in request:
+        item.emb = np.array(request['embedding'], dtype=np.float32)
+      elif 'frame' in request:
+        item.frame = np.frombuffer(
+            base64.b64decode(request['frame']), dtype=np.uint8).reshape(
+                int(request['height']), int(request['width']), 3)
+      else:
+        raise ValueError('Expected an embedding or a frame')
+    if item.emb is not None and item.emb.size != self._engine.embeddingSize():
+      raise ValueError('Expected an embedding of %d values'
+                       % self._engine.embeddingSize())
+    if kind == 'add_example':
+      if label is None: raise ValueError('Expected a label')
+      item.label = self._engine.labelRegistry().id(label)
+    return item
+
+  async def _respond(self, method, path, headers, params, body):
+    """Returns the status and JSON answer of a request."""
+    endpoint = path.strip('/')
+    if endpoint == 'stats':
+      self._counts['stats'] += 1
+      return 200, self.stats()
+    if endpoint not in ('classify', 'add_example', 'clear'):
+      return 404, {'error': 'Unknown endpoint %s' % path}
+    if method != 'POST':
+      return 405, {'error': '%s needs POST' % path}
+    self._counts[endpoint] += 1
+    if endpoint == 'clear': item = _Item('clear')
+    else: item = self._parseItem(endpoint, headers, params, body)
+    return 200, await self._batcher.submit(item)
+
+  async def handle(self, reader, writer):
+    """Serves the requests of one connection."""
+    try:
+      while True:
+        line = await reader.readline()
+        if not line: break
+        start = time.perf_counter()
+        method, target, _ = line.decode('latin-1').split(None, 2)
+        headers = {}
+        while True:
+          header = await reader.readline()
+          if header in (b'\r\n', b'\n', b''): break
+          name, _, value = header.decode('latin-1').partition(':')
+          headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        body = await reader.readexactly(length) if length else b''
+        path, _, query = target.partition('?')
+        try:
+          status, answer = await self._respond(method, path, headers,
+                                               dict(parse_qsl(query)), body)
+        except (ValueError, KeyError, TypeError) as e:
+          status, answer = 400, {'error': str(e)}
+        except Exception as e:
+          status, answer = 500, {'error': str(e)}
+        if status != 200: self._counts['errors'] += 1
+        payload = json.dumps(answer).encode('utf-8')
+        writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n'
+                      'Content-Length: %d\r\n\r\n' % (
+                          status, _REASONS[status], len(payload))
+                     ).encode('latin-1') + payload)
+        await writer.drain()
+        self._latencies.append(time.perf_counter() - start)
+        if headers.get('connection', '').lower() == 'close': break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+      pass
+    finally:
+      writer.close()
+
+  def stats(self):
+    """Returns the request and batch counters and latency percentiles."""
+    stats = {'requests': dict(self._counts),
+             'batches': self._batcher.stats(),
+             'examples': self._engine.exampleCount(),
+             'embedding_size': self._engine.embeddingSize(),
+             'image_size': list(self._engine.requiredImageSize())}
+    if self._latencies:
+      latencies = np.array(self._latencies)
+      stats['latency_ms'] = dict(('p%d' % p, 1e3*float(np.percentile(
+          latencies, p))) for p in (50, 95, 99))
+    return stats
+
+  async def close(self):
+    await self._batcher.stop()
+
+
+def serve(engine, port=8765, unix=None, max_batch=32, max_wait=0.002):
+  """Serves engine until interrupted, on a Unix socket if unix is set and
+  on 127.0.0.1:port otherwise."""
+  loop = asyncio.get_event_loop()
+  server = Server(engine, max_batch, max_wait)
+  if unix:
+    listener = loop.run_until_complete(
+        asyncio.start_unix_server(server.handle, path=unix))
+    print('Serving on %s' % unix)
+  else:
+    listener = loop.run_until_complete(
+        asyncio.start_server(server.handle, '127.0.0.1', port))
+    print('Serving on http://127.0.0.1:%d' % port)
+  try:
+    loop.run_forever()
+  except KeyboardInterrupt:
+    pass
+  listener.close()
+  loop.run_until_complete(listener.wait_closed())
+  loop.run_until_complete(server.close())
+  print('Stats: ', server.stats())
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--model', help='File path of Tflite model.',
+                      default='models/mobilenet_quant_v1_224_headless_edgetpu.tflite')
+  parser.add_argument('--backend', default='edgetpu',
+                      choices=['edgetpu', 'cpu', 'reference'],
+                      help='What runs the model, see teachable.py.')
+  parser.add_argument('--port', type=int, default=8765,
+                      help='Port to serve on, on 127.0.0.1.')
+  parser.add_argument('--unix', default=None,
+                      help='Serve on this Unix socket instead of a port.')
+  parser.add_argument('--batchwait', type=float, default=2.0,
+                      help='Milliseconds to wait for more requests to batch with.')
+  parser.add_argument('--maxbatch', type=int, default=32,
+                      help='Most requests handled in one batch.')
+  parser.add_argument('--store', default=None,
+                      help='Directory to keep the examples in across restarts.')
+  parser.add_argument('--capacity', type=int, default=None,
+                      help='Keep at most this many examples in total.')
+  parser.add_argument('--classcapacity', type=int, default=None,
+                      help='Keep at most this many examples per class.')
+  parser.add_argument('--policy', default='reservoir',
+                      choices=['reservoir', 'prune', 'kmeans'],
+                      help='Which examples a store at capacity keeps, see bounded.py.')
+  args = parser.parse_args(argv[1:])
+
+  from embedding import KNNEmbeddingEngine
+  engine = KNNEmbeddingEngine(args.model, store_path=args.store,
+                              backend=args.backend, capacity=args.capacity,
+                              class_capacity=args.classcapacity,
+                              policy=args.policy)
+  serve(engine, args.port, args.unix, args.maxbatch, args.batchwait/1000.0)
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv))
@@ -0,0 +1,275 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shares the kNN examples between the processes of a host.
+
+One process, the writer, teaches; any number of readers classify with the
+same examples, memory-mapped from one file. The examples are taught once
+and take the same memory however many processes use them. Keep the file on
+a tmpfs such as /dev/shm to keep it off the disk.
+
+The file is a header followed by fixed size arrays of encoded rows, their
+scales and their labels. The header holds, as uint64 words:
+
+  magic, dtype, dim, capacity, generation, count, moved
+
+The writer encodes a new example into row `count`, then increments count
+and, last, generation. Before each query a reader compares generation with
+the one it last saw, a single read of the mapping; when it moved, the
+reader takes in the rows from the count it last saw up to count, which are
+complete and never change again. Neither side takes a lock.
+
+When the rows are full, and on clear, the writer builds a new file, renames
+it over the old one and sets `moved` in the old one before bumping its
+generation, upon which the readers map the new file. Rows a reader is still
+scanning stay mapped until it lets go of the old file.
+"""
+
+import fcntl
+import os
+
+import numpy as np
+
+import compress
+from store import EmbeddingStore
+
+_MAGIC = b'TMS1\0\0\0\0'
+_HEADER_BYTES = 64
+# Words of the header.
+_DTYPE, _DIM, _CAPACITY, _GENERATION, _COUNT, _MOVED = range(1, 7)
+
+
+def _align(size):
+  return (size + 63) // 64 * 64
+
+
+def _layout(dtype, dim, capacity):
+  """Returns the offsets of the rows, scales and labels and the file size."""
+  rows = _HEADER_BYTES
+  scales = rows + _align(capacity*dim*np.dtype(dtype).itemsize)
+  labels = scales + _align(4*capacity)
+  return rows, scales, labels, labels + _align(4*capacity)
+
+
+class _Mapping(object):
+  """The header and arrays of one store file, memory-mapped."""
+
+  def __init__(self, path, writable):
+    mode = 'r+' if writable else 'r'
+    self.header = np.memmap(path, dtype=np.uint64, mode=mode, shape=(8,))
+    if self.header[:1].tobytes() != _MAGIC:
+      raise ValueError('%s is not a shared store' % path)
+    self.dtype = compress.DTYPES[int(self.header[_DTYPE])]
+    self.dim = int(self.header[_DIM])
+    self.capacity = int(self.header[_CAPACITY])
+    rows, scales, labels, _ = _layout(self.dtype, self.dim, self.capacity)
+    self.rows = np.memmap(path, dtype=self.dtype, mode=mode, offset=rows,
+                          shape=(self.capacity, self.dim))
+    self.scales = np.memmap(path, dtype=np.float32, mode=mode, offset=scales,
+                            shape=(self.capacity,))
+    self.labels = np.memmap(path, dtype=np.int32, mode=mode, offset=labels,
+                            shape=(self.capacity,))
+
+
+def _create(path, dtype, dim, capacity):
+  """Writes an empty store file and returns its writable mapping."""
+  with open(path, 'wb') as f: f.truncate(_layout(dtype, dim, capacity)[3])
+  header = np.memmap(path, dtype=np.uint64, mode='r+', shape=(8,))
+  header[0] = np.frombuffer(_MAGIC, dtype=np.uint64)[0]
+  header[_DTYPE] = compress.DTYPES.index(dtype)
+  header[_DIM] = dim
+  header[_CAPACITY] = capacity
+  header[_GENERATION] = 1
+  header.flush()
+  del header
+  return _Mapping(path, True)
+
+
+class SharedStore(object):
+  """An EmbeddingStore whose rows live in a file shared by processes.
+
+     Offers the add/query/queryBatch/neighbors/clear interface of
+     EmbeddingStore; only the writer may add and clear. The writer holds an
+     exclusive lock on path + '.lock', so there is one at a time. Readers
+     may start before the writer has created the file: they see no examples
+     until it has.
+  """
+
+  def __init__(self, path, kNN=3, dtype='float32', writer=True,
+               capacity=1024):
+    """Opens a shared store.
+
+    Args:
+      path: String, the store file.
+      kNN: Int, number of neighbors used when voting.
+      dtype: String, storage type of the rows of a new file, one of
+        compress.DTYPES. Readers use the type the file has.
+      writer: Bool, whether this process teaches.
+      capacity: Int, number of rows of a new file, doubled when full.
+
+    Raises:
+      ValueError: The file is not a shared store, or the writer asked for
+        a dtype other than the file's.
+      RuntimeError: Another process is the writer.
+    """
+    if dtype not in compress.DTYPES:
+      raise ValueError('Unsupported store dtype %s' % dtype)
+    self._path = path
+    self._kNN = kNN
+    self._dtype = dtype
+    self._writer = writer
+    self._capacity = max(1, capacity)
+    self._mapping = None
+    self._generation = None
+    self._store = EmbeddingStore(kNN, dtype=dtype)
+    self._lock = None
+    if writer:
+      self._lock = open(path + '.lock', 'w')
+      try:
+        fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except (IOError, OSError):
+        self._lock.close()
+        raise RuntimeError('Another process is the writer of %s' % path)
+    try:
+      self._refresh()
+      if writer and self._mapping is not None and self._mapping.dtype != dtype:
+        raise ValueError('%s holds %s rows' % (path, self._mapping.dtype))
+    except:
+      # Not left holding the writer lock.
+      self.close()
+      raise
+
+  def _open(self):
+    mapping = _Mapping(self._path, self._writer)
+    if mapping.dtype != self._store.dtype():
+      self._store = EmbeddingStore(self._kNN, dtype=mapping.dtype)
+    self._mapping = mapping
+    self._generation = None
+
+  def _refresh(self):
+    """Catches up with the writer; one read of the header if nothing
+    changed."""
+    if self._mapping is None:
+      if not os.path.exists(self._path): return
+      self._open()
+    header = self._mapping.header
+    generation = int(header[_GENERATION])
+    if generation == self._generation: return
+    if header[_MOVED]:
+      self._mapping = None
+      self._refresh()
+      return
+    # Read after generation: the rows below count are at least as new.
+    count = int(header[_COUNT])
+    mapping = self._mapping
+    if self._generation is None:
+      # A file not seen before, e.g. after a clear or a move.
+      self._store.load(mapping.rows[:count], mapping.labels[:count],
+                       mapping.scales[:count])
+    else:
+      # Rows are only ever appended to a file: take in the new ones.
+      self._store.extend(mapping.rows[:count], mapping.labels[:count],
+                         mapping.scales[:count])
+    self._generation = generation
+
+  def _replace(self, dim, capacity, keep):
+    """Moves the first keep rows into a new file and sends the readers
+    there."""
+    old = self._mapping
+    tmp = self._path + '.tmp'
+    new = _create(tmp, self._dtype, dim, capacity)
+    if keep:
+      new.rows[:keep] = old.rows[:keep]
+      new.scales[:keep] = old.scales[:keep]
+      new.labels[:keep] = old.labels[:keep]
+      new.header[_COUNT] = keep
+    os.rename(tmp, self._path)
+    if old is not None:
+      old.header[_MOVED] = 1
+      old.header[_GENERATION] += 1
+    self._mapping = new
+    self._generation = None
+    return new
+
+  def _checkWriter(self):
+    if not self._writer:
+      raise ValueError('Only the writer of %s can change it' % self._path)
+
+  def add(self, emb, label):
+    """Normalizes an embedding, appends it under a label and publishes it."""
+    self._checkWriter()
+    emb = self._store.prepare(emb)
+    mapping = self._mapping
+    if mapping is None:
+      mapping = self._replace(emb.shape[0], self._capacity, 0)
+    elif emb.shape[0] != mapping.dim:
+      raise ValueError('Expected an embedding of %d values' % mapping.dim)
+    count = int(mapping.header[_COUNT])
+    if count == mapping.capacity:
+      mapping = self._replace(mapping.dim, 2*mapping.capacity, count)
+    compress.encode(emb[np.newaxis], self._dtype,
+                    mapping.rows[count:count + 1],
+                    mapping.scales[count:count + 1])
+    mapping.labels[count] = label
+    # The row is complete before readers may look at it.
+    mapping.header[_COUNT] = count + 1
+    mapping.header[_GENERATION] += 1
+
+  def clear(self):
+    """Forgets all examples, for the readers too."""
+    self._checkWriter()
+    if self._mapping is not None:
+      self._replace(self._mapping.dim, self._capacity, 0)
+    self._store.clear()
+
+  def generation(self):
+    """Returns the generation of the examples this process last saw."""
+    return self._generation
+
+  def close(self):
+    """Lets go of the file and, for the writer, of the writer lock."""
+    self._mapping = None
+    self._store.clear()
+    if self._lock is not None:
+      self._lock.close()
+      self._lock = None
+
+  def query(self, query_emb):
+    self._refresh()
+    return self._store.query(query_emb)
+
+  def queryBatch(self, query_embs):
+    self._refresh()
+    return self._store.queryBatch(query_embs)
+
+  def neighbors(self, query_emb, count):
+    self._refresh()
+    return self._store.neighbors(query_emb, count)
+
+  def embeddings(self):
+    self._refresh()
+    return self._store.embeddings()
+
+  def labels(self):
+    self._refresh()
+    return self._store.labels()
+
+  def nbytes(self):
+    """Returns the bytes this process allocates; the mapped rows are not
+    counted."""
+    return self._store.nbytes()
+
+  def __len__(self):
+    self._refresh()
+    return len(self._store)
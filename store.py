@@ -0,0 +1,523 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Array-backed embedding store used by the kNN engine."""
+import compress
+import numpy as np
+
+# Bytes of float32 copy kept of int8/float16 rows, see _decodedRows(). NumPy
+# upcasts float16 one element at a time, so scoring the codes directly costs
+# up to ~35x a float32 product; below this size the copy is cheap to keep.
+_DECODED_BYTES = 16 << 20
+
+
+class EmbeddingStore(object):
+  """Preallocated, capacity-doubling store of normalized embeddings.
+
+     Embeddings live in one contiguous matrix and labels in a parallel
+     integer array, so adding an example is an amortized O(1) row copy and a
+     query is a single matrix-vector product over a view of the filled rows.
+
+     Classes with fewer than kNN examples used to be padded (by reflection)
+     up to kNN rows so that classes with more examples would not unfairly win
+     the vote. The store keeps that rule but applies it at query time: each
+     row carries the number of times it would have appeared in the padded
+     block, and votes are weighted accordingly.
+
+     To save memory rows can be kept as float16 or as int8 with a per-row
+     scale, and can be projected to fewer dimensions (see compress.py)
+     before they are stored and compared. While such a store is small it
+     also keeps the rows decoded to float32, which are scored much faster;
+     past _DECODED_BYTES it scores the codes in chunks.
+
+     The leading rows may instead live in a read-only base array, typically
+     a np.memmap of a snapshot on disk (see load() and persist.py); only
+     examples added afterwards are held in the growable in-memory matrix.
+  """
+
+  def __init__(self, kNN=3, capacity=64, index=None, dtype='float32',
+               projection=None):
+    """Creates an empty store.
+
+    Args:
+      kNN: Int, number of neighbors used when voting.
+      capacity: Int, number of rows to allocate on the first add.
+      index: Optional approximate index (e.g. ivf.IVFIndex) used to select
+        candidate rows instead of scanning the whole store.
+      dtype: String, storage type of the rows, one of compress.DTYPES.
+      projection: Optional compress.PCAProjection
+        applied to embeddings and queries.
+    """
+    if dtype not in compress.DTYPES:
+      raise ValueError('Unsupported store dtype %s' % dtype)
+    self._kNN = kNN
+    self._initial_capacity = max(1, capacity)
+    self._index = index
+    self._dtype = dtype
+    self._projection = projection
+    if index is not None: index.attach(self)
+    self.clear()
+
+  def clear(self):
+    """Forgets all stored embeddings."""
+    if self._index is not None: self._index.clear()
+    self._base = None
+    self._base_count = 0
+    self._embeddings = None
+    self._scales = np.zeros(0, dtype=np.float32)
+    self._labels = np.zeros(0, dtype=np.int32)
+    self._weights = np.zeros(0, dtype=np.int32)
+    self._count = 0
+    # Float32 copy of the first _decoded_count rows, or None.
+    self._decoded = None
+    self._decoded_count = 0
+    # Row indices of the first kNN examples of each label; only these rows
+    # can carry a padding weight other than 1.
+    self._head_rows = {}
+
+  def _grow(self, dim, capacity=None):
+    """Doubles the capacity of the in-memory rows (or allocates them)."""
+    if capacity is None:
+      if self._embeddings is None: capacity = self._initial_capacity
+      else: capacity = 2 * self._embeddings.shape[0]
+    tail = self._count - self._base_count
+    embeddings = np.empty((capacity, dim), dtype=self._dtype)
+    if self._embeddings is not None:
+      embeddings[:tail] = self._embeddings[:tail]
+    self._embeddings = embeddings
+    # Per-row metadata always covers the base rows too.
+    for name, dtype in (('_scales', np.float32), ('_labels', np.int32),
+                        ('_weights', np.int32)):
+      grown = np.zeros(self._base_count + capacity, dtype=dtype)
+      grown[:self._count] = getattr(self, name)[:self._count]
+      setattr(self, name, grown)
+
+  def _reweight(self, label):
+    """Recomputes the padding weights of a class with few examples."""
+    rows = self._head_rows[label]
+    if len(rows) < self._kNN:
+      # Same expansion np.pad(mode="reflect") used to materialize.
+      padded = np.pad(np.arange(len(rows)), (0, self._kNN - len(rows)),
+                      mode='reflect')
+      counts = np.bincount(padded, minlength=len(rows))
+    else:
+      counts = np.ones(len(rows), dtype=np.int32)
+    self._weights[rows] = counts
+
+  def _prepare(self, emb):
+    """Normalizes, projects (if the projection is ready) and normalizes
+    again an embedding."""
+    emb = np.asarray(emb, dtype=np.float32).ravel()
+    emb = emb/np.sqrt((emb**2).sum())
+    if self._projection is not None and self._projection.fitted():
+      # Fitted on normalized rows, so its mean is on that scale too.
+      emb = self._projection.transform(emb)
+      emb = emb/np.sqrt((emb**2).sum())
+    return emb
+
+  def add(self, emb, label):
+    """Normalizes an embedding and appends it under an integer label."""
+    emb = self._prepare(emb)
+    tail = self._count - self._base_count
+    if self._embeddings is None or tail == self._embeddings.shape[0]:
+      self._grow(emb.shape[0])
+    row = self._count
+    compress.encode(emb[np.newaxis], self._dtype,
+                    self._embeddings[tail:tail + 1], self._scales[row:row + 1])
+    self._labels[row] = label
+    self._weights[row] = 1
+    self._count += 1
+    if self._index is not None: self._index.add(row, emb)
+
+    rows = self._head_rows.setdefault(label, [])
+    if len(rows) < self._kNN:
+      rows.append(row)
+      self._reweight(label)
+
+    if (self._projection is not None and not self._projection.fitted() and
+        self._count >= self._projection.fit_size):
+      self._fitProjection()
+
+  def _fitProjection(self):
+    """Fits the projection on the stored rows and re-encodes them."""
+    vectors = self.embeddings()
+    self._projection.fit(vectors)
+    vectors = self._projection.transform(vectors)
+    vectors /= np.sqrt((vectors**2).sum(axis=1))[:, np.newaxis]
+    self._base = None
+    self._base_count = 0
+    self._embeddings = None
+    self._decoded = None
+    self._grow(vectors.shape[1], capacity=self._scales.shape[0])
+    compress.encode(vectors, self._dtype, self._embeddings[:self._count],
+                    self._scales[:self._count])
+    if self._index is not None:
+      self._index.clear()
+      for row, vector in enumerate(vectors): self._index.add(row, vector)
+
+  def prepare(self, emb):
+    """Returns an embedding the way it is stored and compared: projected
+    (once the projection is fitted) and normalized, as float32."""
+    return self._prepare(emb)
+
+  def rows(self, label):
+    """Returns the rows holding examples of a label."""
+    return np.flatnonzero(self.labels() == label)
+
+  def _codes(self, rows):
+    """Gathers the encoded rows of an int64 array of row numbers."""
+    if self._base is None: return self._embeddings.take(rows, axis=0)
+    codes = np.empty((len(rows), self.segments()[0][0].shape[1]),
+                     dtype=self._dtype)
+    in_base = rows < self._base_count
+    if in_base.any(): codes[in_base] = self._base[rows[in_base]]
+    if not in_base.all():
+      codes[~in_base] = self._embeddings[rows[~in_base] - self._base_count]
+    return codes
+
+  def vectors(self, rows):
+    """Returns the prepared embeddings of some rows, decoded to float32."""
+    rows = np.asarray(rows, dtype=np.int64)
+    if self._count == 0: return np.zeros((0, 0), dtype=np.float32)
+    return compress.decode(self._codes(rows), self._dtype, self._scales[rows])
+
+  def rowSimilarities(self, rows, query_emb):
+    """Returns the similarity of a prepared query to some rows, scored on
+    their codes like _similarities()."""
+    rows = np.asarray(rows, dtype=np.int64)
+    if not len(rows): return np.zeros(0, dtype=np.float32)
+    decoded = self._decodedRows()
+    if decoded is not None: return np.dot(decoded.take(rows, axis=0), query_emb)
+    return compress.similarities(self._codes(rows), self._dtype, query_emb,
+                                 self._scales[rows])
+
+  def _own(self):
+    """Copies the read-only base rows into memory, so rows can change."""
+    if self._base is None: return
+    codes = np.concatenate([codes for codes, _ in self.segments()])
+    self._base = None
+    self._base_count = 0
+    self._embeddings = None
+    self._grow(codes.shape[1], capacity=self._scales.shape[0])
+    self._embeddings[:self._count] = codes
+
+  def replace(self, row, vector):
+    """Overwrites a row with a prepared vector (see prepare()), keeping its
+    label."""
+    if self._index is not None:
+      raise ValueError('Rows of an indexed store cannot be replaced.')
+    self._own()
+    compress.encode(np.asarray(vector, dtype=np.float32)[np.newaxis],
+                    self._dtype, self._embeddings[row:row + 1],
+                    self._scales[row:row + 1])
+    if row < self._decoded_count:
+      self._decoded[row] = compress.decode(self._embeddings[row:row + 1],
+                                           self._dtype,
+                                           self._scales[row:row + 1])[0]
+
+  def remove(self, row):
+    """Removes a row by moving the last row into its place.
+
+    Returns:
+      The former index of the row moved into row, or None if row was last.
+    """
+    if self._index is not None:
+      raise ValueError('Rows of an indexed store cannot be removed.')
+    self._own()
+    last = self._count - 1
+    label = int(self._labels[row])
+    moved = int(self._labels[last])
+    if row != last:
+      self._embeddings[row] = self._embeddings[last]
+      for array in (self._scales, self._labels, self._weights):
+        array[row] = array[last]
+    if last < self._decoded_count:
+      self._decoded[row] = self._decoded[last]
+    elif row < self._decoded_count:
+      self._decoded_count = row
+    self._decoded_count = min(self._decoded_count, last)
+    self._count = last
+    # Row numbers shifted: find the first kNN rows of both labels again.
+    for changed in set((label, moved)):
+      rows = self.rows(changed)[:self._kNN]
+      if not len(rows):
+        del self._head_rows[changed]
+        continue
+      self._weights[rows] = 1
+      self._head_rows[changed] = list(rows)
+      self._reweight(changed)
+    return last if row != last else None
+
+  def load(self, embeddings, labels, scales=None):
+    """Replaces the contents of the store with already encoded rows.
+
+    The embeddings array is used in place (and never written to), so a
+    read-only np.memmap keeps the rows in the page cache rather than the
+    process heap.
+
+    Args:
+      embeddings: Array of normalized rows, shape [rows, dim].
+      labels: Integer labels of the rows.
+      scales: Per-row scales if embeddings is int8.
+    """
+    self.clear()
+    count = len(labels)
+    if embeddings.dtype != np.dtype(self._dtype):
+      # Written with another --storedtype: re-encode into memory.
+      vectors = compress.decode(embeddings, str(embeddings.dtype), scales)
+      embeddings = np.empty(vectors.shape, dtype=self._dtype)
+      scales = np.empty(count, dtype=np.float32)
+      compress.encode(vectors, self._dtype, embeddings, scales)
+    self._base = embeddings
+    self._base_count = count
+    self._count = count
+    self._labels = np.array(labels, dtype=np.int32)
+    self._weights = np.ones(count, dtype=np.int32)
+    self._scales = (np.array(scales, dtype=np.float32) if scales is not None
+                    else np.ones(count, dtype=np.float32))
+    for label in np.unique(self._labels):
+      label = int(label)
+      self._head_rows[label] = list(
+          np.flatnonzero(self._labels == label)[:self._kNN])
+      self._reweight(label)
+    if self._index is not None:
+      for row, vector in enumerate(self.embeddings()):
+        self._index.add(row, vector)
+
+  def extend(self, embeddings, labels, scales=None):
+    """Like load(), for rows that only grew since the last load() or
+    extend(): the rows already held are kept and only the ones after them
+    are taken in, so the cost is that of the new rows.
+
+    Falls back to load() when the store has rows of its own since, or the
+    arrays are shorter than the rows held.
+    """
+    start, count = self._count, len(labels)
+    if (self._base is None or self._base_count != start or count < start or
+        embeddings.dtype != np.dtype(self._dtype) or
+        self._index is not None):
+      self.load(embeddings, labels, scales)
+      return
+    if count > len(self._labels):
+      for name in ('_scales', '_labels', '_weights'):
+        old = getattr(self, name)
+        grown = np.zeros(max(count, 2*len(old)), dtype=old.dtype)
+        grown[:start] = old[:start]
+        setattr(self, name, grown)
+    self._labels[start:count] = labels[start:count]
+    self._weights[start:count] = 1
+    self._scales[start:count] = 1 if scales is None else scales[start:count]
+    self._base = embeddings
+    self._base_count = self._count = count
+    for row in range(start, count):
+      label = int(self._labels[row])
+      rows = self._head_rows.setdefault(label, [])
+      if len(rows) < self._kNN:
+        rows.append(row)
+        self._reweight(label)
+
+  def rebase(self, embeddings):
+    """Moves the leading rows onto an identical read-only copy.
+
+    Used after a snapshot of the first len(embeddings) rows was written, so
+    that those rows are served from the snapshot and the heap keeps only the
+    rows added since.
+    """
+    count = embeddings.shape[0]
+    if self._embeddings is None:
+      tail = embeddings[:0]
+    else:
+      tail = self._embeddings[count - self._base_count:
+                              self._count - self._base_count].copy()
+    self._base = embeddings
+    self._base_count = count
+    self._embeddings = np.empty(
+        (max(self._initial_capacity, 2*len(tail)), embeddings.shape[1]),
+        dtype=self._dtype)
+    self._embeddings[:len(tail)] = tail
+    for name in ('_scales', '_labels', '_weights'):
+      grown = np.zeros(count + self._embeddings.shape[0],
+                       dtype=getattr(self, name).dtype)
+      grown[:self._count] = getattr(self, name)[:self._count]
+      setattr(self, name, grown)
+
+  def segments(self):
+    """Returns the encoded rows as a list of (codes, scales) blocks."""
+    blocks = []
+    if self._base is not None:
+      blocks.append((self._base, self._scales[:self._base_count]))
+    tail = self._count - self._base_count
+    if tail:
+      blocks.append((self._embeddings[:tail],
+                     self._scales[self._base_count:self._count]))
+    return blocks
+
+  def _decodedRows(self):
+    """Returns the rows decoded to float32 while an int8 or float16 store
+    takes less than _DECODED_BYTES decoded, else None.
+
+    Rows added since the last call are decoded now, so the copy costs a
+    decode per row rather than per query.
+    """
+    if self._dtype == 'float32' or self._count == 0: return None
+    dim = self.segments()[0][0].shape[1]
+    if 4*dim*self._count > _DECODED_BYTES:
+      self._decoded = None
+      self._decoded_count = 0
+      return None
+    if self._decoded is None or self._decoded.shape[1] != dim:
+      self._decoded = np.empty((0, dim), dtype=np.float32)
+      self._decoded_count = 0
+    if self._count > self._decoded.shape[0]:
+      decoded = np.empty((min(max(2*self._decoded.shape[0], self._count, 64),
+                              _DECODED_BYTES//(4*dim)), dim),
+                         dtype=np.float32)
+      decoded[:self._decoded_count] = self._decoded[:self._decoded_count]
+      self._decoded = decoded
+    start = self._decoded_count
+    if start < self._count:
+      self._decoded[start:self._count] = self.vectors(
+          np.arange(start, self._count))
+      self._decoded_count = self._count
+    return self._decoded[:self._count]
+
+  def _similarities(self, query_emb):
+    """Returns the similarity of a prepared query to every stored row.
+
+    With a [dim, queries] matrix of prepared queries, returns [rows, queries].
+    """
+    decoded = self._decodedRows()
+    if decoded is not None: return np.dot(decoded, query_emb)
+    sims = [compress.similarities(codes, self._dtype, query_emb, scales)
+            for codes, scales in self.segments()]
+    return sims[0] if len(sims) == 1 else np.concatenate(sims)
+
+  def neighbors(self, query_emb, count):
+    """Returns the rows of up to count nearest embeddings, closest first.
+
+    Args:
+      query_emb: Embedding vector, need not be normalized.
+      count: Int, number of rows to return.
+    """
+    if self._count == 0: return np.zeros(0, dtype=np.int64)
+    # Normalization doesn't change the ranking, but keeps similarities in
+    # [-1, 1] for callers that inspect them.
+    query_emb = self._prepare(query_emb)
+    if self._index is not None:
+      candidates, sims = self._index.search(query_emb)
+    else:
+      candidates = None
+      sims = self._similarities(query_emb)
+
+    count = min(len(sims), count)
+    nearest = np.argpartition(sims, -count)[-count:]
+    nearest = nearest[np.argsort(-sims[nearest])]
+    if candidates is not None: nearest = candidates[nearest]
+    return nearest
+
+  def query(self, query_emb):
+    """Returns the label voted by the kNN nearest stored embeddings.
+
+    Args:
+      query_emb: Embedding vector, need not be normalized.
+
+    Returns:
+      The winning integer label, or None if the store is empty.
+    """
+    if self._count == 0: return None
+
+    # Every row appears at least once in the padded set, so the kNN best
+    # padded entries are always copies of the kNN best distinct rows.
+    return self._vote(self.neighbors(query_emb, self._kNN))
+
+  def queryBatch(self, query_embs):
+    """Returns the label voted for each of several queries, like query().
+
+    Without an index all queries are compared to the store in one
+    matrix-matrix product, which streams the rows once for the batch.
+    """
+    if self._count == 0: return [None]*len(query_embs)
+    if self._index is not None: return [self.query(q) for q in query_embs]
+    queries = np.stack([self._prepare(q) for q in query_embs])
+    sims = self._similarities(queries.T)
+    count = min(len(sims), self._kNN)
+    nearest = np.argpartition(-sims, count - 1, axis=0)[:count]
+    columns = np.arange(nearest.shape[1])
+    nearest = np.take_along_axis(
+        nearest, np.argsort(-sims[nearest, columns], axis=0), axis=0)
+    return [int(label) for label in self._votes(nearest)]
+
+  def _vote(self, nearest):
+    """Returns the label voted by rows sorted closest first."""
+    return int(self._votes(nearest[:, np.newaxis])[0])
+
+  def _votes(self, nearest):
+    """Returns the label voted by each column of a [kNN, queries] array of
+    rows sorted closest first."""
+    # Walk the nearest rows in order and take as many padded copies of each
+    # as still fit in the kNN budget.
+    weights = self._weights[nearest]
+    taken = np.minimum(weights, np.maximum(
+        self._kNN - (np.cumsum(weights, axis=0) - weights), 0))
+    labels = self._labels[nearest]
+    # Count the votes of all queries with one bincount, over the few
+    # labels present rather than all label ids.
+    classes, index = np.unique(labels, return_inverse=True)
+    index = index.reshape(labels.shape)
+    columns = np.arange(labels.shape[1])
+    votes = np.bincount((columns*len(classes) + index).ravel(),
+                        weights=taken.ravel(),
+                        minlength=labels.shape[1]*len(classes))
+    votes = votes.reshape(labels.shape[1], len(classes))
+
+    # Break ties in favour of the label of the closest neighbor.
+    winners = votes[columns, index] == votes.max(axis=1)
+    return labels[np.argmax(winners, axis=0), columns]
+
+  def embeddings(self):
+    """Returns the stored (normalized, projected) embeddings as float32.
+
+    This may be a view of the store (do not modify it) or a decoded copy.
+    """
+    blocks = [compress.decode(codes, self._dtype, scales)
+              if self._dtype != 'float32' else codes
+              for codes, scales in self.segments()]
+    if not blocks: return np.zeros((0, 0), dtype=np.float32)
+    return blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+
+  def dtype(self):
+    """Returns the storage type of the rows."""
+    return self._dtype
+
+  def projected(self):
+    """Returns True if rows are stored after a projection."""
+    return self._projection is not None
+
+  def labels(self):
+    """Returns a view of the stored labels."""
+    return self._labels[:self._count]
+
+  def nbytes(self):
+    """Returns the number of bytes allocated for the store."""
+    allocated = (self._labels.nbytes + self._weights.nbytes +
+                 self._scales.nbytes)
+    if self._embeddings is not None: allocated += self._embeddings.nbytes
+    if self._decoded is not None: allocated += self._decoded.nbytes
+    if self._base is not None and not isinstance(self._base, np.memmap):
+      allocated += self._base.nbytes
+    if self._index is not None: allocated += self._index.nbytes()
+    return allocated
+
+  def __len__(self):
+    return self._count
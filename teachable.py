@@ -17,18 +17,21 @@
 import argparse
 import sys
 import os
+import threading
 import time
 
 from abc import abstractmethod
 from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 os.environ['XDG_RUNTIME_DIR']='/run/user/1000'
 
-from embedding import KNNEmbeddingEngine
-from PIL import Image
-
-import gstreamer
+import buttons
+import compress
+from labels import LabelRegistry
+import metrics
+from overlay import BackgroundLogger
 
 def detectPlatform():
   try:
@@ -46,16 +49,23 @@ def detectPlatform():
 
 
 class UI(object):
-  """Abstract UI class. Subclassed by specific board implementations."""
+  """Abstract UI class. Subclassed by specific board implementations.
+
+     Boards that watch their buttons off the frame path (see buttons.py)
+     set self._events to the buttons.ButtonEvents their input reports to;
+     the others are polled and debounced once per frame.
+  """
   def __init__(self):
     self._button_state = [False for _ in self._buttons]
     current_time = time.time()
     self._button_state_last_change = [current_time for _ in self._buttons]
     self._debounce_interval = 0.1 # seconds
+    self._events = None
 
   def setOnlyLED(self, index):
     for i in range(len(self._LEDs)): self.setLED(i, False)
-    if index is not None: self.setLED(index, True)
+    # Classes past the buttons have no LED.
+    if index is not None and index < len(self._LEDs): self.setLED(index, True)
 
   def isButtonPressed(self, index):
     buttons = self.getButtonState()
@@ -68,6 +78,8 @@ class UI(object):
     raise NotImplementedError()
 
   def getDebouncedButtonState(self):
+    # Presses already debounced by the input's own thread or callbacks.
+    if self._events is not None: return self._events.drain()
     t = time.time()
     for i,new in enumerate(self.getButtonState()):
       if not new:
@@ -84,15 +96,19 @@ class UI(object):
 
   def testButtons(self):
     while True:
+      state = self.getButtonState()
       for i in range(5):
-        self.setLED(i, self.isButtonPressed(i))
+        self.setLED(i, state[i])
       print('Buttons: ', ' '.join([str(i) for i,v in
-          enumerate(self.getButtonState()) if v]))
+          enumerate(state) if v]))
       time.sleep(0.01)
 
-  def wiggleLEDs(self, reps=3):
+  def wiggleLEDs(self, reps=3, stop=None):
+    """Runs a light over the LEDs; stop is an optional threading.Event that
+    ends it early."""
     for i in range(reps):
       for i in range(5):
+        if stop is not None and stop.is_set(): return
         self.setLED(i, True)
         time.sleep(0.05)
         self.setLED(i, False)
@@ -107,19 +123,16 @@ class UI_Keyboard(UI):
     self._buttons = ['q', '1' , '2' , '3', '4']
     self._LEDs = [None]*5
     super(UI_Keyboard, self).__init__()
+    self._events = buttons.ButtonEvents(len(self._buttons),
+                                        self._debounce_interval)
+    self._input = buttons.KeyboardInput(self._events, self._buttons)
 
   def setLED(self, index, state):
     pass
 
   def getButtonState(self):
-    pressed_chars = set()
-    while True:
-      char = keyinput.get_char()
-      if not char : break
-      pressed_chars.add(char)
-
-    state = [b in pressed_chars for b in self._buttons]
-    return state
+    # Keys have no state: a key counts as pressed once, when it is typed.
+    return self._events.drain()
 
 
 class UI_Raspberry(UI):
@@ -140,6 +153,9 @@ class UI_Raspberry(UI):
       rpigpio.setwarnings(False)
       rpigpio.setup(pin, rpigpio.OUT)
     super(UI_Raspberry, self).__init__()
+    self._events = buttons.ButtonEvents(len(self._buttons),
+                                        self._debounce_interval)
+    self._input = buttons.RpiGpioInput(self._events, self._buttons)
 
   def setLED(self, index, state):
     return rpigpio.output(self._LEDs[index],
@@ -175,6 +191,13 @@ class UI_EdgeTpuDevBoard(UI):
       sys.exit(1)
 
     super(UI_EdgeTpuDevBoard, self).__init__()
+    self._events = buttons.ButtonEvents(len(self._buttons),
+                                        self._debounce_interval)
+    try:
+      self._input = buttons.PeripheryInput(self._events, self._buttons)
+    except (GPIOError, AttributeError):
+      # No edge detection on these pins, or an older periphery.
+      self._input = buttons.PollingInput(self._events, self.getButtonState)
 
   def __del__(self):
     if hasattr(self, "_LEDs"):
@@ -189,75 +212,272 @@ class UI_EdgeTpuDevBoard(UI):
     return [button.read() for button in self._buttons]
 
 
+class UI_Passive(UI):
+  """UI without buttons or LEDs, for the additional streams of a multi camera
+     setup: only the first stream is taught from the real buttons."""
+  def __init__(self):
+    self._buttons = [None]*5
+    self._LEDs = [None]*5
+    super(UI_Passive, self).__init__()
+
+  def setLED(self, index, state):
+    pass
+
+  def getButtonState(self):
+    return [False]*len(self._buttons)
+
+
 class TeachableMachine(object):
   """Abstract TeachableMachine class. Subclassed by specific method implementations."""
   @abstractmethod
-  def __init__(self, model_path, ui):
+  def __init__(self, model_path, ui, log_interval=1.0, fps_interval=1.0,
+               gate=None, name=None, scheduler=None, recorder=None):
     assert os.path.isfile(model_path), 'Model file %s not found'%model_path
     self._ui = ui
+    # Prefixes the console status, to tell streams apart.
+    self._name = name
+    # Optional gate.FrameGate; frames it rejects reuse the last result.
+    self._gate = gate
+    # Optional schedule.DeadlineScheduler; frames it skips reuse the last
+    # result too.
+    self._scheduler = scheduler
+    # Optional recorder.Recorder keeping what each frame showed.
+    self._recorder = recorder
     self._start_time = time.time()
     self._frame_times = deque(maxlen=40)
-
-  def visualize(self, classification, svg):
-    self._frame_times.append(time.time())
-    fps = len(self._frame_times)/float(self._frame_times[-1] - self._frame_times[0] + 0.001)
+    # The status only changes (and is only re-rendered and logged) when the
+    # class or example count changes, or every fps_interval for the fps.
+    self._log = BackgroundLogger(log_interval)
+    self._fps_interval = fps_interval
+    self._fps = 0.0
+    self._fps_time = 0.0
+    self._led = -1
+    self._labels = None
+    # Set when all 4 class buttons are held; classify() then returns True.
+    self.clean_shutdown = False
+
+  def visualize(self, classification, overlay):
+    start = metrics.start()
+    now = time.time()
+    self._frame_times.append(now)
+    if now - self._fps_time >= self._fps_interval:
+      self._fps = len(self._frame_times)/float(self._frame_times[-1] - self._frame_times[0] + 0.001)
+      self._fps_time = now
     # Print/Display results
-    self._ui.setOnlyLED(classification)
-    classes = ['--', 'One', 'Two', 'Three', 'Four']
+    if classification != self._led:
+      self._ui.setOnlyLED(classification)
+      self._led = classification
+    if self._labels is None:
+      # The kNN engine names classes past the buttons too.
+      if hasattr(self._engine, 'labelRegistry'):
+        self._labels = self._engine.labelRegistry()
+      else:
+        self._labels = LabelRegistry()
     status = 'fps %.1f; #examples: %d; Class % 7s'%(
-            fps, self._engine.exampleCount(),
-            classes[classification or 0])
-    print(status)
-    svg.add(svg.text(status, insert=(26, 26), fill='black', font_size='20'))
-    svg.add(svg.text(status, insert=(25, 25), fill='white', font_size='20'))
+            self._fps, self._engine.exampleCount(),
+            self._labels.name(classification))
+    if overlay.setText(status):
+      self._log.log('%s: %s'%(self._name, status) if self._name else status)
+    metrics.record('visualize', start)
+    metrics.firstResult()
+
+  def flushLog(self):
+    """Writes out status lines still waiting for the logger thread."""
+    self._log.flush()
 
   def classify(self):
     raise NotImplementedError()
 
+  def shouldInfer(self, img, buttons):
+    """Returns True unless the scheduler or gate lets img reuse the last
+    result."""
+    return self.inferPath(img, buttons) is not None
+
+  def inferPath(self, img, buttons):
+    """Returns how to classify img: 'exact', 'cheap' (as the scheduler
+    decides), or None to reuse the last result.
+
+    Frames with a button pressed are always inferred, and the frame after
+    them too, since the examples (and so the result) may have changed.
+    """
+    path = 'exact'
+    if self._scheduler is not None:
+      # Before the gate, which costs more than skipping a frame.
+      path = self._scheduler.check(buttons)
+      if path is None: return None
+    if self._gate is None: return path
+    start = metrics.start()
+    if any(buttons):
+      self._gate.check(img, force=True)
+      self._gate.reset()
+      infer = True
+    else:
+      infer = self._gate.check(img)
+    metrics.record('gate', start)
+    return path if infer else None
+
+  def scheduled(self, path, start):
+    """Tells the scheduler a classification on path took since start (a
+    time.perf_counter())."""
+    if self._scheduler is not None:
+      self._scheduler.record(path, time.perf_counter() - start)
+
+  def recordFrame(self, img, emb, classification, buttons, downsampled=False):
+    """Hands a frame and its result to the recorder, if there is one."""
+    if self._recorder is None: return
+    start = metrics.start()
+    self._recorder.record(img, emb, classification, buttons,
+                          downsampled=downsampled)
+    metrics.record('record', start)
+
+  def gateStats(self):
+    """Returns the FrameGate counters, or None without a gate."""
+    return self._gate.stats() if self._gate is not None else None
+
+  def schedulerStats(self):
+    """Returns the DeadlineScheduler counters, or None without one."""
+    return self._scheduler.stats() if self._scheduler is not None else None
+
+  def inputSize(self):
+    """Returns the (width, height) frames should have for the model."""
+    return self._engine.requiredImageSize()
+
+  def close(self):
+    """Finishes background work of the engine."""
+    pass
+
 class TeachableMachineKNN(TeachableMachine):
-  def __init__(self, model_path, ui, KNN=3):
-    TeachableMachine.__init__(self, model_path, ui)
+  def __init__(self, model_path, ui, KNN=3, nprobe=None, dtype='float32',
+               projection=None, store_path=None, engine=None,
+               log_interval=1.0, gate=None, name=None, pool=None,
+               backend='edgetpu', scheduler=None, recorder=None):
+    TeachableMachine.__init__(self, model_path, ui, log_interval, gate=gate,
+                              name=name, scheduler=scheduler,
+                              recorder=recorder)
     self._buffer = deque(maxlen = 4)
-    self._engine = KNNEmbeddingEngine(model_path, KNN)
-
-  def classify(self, img, svg):
-    # Classify current image and determine
-    emb = self._engine.DetectWithImage(img)
-    self._buffer.append(self._engine.kNNEmbedding(emb))
-    classification = Counter(self._buffer).most_common(1)[0][0]
+    self._result = None
+    # Optional pool.EnginePool embedding frames on several backends.
+    self._pool = pool
+    if engine is not None:
+      # Injected engine, e.g. the stand-in used by replay.py.
+      self._engine = engine
+      return
+    from embedding import KNNEmbeddingEngine
+    # nprobe switches kNN to an approximate index, see ivf.IVFIndex; dtype
+    # and projection compress the stored embeddings, see compress.py;
+    # store_path keeps the examples across restarts, see persist.py;
+    # backend picks what runs the model, see backends.py.
+    self._engine = KNNEmbeddingEngine(model_path, KNN, nprobe, dtype,
+                                      projection, store_path=store_path,
+                                      backend=backend)
+
+  def classify(self, img, overlay):
     # Interpret user button presses (if any)
-    debounced_buttons = self._ui.getDebouncedButtonState()
+    start = metrics.start()
+    debounced_buttons = list(self._ui.getDebouncedButtonState())
+    metrics.record('buttons', start)
+    path = self.inferPath(img, debounced_buttons)
+    if self._pool is not None:
+      # Embedded by whichever backend is free, the rest follows in frame
+      # order. The frame is copied as the caller's buffer is only borrowed.
+      frame = (self._recorder.downsample(img).copy()
+               if self._recorder is not None else None)
+      self._pool.submit(img.copy() if path is not None else None,
+                        partial(self._pooled, overlay, debounced_buttons,
+                                frame),
+                        stream=self)
+      # _update sees the buttons once the frame is embedded, so a shutdown
+      # it asked for is passed on with the next frame.
+      return self.clean_shutdown
+    # Classify current image (unless it didn't change) and determine
+    emb = None
+    if path == 'cheap':
+      start = time.perf_counter()
+      emb = self._engine.DetectWithImage(img)
+      self._result = self._engine.centroidEmbedding(emb)
+      self.scheduled(path, start)
+    elif path is not None:
+      start = time.perf_counter()
+      emb, self._result = self._engine.classifyImage(img)
+      self.scheduled(path, start)
+    return self._update(overlay, debounced_buttons, emb, img)
+
+  def _pooled(self, overlay, debounced_buttons, frame, emb):
+    if emb is not None: self._result = self._engine.kNNEmbedding(emb)
+    self._update(overlay, debounced_buttons, emb, frame, downsampled=True)
+
+  def _update(self, overlay, debounced_buttons, emb, img, downsampled=False):
+    if (self._scheduler is not None and
+        self._buffer.maxlen != self._scheduler.window()):
+      # The vote spans as many classifications whatever the stride.
+      self._buffer = deque(self._buffer, maxlen=self._scheduler.window())
+    self._buffer.append(self._result)
+    classification = Counter(self._buffer).most_common(1)[0][0]
+    self.recordFrame(img, emb, classification, debounced_buttons, downsampled)
+    start = metrics.start()
     for i, b in enumerate(debounced_buttons):
       if not b: continue
       if i == 0: self._engine.clear() # Hitting button 0 resets
       else : self._engine.addEmbedding(emb, i) # otherwise the button # is the class
+    metrics.record('teach', start)
     # Hitting exactly all 4 class buttons simultaneously quits the program.
     if sum(filter(lambda x:x, debounced_buttons[1:])) == 4 and not debounced_buttons[0]:
       self.clean_shutdown = True
       return True # return True to shut down pipeline
-    return self.visualize(classification, svg)
+    return self.visualize(classification, overlay)
 
 class TeachableMachineImprinting(TeachableMachine):
-  def __init__(self, model_path, ui, output_path, keep_classes):
-    TeachableMachine.__init__(self, model_path, ui)
-    self._BATCHSIZE = 1 # batch size for the engine to train for once.
+  def __init__(self, model_path, ui, output_path, keep_classes, engine=None,
+               log_interval=1.0, gate=None, scheduler=None, recorder=None):
+    TeachableMachine.__init__(self, model_path, ui, log_interval, gate=gate,
+                              scheduler=scheduler, recorder=recorder)
+    self._classification = None
+    # Queued images that start training without waiting for more: one, so a
+    # taught example takes effect as soon as possible. Training runs in the
+    # background, images arriving meanwhile join the next batch.
+    self._BATCHSIZE = 1
+    if engine is not None:
+      self._engine = engine
+      return
     from imprinting import DemoImprintingEngine
     self._engine = DemoImprintingEngine(model_path, output_path, keep_classes, self._BATCHSIZE)
 
-  def classify(self, img, svg):
-    # Classifty current image and determine
-    classification = self._engine.classify(img)
+  def classify(self, img, overlay):
     # Interpret user button presses (if any)
+    start = metrics.start()
     debounced_buttons = self._ui.getDebouncedButtonState()
+    metrics.record('buttons', start)
+    # Classifty current image (unless it didn't change) and determine
+    emb = None
+    path = self.inferPath(img, debounced_buttons)
+    if path is not None:
+      start = metrics.start()
+      begin = time.perf_counter()
+      if hasattr(self._engine, 'classifyImage'):
+        # Keep the embedding, so that teaching this frame does not redo it.
+        emb, self._classification = self._engine.classifyImage(img)
+      else:
+        self._classification = self._engine.classify(img)
+      self.scheduled(path, begin)
+      metrics.record('imprinting', start)
+    classification = self._classification
+    self.recordFrame(img, emb, classification, debounced_buttons)
+    start = metrics.start()
     for i, b in enumerate(debounced_buttons):
       if not b: continue
       if i == 0: self._engine.clear() # Hitting button 0 resets
-      else : self._engine.addImage(img, i) # otherwise the button # is the class
+      elif emb is not None: self._engine.addEmbedding(emb, i, img) # otherwise the button # is the class
+      else : self._engine.addImage(img, i)
+    metrics.record('teach', start)
     # Hitting exactly all 4 class buttons simultaneously quits the program.
     if sum(filter(lambda x:x, debounced_buttons[1:])) == 4 and not debounced_buttons[0]:
       self.clean_shutdown = True
       return True # return True to shut down pipeline
-    return self.visualize(classification, svg)
+    return self.visualize(classification, overlay)
+
+  def close(self):
+    """Waits for queued examples to be trained and saved."""
+    self._engine.close()
 
 def main(args):
     parser = argparse.ArgumentParser()
@@ -268,41 +488,299 @@ def main(args):
     parser.add_argument('--keyboard', dest='keyboard', action='store_true',
                         help='Run test of UI. Ctrl-C to abort.')
     parser.add_argument('--method', dest='method',
-                        help='method for transfer learning, support knn or imprinting',
+                        help='method for transfer learning, support knn, imprinting, or imprinting-numpy (imprinting on the --model embeddings in NumPy, without retraining a model per example)',
                         default='knn',
-                        choices=['knn', 'imprinting'])
-    parser.add_argument('--outputmodel', help='File path of output Tflite model, only for imprinting method.',
+                        choices=['knn', 'imprinting', 'imprinting-numpy'])
+    parser.add_argument('--outputmodel', help='File path of output Tflite model, only for imprinting method (and imprinting-numpy with --export).',
                         default='output.tflite')
     parser.add_argument('--keepclasses', dest='keepclasses', action='store_true',
-                        help='Whether to keep base model classes, only for imprinting method.')
+                        help='Whether to keep base model classes, only for imprinting method (and imprinting-numpy with --export).')
+    parser.add_argument('--export', dest='export', action='store_true',
+                        help='Keep the taught images and write them as an imprinted --outputmodel on exit, only for imprinting-numpy method.')
+    parser.add_argument('--nprobe', type=int, default=None,
+                        help='Use approximate kNN search, scanning this many index lists per frame, only for knn method.')
+    parser.add_argument('--storedtype', default='float32',
+                        choices=['float32', 'float16', 'int8'],
+                        help='Storage type of the kNN embeddings, only for knn method.')
+    parser.add_argument('--projection', default=None,
+                        choices=compress.PROJECTIONS,
+                        help='Reduce kNN embeddings to %d dimensions before storing them, only for knn method.' % compress.PROJECTION_DIM)
+    parser.add_argument('--store', dest='store', default=None,
+                        help='Directory to keep taught kNN examples in across restarts, only for knn method.')
+    parser.add_argument('--capacity', type=int, default=None,
+                        help='Keep at most this many kNN examples in total, only for knn method.')
+    parser.add_argument('--classcapacity', type=int, default=None,
+                        help='Keep at most this many kNN examples per class, only for knn method.')
+    parser.add_argument('--policy', default='reservoir',
+                        choices=['reservoir', 'prune', 'kmeans'],
+                        help='Which examples a store at capacity keeps: a random sample, the least redundant ones, or merged prototypes, only with --capacity or --classcapacity.')
+    parser.add_argument('--shared', default=None,
+                        help='File (e.g. in /dev/shm) holding kNN examples shared with other processes of this host, only for knn method.')
+    parser.add_argument('--sharedreader', action='store_true',
+                        help='Classify with the --shared examples another process teaches; the buttons do not teach.')
+    parser.add_argument('--loginterval', type=float, default=1.0,
+                        help='Seconds between writes of status changes to the console.')
+    parser.add_argument('--gate', type=float, default=None,
+                        help='Reuse the last result while frames differ by less than this mean intensity (0-255) from the last inferred one.')
+    parser.add_argument('--refresh', type=int, default=30,
+                        help='Run inference at least every this many frames, only with --gate.')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='Milliseconds of classification allowed per frame: slower classifications run on every Nth frame only, or on a cheaper path for knn (see schedule.py).')
+    parser.add_argument('--duty', type=float, default=None,
+                        help='Fraction of the time between frames classification may take (e.g. to bound power), like --budget.')
+    parser.add_argument('--maxstride', type=int, default=8,
+                        help='Most frames one classification stands for, only with --budget or --duty.')
+    parser.add_argument('--record', default=None,
+                        help='Directory to record downsampled frames, embeddings, results and button presses in, from a background thread (see recorder.py).')
+    parser.add_argument('--recordmb', type=float, default=256,
+                        help='Megabytes the recording of each stream keeps at most, dropping the oldest, only with --record.')
+    parser.add_argument('--source', dest='sources', action='append', default=None,
+                        help='Camera device, video file or videotestsrc[:PATTERN] to classify; repeat for several streams sharing one model, only for knn method with more than one. Default /dev/video0.')
+    parser.add_argument('--batchwait', type=float, default=5.0,
+                        help='Milliseconds to wait for frames of other streams to classify together, only with several --source.')
+    parser.add_argument('--backend', default='edgetpu',
+                        choices=['edgetpu', 'cpu', 'reference'],
+                        help='What runs the model: the Edge TPU, the CPU (TF Lite interpreter) or a NumPy stand-in for benchmarking, only for knn and imprinting-numpy methods.')
+    parser.add_argument('--tpus', type=int, default=1,
+                        help='Number of Edge TPUs to spread inference over, 0 for all, only for knn method.')
+    parser.add_argument('--cpuworkers', type=int, default=0,
+                        help='Run the cpu or reference backend in this many worker processes, only for knn method.')
+    parser.add_argument('--metrics', default=None,
+                        help='Collect per-stage latency histograms and write them to this file, as Prometheus text if it ends in .prom and JSON otherwise.')
+    parser.add_argument('--metricsinterval', type=float, default=10.0,
+                        help='Seconds between writes of --metrics.')
+    parser.add_argument('--metricsport', type=int, default=None,
+                        help='Serve the latency histograms over HTTP on this localhost port (Prometheus text, or JSON at /metrics.json).')
+    parser.add_argument('--srcsize', default='640x480',
+                        help='WIDTHxHEIGHT to capture the sources at.')
+    parser.add_argument('--framerate', type=int, default=30,
+                        help='Frames per second to capture the sources at.')
+    parser.add_argument('--headless', dest='headless', action='store_true',
+                        help='Do not show the video (it goes to a fakesink), e.g. to benchmark without a display.')
+    parser.add_argument('--unthrottled', dest='unthrottled', action='store_true',
+                        help='Generate test patterns and decode files as fast as the pipeline takes them instead of at --framerate.')
+    parser.add_argument('--leaky', default='downstream',
+                        choices=['no', 'upstream', 'downstream'],
+                        help='Which frames full GStreamer queues drop; with no, slow classification holds the sources back.')
+    parser.add_argument('--queuesize', type=int, default=1,
+                        help='Frames each GStreamer queue holds.')
+    parser.add_argument('--frames', type=int, default=None,
+                        help='Stop after this many frames of each camera or test pattern source.')
+    parser.add_argument('--crop', dest='crop', action='store_true',
+                        help='Center crop camera frames to the model input instead of stretching them.')
+    parser.add_argument('--pipelined', dest='pipelined', action='store_true',
+                        help='Classify frames on a worker thread, dropping stale frames, instead of in the capture callback.')
+    parser.add_argument('--queuedepth', type=int, default=2,
+                        help='Number of frames queued for the worker, only with --pipelined.')
     args = parser.parse_args()
+    sources = args.sources or ['/dev/video0']
+    src_size = tuple(int(x) for x in args.srcsize.split('x'))
+    if len(sources) > 1 and args.method != 'knn':
+      parser.error('Several --source are only supported by the knn method.')
+    if args.method != 'knn' and (args.tpus != 1 or args.cpuworkers):
+      parser.error('--tpus and --cpuworkers are only supported by the knn method.')
+    if args.method == 'imprinting' and args.backend != 'edgetpu':
+      parser.error('--backend is not supported by the imprinting method.')
+    if args.export and args.method != 'imprinting-numpy':
+      parser.error('--export is only supported by the imprinting-numpy method.')
+    if (args.capacity or args.classcapacity) and (args.nprobe or args.store):
+      parser.error('--capacity and --classcapacity cannot be combined with --nprobe or --store.')
+    if args.shared and (args.nprobe or args.projection or args.store or
+                        args.capacity or args.classcapacity):
+      parser.error('--shared cannot be combined with --nprobe, --projection, --store, --capacity or --classcapacity.')
+    if args.sharedreader and not args.shared:
+      parser.error('--sharedreader needs --shared.')
+    if (args.budget or args.duty) and (len(sources) > 1 or args.tpus != 1 or
+                                       args.cpuworkers):
+      parser.error('--budget and --duty cannot be combined with several --source, --tpus or --cpuworkers.')
+    if args.tpus != 1 and args.backend != 'edgetpu':
+      parser.error('--tpus needs the edgetpu backend.')
+    if args.cpuworkers and args.backend == 'edgetpu':
+      parser.error('--cpuworkers needs the cpu or reference backend, use --tpus for Edge TPUs.')
+
+    startup = metrics.startupBegin()
+    if args.metrics or args.metricsport:
+      metrics.enable()
+    executor = ThreadPoolExecutor(2)
+    if not args.testui:
+      # GStreamer starts up and the camera opens while the model loads. The
+      # frame size comes from the model file, so it need not be loaded yet.
+      import modelinfo
+      appsink_size = modelinfo.imageSize(args.model)
+      def buildPipeline():
+        start = time.perf_counter()
+        import gstreamer
+        gstreamer.init()
+        metrics.startupPhase('gstreamer', start)
+        start = time.perf_counter()
+        builder = gstreamer.PipelineBuilder(
+            sources, src_size, args.framerate, appsink_size, args.crop,
+            display=not args.headless, leaky=args.leaky,
+            queue_size=args.queuesize, throttle=not args.unthrottled,
+            num_buffers=args.frames)
+        pipeline = builder.build()
+        metrics.startupPhase('pipeline', start)
+        return builder, pipeline
+      gst = executor.submit(buildPipeline)
 
     # The UI differs a little depending on the system because the GPIOs
     # are a little bit different.
     print('Initialize UI.')
+    start = time.perf_counter()
     platform = detectPlatform()
-    if args.keyboard:
+    if args.sharedreader:
+      # Another process teaches.
+      ui = UI_Passive()
+    elif args.keyboard:
       ui = UI_Keyboard()
     else:
       if platform == 'raspberry': ui = UI_Raspberry()
       elif platform == 'devboard': ui = UI_EdgeTpuDevBoard()
-      else:
+      elif sys.stdin.isatty():
         print('No GPIOs detected - falling back to Keyboard input')
         ui = UI_Keyboard()
+      else:
+        print('No GPIOs or terminal detected - running without buttons')
+        ui = UI_Passive()
+    metrics.startupPhase('ui', start)
 
-    ui.wiggleLEDs()
     if args.testui:
+        ui.wiggleLEDs()
         ui.testButtons()
         return
 
+    # The LEDs show startup progress until the first frame, no longer.
+    leds_done = threading.Event()
+    def wiggleLEDs():
+      start = time.perf_counter()
+      ui.wiggleLEDs(stop=leds_done)
+      metrics.startupPhase('leds', start)
+    leds = executor.submit(wiggleLEDs)
+
+    exporter = None
+    if args.metrics: exporter = metrics.Exporter(args.metrics, args.metricsinterval)
+    if args.metricsport: metrics.serve(args.metricsport)
+
     print('Initialize Model...')
+    start = time.perf_counter()
+    def makeGate():
+      if args.gate is None: return None
+      from gate import FrameGate
+      return FrameGate(args.gate, args.refresh)
+    recorders = []
+    def makeRecorder(stream):
+      if not args.record: return None
+      from recorder import Recorder
+      # One recording per stream, each within --recordmb.
+      path = (os.path.join(args.record, 'cam%d' % stream) if len(sources) > 1
+              else args.record)
+      recorders.append(Recorder(path, max_bytes=int(args.recordmb*(1 << 20))))
+      return recorders[-1]
+    def makeScheduler(cheap):
+      if not (args.budget or args.duty): return None
+      from schedule import DeadlineScheduler
+      return DeadlineScheduler(args.budget, args.duty, args.maxstride,
+                               cheap=cheap)
+    engine = pool = shared = None
     if args.method == 'knn':
-      teachable = TeachableMachineKNN(args.model, ui)
+      from embedding import KNNEmbeddingEngine
+      engine = KNNEmbeddingEngine(args.model, 3, args.nprobe, args.storedtype,
+                                  args.projection, store_path=args.store,
+                                  backend=args.backend,
+                                  capacity=args.capacity,
+                                  class_capacity=args.classcapacity,
+                                  policy=args.policy, shared_path=args.shared,
+                                  shared_reader=args.sharedreader)
+    if args.tpus != 1:
+      # The engine's own Edge TPU plus one more engine per further TPU.
+      from backends import edgeTpuPaths
+      from embedding import EmbeddingEngine
+      from pool import EnginePool, ThreadBackend
+      paths = edgeTpuPaths()
+      if args.tpus: paths = paths[:args.tpus - 1]
+      pool = EnginePool([ThreadBackend(engine)] +
+                        [ThreadBackend(EmbeddingEngine(args.model, path), path)
+                         for path in paths])
+    elif args.cpuworkers:
+      from embedding import EmbeddingEngine
+      from pool import EnginePool, ProcessBackend
+      pool = EnginePool([ProcessBackend(partial(EmbeddingEngine, args.model,
+                                                backend=args.backend))
+                         for _ in range(args.cpuworkers)])
+    if len(sources) > 1:
+      # One model and store for all streams; the buttons teach from the first.
+      from multistream import SharedKNNEngine
+      shared = SharedKNNEngine(engine, max_batch=len(sources),
+                               max_wait=args.batchwait/1000.0, embedder=pool)
+      machines = [TeachableMachineKNN(args.model, ui if i == 0 else UI_Passive(),
+                                      engine=shared,
+                                      log_interval=args.loginterval,
+                                      gate=makeGate(), name='cam%d'%i,
+                                      recorder=makeRecorder(i))
+                  for i in range(len(sources))]
+    elif args.method == 'knn':
+      machines = [TeachableMachineKNN(args.model, ui, engine=engine,
+                                      log_interval=args.loginterval,
+                                      gate=makeGate(), pool=pool,
+                                      scheduler=makeScheduler(True),
+                                      recorder=makeRecorder(0))]
+    elif args.method == 'imprinting-numpy':
+      from embedding import ImprintingEmbeddingEngine
+      engine = ImprintingEmbeddingEngine(
+          args.model, backend=args.backend,
+          export_path=args.outputmodel if args.export else None,
+          keep_classes=args.keepclasses)
+      machines = [TeachableMachineImprinting(args.model, ui, args.outputmodel, args.keepclasses,
+                                             engine=engine,
+                                             log_interval=args.loginterval,
+                                             gate=makeGate(),
+                                             scheduler=makeScheduler(False),
+                                             recorder=makeRecorder(0))]
     else:
-      teachable = TeachableMachineImprinting(args.model, ui, args.outputmodel, args.keepclasses)
+      machines = [TeachableMachineImprinting(args.model, ui, args.outputmodel, args.keepclasses,
+                                             log_interval=args.loginterval,
+                                             gate=makeGate(),
+                                             scheduler=makeScheduler(False),
+                                             recorder=makeRecorder(0))]
+
+    metrics.startupPhase('model', start)
 
     print('Start Pipeline.')
-    result = gstreamer.run_pipeline(teachable.classify)
+    builder, pipeline = gst.result()
+    leds_done.set()
+    leds.result()
+    executor.shutdown()
+    import gstreamer
+    if machines[0].inputSize() != appsink_size:
+      # The engine takes other frames than the model file says (the
+      # reference backend); build the pipeline again for those.
+      pipeline.set_state(gstreamer.Gst.State.NULL)
+      appsink_size = builder.appsink_size = tuple(machines[0].inputSize())
+      pipeline = builder.build()
+    result = gstreamer.run_pipeline([m.classify for m in machines],
+                                    src_size=src_size,
+                                    appsink_size=appsink_size,
+                                    crop=args.crop,
+                                    pipelined=args.pipelined,
+                                    queue_depth=args.queuedepth,
+                                    sources=sources,
+                                    pipeline=pipeline)
+    for m in machines:
+      m.close()
+      if m.gateStats() is not None: print('Gate stats: ', m.gateStats())
+      if m.schedulerStats() is not None:
+        print('Scheduler stats: ', m.schedulerStats())
+    if shared is not None:
+      shared.stop()
+      print('Batch stats: ', shared.stats())
+    if pool is not None:
+      pool.close()
+      print('Engine stats: ', pool.stats())
+    for recorder in recorders:
+      recorder.close()
+      print('Recorder stats: ', recorder.stats())
+    if exporter is not None: exporter.stop()
+    print(startup.report())
 
     ui.wiggleLEDs(4)
 